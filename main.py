@@ -2,9 +2,27 @@ import os
 import base64
 import json
 import time, datetime, math, requests
+import numpy as np
+import re, csv, queue, sqlite3, threading, struct, copy, bisect, gzip
+from collections import deque
+from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dhanhq import dhanhq
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import RefreshError
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+try:
+    import msgpack, zstandard
+except ImportError:
+    msgpack = zstandard = None
 
 print("🔥 N50 FINAL MASTER ENGINE V5.1 ULTRA RUNNING 🔥")
 
@@ -24,2613 +42,5501 @@ creds = Credentials.from_service_account_info(
 )
 
 gc = gspread.authorize(creds)
-ws = gc.open("N50").sheet1
-# ================= ULTRA SHEET MODE =================
-SHEET_CACHE = {}
-WRITE_CACHE = {}
 
-LAST_CPR=None
+# ================= WORKSHEET REGISTRY =================
 
-STATE = {}
+# spreadsheet + tab handles are resolved once and shared by every engine,
+# they are only dropped and re-resolved after an auth/expiry error
 
-STATE["predictive_gamma"] = "NONE"
-STATE["premium_velocity"] = 0
-# ================= GOD TIER STATE =================
+SPREADSHEET_NAME = os.getenv("SPREADSHEET_NAME", "N50")
 
+SHEETS = {"book": None, "tabs": {}}
+SHEETS_LOCK = threading.RLock()
 
-def set_state(key,value):
-    STATE[key] = value
+def worksheet(name=None):
 
-def get_state(key,default=""):
-    return STATE.get(key,default)
-# ================= SAFE =================
+    # None -> first tab (the dashboard)
+    with SHEETS_LOCK:
 
-def safe(c):
-    v = SHEET_CACHE.get(c,"")
-    return "" if v is None else str(v).strip()
+        tabs = SHEETS["tabs"]
 
-def ultra_write(cell,value):
-    WRITE_CACHE[cell] = value
+        if name not in tabs:
 
-# ================= DHAN CLIENT =================
+            book = spreadsheet()
 
-CLIENT_ID = ws.acell("B1").value
-ACCESS_TOKEN = ws.acell("B2").value
+            tabs[name] = book.sheet1 if name is None else book.worksheet(name)
 
+        return tabs[name]
 
-dhan = dhanhq(CLIENT_ID, ACCESS_TOKEN)
 
-# ================= HEADERS =================
+def spreadsheet():
 
-def headers():
-    return {
-        "client-id": CLIENT_ID,
-        "access-token": ACCESS_TOKEN,
-        "Content-Type": "application/json"
-    }
+    with SHEETS_LOCK:
 
+        if SHEETS["book"] is None:
+            SHEETS["book"] = gc.open(SPREADSHEET_NAME)
 
-# ================= MARKET =================
+        return SHEETS["book"]
 
-# ================= MARKET (ULTRA SAFE) =================
 
-def market():
+def is_auth_error(e):
 
-    try:
+    if isinstance(e, RefreshError):
+        return True
 
-        r = requests.post(
-            "https://api.dhan.co/v2/marketfeed/quote",
-            headers=headers(),
-            json={"IDX_I":[13]}
-        ).json()
+    status = getattr(getattr(e, "response", None), "status_code", None)
 
-        # ----- SAFE PARSE -----
-        if "data" not in r:
-            print("MARKET ERROR:", r)
-            return None, None
+    return status == 401 or "UNAUTHENTICATED" in str(e)
 
-        data = r.get("data", {})
 
-        if "IDX_I" not in data:
-            print("MARKET IDX_I MISSING:", r)
-            return None, None
+def refresh_worksheets():
 
-        idx = data["IDX_I"]
+    # drops every handle; each thread re-resolves the tabs it uses (the
+    # loop rebinds ws itself)
+    global gc
 
-        if "13" not in idx:
-            print("MARKET SECURITY ID MISSING:", r)
-            return None, None
+    with SHEETS_LOCK:
 
-        ltp = float(idx["13"]["last_price"])
+        gc = gspread.authorize(creds)
 
-    except Exception as e:
+        SHEETS["book"] = None
+        SHEETS["tabs"].clear()
 
-        print("MARKET API ERROR:", e)
-        return None, None
+    print("SHEETS RE-AUTHORIZED")
 
 
-    # ---------- INDIA VIX ----------
-    vix = 15
+ws = worksheet()
+# ================= ULTRA SHEET MODE =================
+SHEET_CACHE = {}
+WRITE_CACHE = {}
 
-    try:
+LAST_CPR=None
 
-        s = requests.Session()
-        h = {"User-Agent":"Mozilla/5.0"}
+STATE = {}
 
-        s.get("https://www.nseindia.com", headers=h)
+# ================= SIGNAL BUS =================
 
-        j = s.get("https://www.nseindia.com/api/allIndices", headers=h).json()
+# Every source and engine output is published here with a version that
+# bumps only on change. Engines read same-tick values through read_signal()
+# instead of last tick's sheet cell; the cell is only where the writer
+# renders the value, and the fallback before anything was published.
 
-        for i in j.get("data", []):
-            if i.get("index") == "INDIA VIX":
-                vix = float(i.get("last",15))
+# name -> {"value", "key", "version"}
+INPUTS = {}
+INPUTS_LOCK = threading.Lock()
 
-    except:
-        pass
+SIGNAL_CELLS = {
+    "ltp": "C6", "vwap": "Q3",
+    "resistance": "B31", "maxpain": "B32", "support": "B33"
+}
+CELL_SIGNALS = {cell: name for name,cell in SIGNAL_CELLS.items()}
 
-    return ltp, vix
+SIGNAL_TYPES = {
+    "ltp": float, "vwap": float,
+    "resistance": float, "maxpain": float, "support": float
+}
 
 
-# ================= CPR ENGINE (ULTRA SAFE FINAL) =================
+def publish(name, value, key=None):
 
-def cpr_engine(ltp):
+    # bump the version only when the input actually changed
+    key = value if key is None else key
 
-    global LAST_CPR
+    with INPUTS_LOCK:
 
-    try:
+        slot = INPUTS.get(name)
 
-        hist = requests.post(
-            "https://api.dhan.co/v2/charts/historical",
-            headers=headers(),
-            json={
-                "securityId":"13",
-                "exchangeSegment":"IDX_I",
-                "instrument":"INDEX",
-                "fromDate":(datetime.date.today()-datetime.timedelta(days=10)).strftime("%Y-%m-%d"),
-                "toDate":datetime.date.today().strftime("%Y-%m-%d")
-            }
-        ).json()
-
-        highs=[]
-        lows=[]
-        closes=[]
-
-        # ---- SAFE PARSE ----
-        if "high" in hist:
-            highs = hist.get("high",[])
-            lows  = hist.get("low",[])
-            closes= hist.get("close",[])
-
-        elif "data" in hist:
-            data = hist.get("data",{})
-            highs = data.get("high",[])
-            lows  = data.get("low",[])
-            closes= data.get("close",[])
+        if slot is None:
+            slot = INPUTS[name] = {"value": None, "key": None, "version": 0}
 
-        else:
-            print("CPR STRUCTURE UNKNOWN:",hist)
-            return
+        if slot["version"] == 0 or slot["key"] != key:
+            slot["version"] += 1
 
-        if len(highs)<2 or len(lows)<2 or len(closes)<2:
-            print("CPR INSUFFICIENT DATA")
-            return
+        slot["value"] = value
+        slot["key"] = key
 
-        H=highs[-2]
-        L=lows[-2]
-        C=closes[-2]
 
-        pivot=(H+L+C)/3
-        bc=(H+L)/2
-        tc=pivot*2-bc
+def read(name, default=None):
 
-        tc,bc=max(tc,bc),min(tc,bc)
+    slot = INPUTS.get(name)
 
-        width=abs(tc-bc)
+    return slot["value"] if slot else default
 
-        if width<=40:
-            typ="ULTRA NARROW ⚡"
-        elif width<=70:
-            typ="NARROW 🔥"
-        elif width<=120:
-            typ="NORMAL"
-        else:
-            typ="WIDE 🧊"
 
-        ws.update(range_name="H4:H6", values=[[tc],[pivot],[bc]])
+def read_signal(name):
 
-        ultra_write("H7",width)
-        ultra_write("H8",typ)
+    # typed: floats (None when unset) or stripped strings, like safe()
+    slot = INPUTS.get(name)
 
-        relation="INSIDE CPR"
+    value = slot["value"] if slot else SHEET_CACHE.get(SIGNAL_CELLS.get(name), "")
 
-        if ltp>tc:
-            relation="ABOVE CPR"
-        elif ltp<bc:
-            relation="BELOW CPR"
+    if SIGNAL_TYPES.get(name) is float:
+        return to_float(value)
 
-        set_state("relation", relation)
-        set_state("tc", tc)
-        set_state("pivot", pivot)
-        set_state("bc", bc)
+    return "" if value is None else str(value).strip()
 
-        ultra_write("H9",relation)
+# ================= TYPED SIGNALS =================
 
-    except Exception as e:
+# Engine states are IntEnum codes held in one __slots__ record per
+# underlying (SIG). Engines compare codes, never labels; the label is only
+# rendered when emit() hands a code to its cell, so rewording a label
+# cannot change a decision.
 
-        print("CPR ENGINE ERROR:",e)
+class Relation(IntEnum):
+    NONE = 0; ABOVE = 1; INSIDE = 2; BELOW = 3
 
+class Gamma(IntEnum):
+    NEUTRAL = 0; UP = 1; DOWN = 2; TRAP = 3
 
-#==================== RESIS/SUPP/MAX PAIN ======================
+class Flow(IntEnum):
+    NONE = 0; PROBABLE = 1; ULTRA_UP = 2; ULTRA_DOWN = 3
 
-def oi_levels_engine(ltp, oc):
+class Strength(IntEnum):
+    # ordered: >= STRONG covers SUPER_STRONG
+    INVALIDATED = 0; WEAKENING = 1; STRONG = 2; SUPER_STRONG = 3
 
-    max_ce_oi = 0
-    max_pe_oi = 0
+class Side(IntEnum):
+    NONE = 0; CE = 1; PE = 2
 
-    resistance = None
-    support = None
-    pain_map = {}
+class God(IntEnum):
+    NONE = 0; LONG = 1; SHORT = 2
 
-    atm = round(ltp/50)*50
+class Predictive(IntEnum):
+    NONE = 0; EARLY_UP = 1; EARLY_DOWN = 2; IGNITION = 3
 
-    for k,v in oc.items():
+class Sniper(IntEnum):
+    WAIT = 0
+    GOD_LONG = 1; GOD_SHORT = 2
+    NEWS_LONG = 3; NEWS_SHORT = 4
+    PREDICTIVE_LONG = 5; PREDICTIVE_SHORT = 6
+    EARLY_LONG = 7; EARLY_SHORT = 8
+    LONG_READY = 9; SHORT_READY = 10
 
-        strike = int(float(k))
+class Block(IntEnum):
+    NONE = 0; PREMIUM_TRAP = 1; MAGNET = 2; NO_FLOW = 3; WEAK = 4
 
-        # only relevant strikes
-        if abs(strike-atm) > 500:
-            continue
+class Target(IntEnum):
+    NONE = 0; PIVOT_MAGNET = 1; TC = 2; BC = 3
+    PDH = 4; RESIST = 5; PDL = 6; SUPPORT = 7; MAX_PAIN = 8
 
-        ce = v.get("ce")
-        pe = v.get("pe")
+class Trend(IntEnum):
+    NONE = 0; SHORT = 1; LONG = 2
 
-        ce_oi = ce.get("oi",0) if ce else 0
-        pe_oi = pe.get("oi",0) if pe else 0
+class Regime(IntEnum):
+    NONE = 0; DEALER_SHORT = 1; DEALER_LONG = 2; CONT_SHORT = 3; CONT_LONG = 4
 
-        if strike > ltp and ce_oi > max_ce_oi:
-            max_ce_oi = ce_oi
-            resistance = strike
+class Dark(IntEnum):
+    NONE = 0; SHORT_BUILD = 1
 
-        if strike < ltp and pe_oi > max_pe_oi:
-            max_pe_oi = pe_oi
-            support = strike
+class Decision(IntEnum):
+    WAIT = 0; CONFLICT = 1; CE_BUY = 2; PE_BUY = 3
 
-        pain_map[strike] = abs(ce_oi - pe_oi)
 
-    if resistance:
-        ultra_write("B31", resistance)
+LABELS = {
+    Relation: {Relation.NONE: "", Relation.ABOVE: "ABOVE CPR", Relation.INSIDE: "INSIDE CPR", Relation.BELOW: "BELOW CPR"},
+    Gamma: {Gamma.NEUTRAL: "NEUTRAL", Gamma.UP: "TRUE GAMMA UP 🚀", Gamma.DOWN: "TRUE GAMMA DOWN 🔻", Gamma.TRAP: "PREMIUM TRAP ⚠️"},
+    Flow: {Flow.NONE: "NO FLOW", Flow.PROBABLE: "PROBABLE FLOW", Flow.ULTRA_UP: "ULTRA FLOW 🚀", Flow.ULTRA_DOWN: "ULTRA FLOW 🔻"},
+    Strength: {Strength.INVALIDATED: "INVALIDATED", Strength.WEAKENING: "WEAKENING", Strength.STRONG: "STRONG", Strength.SUPER_STRONG: "SUPER STRONG 🚀"},
+    Side: {Side.NONE: "", Side.CE: "CE", Side.PE: "PE"},
+    God: {God.NONE: "NO GOD SIGNAL", God.LONG: "🔥 GOD MODE LONG", God.SHORT: "🔻 GOD MODE SHORT"},
+    Predictive: {Predictive.NONE: "NONE", Predictive.EARLY_UP: "EARLY UP PRESSURE",
+                 Predictive.EARLY_DOWN: "EARLY DOWN PRESSURE", Predictive.IGNITION: "PREDICTIVE GAMMA IGNITION"},
+    Sniper: {
+        Sniper.WAIT: "WAIT",
+        Sniper.GOD_LONG: "⚡ GOD EARLY LONG", Sniper.GOD_SHORT: "⚡ GOD EARLY SHORT",
+        Sniper.NEWS_LONG: "🚨 NEWS SNIPER LONG", Sniper.NEWS_SHORT: "🚨 NEWS SNIPER SHORT",
+        Sniper.PREDICTIVE_LONG: "⚡ V2 PREDICTIVE LONG", Sniper.PREDICTIVE_SHORT: "⚡ V2 PREDICTIVE SHORT",
+        Sniper.EARLY_LONG: "⚡ EARLY SNIPER LONG", Sniper.EARLY_SHORT: "⚡ EARLY SNIPER SHORT",
+        Sniper.LONG_READY: "🔥 TRUE SNIPER LONG READY", Sniper.SHORT_READY: "🔻 TRUE SNIPER SHORT READY"
+    },
+    Block: {
+        Block.NONE: "", Block.PREMIUM_TRAP: "⚠️ SNIPER BLOCKED — PREMIUM TRAP",
+        Block.MAGNET: "⚠️ SNIPER BLOCKED — MAGNET ZONE", Block.NO_FLOW: "⚠️ SNIPER BLOCKED — NO FLOW",
+        Block.WEAK: "⚠️ SNIPER BLOCKED — WEAK STRUCTURE"
+    },
+    Target: {
+        Target.NONE: "NO CLEAR TARGET", Target.PIVOT_MAGNET: "🧲 CPR PIVOT MAGNET",
+        Target.TC: "🎯 TARGET → TC (upper magnet)", Target.BC: "🎯 TARGET → BC (lower magnet)",
+        Target.PDH: "🎯 TARGET → PDH LIQUIDITY", Target.RESIST: "🎯 TARGET → RESIST {}",
+        Target.PDL: "🎯 TARGET → PDL LIQUIDITY", Target.SUPPORT: "🎯 TARGET → SUPPORT {}",
+        Target.MAX_PAIN: "🧲 MAX PAIN PIN ZONE"
+    },
+    Trend: {Trend.NONE: "NO TREND", Trend.SHORT: "🔻 TREND CONTINUATION SHORT", Trend.LONG: "🚀 TREND CONTINUATION LONG"},
+    Regime: {
+        Regime.NONE: "NONE", Regime.DEALER_SHORT: "🔥 DEALER TREND SHORT", Regime.DEALER_LONG: "🚀 DEALER TREND LONG",
+        Regime.CONT_SHORT: "🔻 TREND CONTINUATION", Regime.CONT_LONG: "🚀 TREND CONTINUATION"
+    },
+    Dark: {Dark.NONE: "NO DARK SIGNAL", Dark.SHORT_BUILD: "🌑 DARK POOL SHORT BUILD"},
+    Decision: {Decision.WAIT: "WAIT", Decision.CONFLICT: "⚠️ WAIT / CONFLICT", Decision.CE_BUY: "🔥 CE BUY", Decision.PE_BUY: "🔻 PE BUY"}
+}
+
+# where the writer renders each coded signal
+TYPED_CELLS = {
+    "relation": "H9", "gamma": "M17", "flow": "N17", "god_signal": "N9",
+    "sniper": "N5", "sniper_block": "N6", "target": "N23",
+    "trend": "N27", "trend_regime": "N29", "dark": "N31", "decision": "C10"
+}
+
+
+class Signals:
+
+    # codes plus the numbers that qualify them (accel flag, target level,
+    # premium velocity)
+    __slots__ = (
+        "relation", "gamma", "premium_velocity", "predictive_gamma", "god_signal",
+        "flow", "flow_accel", "floating", "floating_strength", "inst_floating", "inst_strength",
+        "sniper", "sniper_block", "target", "target_level",
+        "trend", "trend_regime", "dark", "decision"
+    )
 
-    if support:
-        ultra_write("B33", support)
+    def __init__(self):
 
-    if pain_map:
-        maxpain = min(pain_map, key=pain_map.get)
-        ultra_write("B32", maxpain)
-# ================= VIX RANGE =================
+        self.relation = Relation.NONE
+        self.gamma = Gamma.NEUTRAL
+        self.premium_velocity = 0.0
+        self.predictive_gamma = Predictive.NONE
+        self.god_signal = God.NONE
+        self.flow, self.flow_accel = Flow.NONE, False
+        self.floating, self.floating_strength = Side.NONE, Strength.INVALIDATED
+        self.inst_floating, self.inst_strength = Side.NONE, Strength.INVALIDATED
+        self.sniper, self.sniper_block = Sniper.WAIT, Block.NONE
+        self.target, self.target_level = Target.NONE, None
+        self.trend, self.trend_regime = Trend.NONE, Regime.NONE
+        self.dark = Dark.NONE
+        self.decision = Decision.WAIT
 
-def vix_range_engine(ltp, vix):
 
-    # Daily sigma formula
-    pct = vix / math.sqrt(365)
-    pts = (pct / 100) * ltp
+SIG = Signals()
 
-    vix_high = round(ltp + pts)
-    vix_low = round(ltp - pts)
 
-    ultra_write("D31", vix_high)   # VIX HIGH
-    ultra_write("D32", vix_low)    # VIX LOW
+def label(code):
+    return LABELS[type(code)][code]
 
 
-# ================= VWAP =================
+def render(name):
 
-# ================= VWAP ULTRA ENGINE v2 (LIVE SAFE) =================
+    code = getattr(SIG, name)
+    text = label(code)
 
-LAST_VWAP = None
+    if name == "flow" and SIG.flow_accel:
+        text += " + GAMMA ACCEL"
 
-def vwap(ltp, oc_data):
+    elif name == "target" and SIG.target_level is not None:
+        text = text.format(int(SIG.target_level))
 
-    global LAST_VWAP
+    # nothing blocked: the cell shows the sniper call itself
+    elif name == "sniper_block" and code == Block.NONE:
+        text = render("sniper")
 
-    try:
+    return text
 
-        # =====================================================
-        # 1️⃣ PRIMARY — TRUE INDEX VWAP (INTRADAY CANDLES)
-        # =====================================================
 
-        intraday = requests.post(
-            "https://api.dhan.co/v2/charts/intraday",
-            headers=headers(),
-            json={
-                "securityId":"13",
-                "exchangeSegment":"IDX_I",
-                "instrument":"INDEX",
-                "interval":"1"
-            }
-        ).json()
+def emit(name, code, key=None):
 
-        data = intraday.get("data", {})
+    # record, publish (key: every field the signal's meaning depends on)
+    # and render the label into its cell
+    setattr(SIG, name, code)
+    publish(name, code, key)
 
-        price = []
-        vol   = []
+    if name in TYPED_CELLS:
+        ultra_write(TYPED_CELLS[name], render(name))
 
-        # ----- handle multiple API structures -----
+# ================= GOD TIER STATE =================
 
-        if "candles" in data:
 
-            # format: [time, open, high, low, close, volume]
+def set_state(key,value):
+    STATE[key] = value
+    publish(key, value)
 
-            for c in data["candles"]:
-                try:
-                    price.append(float(c[4]))
-                    vol.append(float(c[5]))
-                except:
-                    continue
+def get_state(key,default=""):
+    return STATE.get(key,default)
+# ================= SAFE =================
 
-        elif "close" in data and "volume" in data:
+def safe(c):
+    v = SHEET_CACHE.get(c,"")
+    return "" if v is None else str(v).strip()
 
-            # alternate dhan format
+def ultra_write(cell,value):
+    WRITE_CACHE[cell] = value
 
-            for p,v in zip(data["close"], data["volume"]):
-                price.append(float(p))
-                vol.append(float(v))
+    if cell in CELL_SIGNALS:
+        publish(CELL_SIGNALS[cell], value)
 
-        # ----- calculate VWAP if valid -----
+def to_float(v):
 
-        if price and vol and sum(vol) > 0:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
 
-            v = sum(p*v for p,v in zip(price,vol)) / sum(vol)
+IST = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
 
-            LAST_VWAP = round(v,2)
+def ist_today():
+    return datetime.datetime.now(IST).date()
 
-            ultra_write("Q3", LAST_VWAP)
+# ================= DIFF WRITER =================
 
-            print("VWAP LIVE:", LAST_VWAP)
+# last values committed to the sheet; only cells that differ get sent,
+# dropped every SHADOW_RESYNC_SEC so manual edits are overwritten again
+SHEET_SHADOW = {}
 
-            return
+SHADOW_RESYNC_SEC = float(os.getenv("SHADOW_RESYNC_SEC", "300"))
+LAST_SHADOW_RESYNC = time.time()
 
-        
-        # =====================================================
-        # 2️⃣ FALLBACK — INSTITUTIONAL OPTIONCHAIN VWAP
-        # =====================================================
+# cells that change every tick (LTP, clock, tick stats): held back and
+# sent with the next batch that goes out anyway, or every HEARTBEAT_SEC
+HEARTBEAT_CELLS = ("C6", "M3", "M4")
+HEARTBEAT_SEC = float(os.getenv("HEARTBEAT_SEC", "8"))
+HEARTBEAT = {}
+LAST_HEARTBEAT = 0.0
 
-        total_weight   = 0
-        weighted_price = 0
+def cell_index(cell):
 
-        atm = round(ltp/50)*50
+    # "AB12" -> (12, 28)
+    col = 0
+    i = 0
 
-        for i in range(-200,250,50):
+    while cell[i].isalpha():
+        col = col*26 + (ord(cell[i].upper())-64)
+        i += 1
 
-            k = f"{atm+i:.6f}"
+    return int(cell[i:]), col
 
-            if k not in oc_data:
-                continue
 
-            ce = oc_data[k].get("ce")
-            pe = oc_data[k].get("pe")
+def col_letter(col):
 
-            if ce:
-                p = float(ce.get("last_price",0))
-                v = float(ce.get("volume",0))
-                if v > 0:
-                    weighted_price += p*v
-                    total_weight   += v
+    name = ""
 
-            if pe:
-                p = float(pe.get("last_price",0))
-                v = float(pe.get("volume",0))
-                if v > 0:
-                    weighted_price += p*v
-                    total_weight   += v
+    while col:
+        col, rem = divmod(col-1, 26)
+        name = chr(65+rem) + name
 
-        if total_weight > 0:
+    return name
 
-            LAST_VWAP = round(weighted_price/total_weight,2)
 
-            ultra_write("Q3", LAST_VWAP)
+def coalesce_ranges(cells):
 
-            print("VWAP OPTIONCHAIN FALLBACK:", LAST_VWAP)
+    # ---- 1. horizontal runs of adjacent cells per row ----
+    rows = {}
 
-            return
+    for cell,value in cells.items():
+        r,c = cell_index(cell)
+        rows.setdefault(r,{})[c] = value
 
+    runs = {}
 
-        # =====================================================
-        # 3️⃣ EMERGENCY FALLBACK — NEVER LEAVE VWAP EMPTY
-        # =====================================================
+    for r in sorted(rows):
 
-        if LAST_VWAP is None:
-            LAST_VWAP = ltp
+        cols = sorted(rows[r])
+        start = prev = cols[0]
 
-        ultra_write("Q3", LAST_VWAP)
+        for c in cols[1:] + [None]:
 
-        print("VWAP EMERGENCY (LTP):", LAST_VWAP)
+            if c is not None and c == prev+1:
+                prev = c
+                continue
 
+            runs.setdefault((start,prev),[]).append(
+                (r,[rows[r][x] for x in range(start,prev+1)])
+            )
 
-    except Exception as e:
+            if c is not None:
+                start = prev = c
 
-        print("VWAP ERROR:", e)
+    # ---- 2. stack equal-width runs on consecutive rows into rectangles ----
+    batch = []
 
-    
-    if LAST_VWAP is not None:
-        set_state("vwap", LAST_VWAP)
+    for (c0,c1),items in runs.items():
 
+        block = [items[0]]
 
+        for r,values in items[1:] + [(None,None)]:
 
-#=====================================================
+            if r is not None and r == block[-1][0]+1:
+                block.append((r,values))
+                continue
 
-def expiry():
+            top = f"{col_letter(c0)}{block[0][0]}"
+            bottom = f"{col_letter(c1)}{block[-1][0]}"
 
- current=safe("B4")
+            batch.append({
+                "range": top if top == bottom else f"{top}:{bottom}",
+                "values": [v for _,v in block]
+            })
 
- if current:
-  return current
+            block = [(r,values)]
 
- r=requests.post(
-  "https://api.dhan.co/v2/optionchain/expirylist",
-  headers=headers(),
-  json={"UnderlyingScrip":13,"UnderlyingSeg":"IDX_I"}
- ).json()
+    return batch
 
- exp=r.get("data",[])
 
- if not exp:
-  raise Exception("No expiry received")
+def ultra_write_range(range_name, values):
 
- first=exp[0]
+    # row / rectangle writes land in the same per-cell buffer,
+    # coalesce_ranges() glues them back together at flush time
+    r0,c0 = cell_index(range_name.split(":")[0])
 
- ultra_write("B4",first)
+    for i,row in enumerate(values):
+        for j,v in enumerate(row):
+            ultra_write(f"{col_letter(c0+j)}{r0+i}", v)
 
- print("AUTO EXPIRY SET:",first)
 
- return first
+def buffered_values(range_name):
 
-# ================= OPTIONCHAIN (FIXED PARSER) =================
+    # what the sheet will hold after this tick's flush
+    a,b = range_name.split(":")
 
-# ================= OPTIONCHAIN (ULTRA SAFE PARSER) =================
+    r0,c0 = cell_index(a)
+    r1,c1 = cell_index(b)
 
-def optionchain():
+    values = [
+        [
+            WRITE_CACHE.get(cell, SHEET_SHADOW.get(cell, ""))
+            for cell in (f"{col_letter(c)}{r}" for c in range(c0,c1+1))
+        ]
+        for r in range(r0,r1+1)
+    ]
 
-    try:
+    # nothing written since the last resync: fall back to the sheet
+    if not any(v != "" for row in values for v in row):
 
-        response = requests.post(
-            "https://api.dhan.co/v2/optionchain",
-            headers=headers(),
-            json={
-                "UnderlyingScrip":13,
-                "UnderlyingSeg":"IDX_I",
-                "Expiry":expiry()
-            }
-        )
+        sheet = ws.get(range_name)
 
-        r = response.json()
+        for i,row in enumerate(sheet[:len(values)]):
+            values[i][:len(row)] = row
 
-        # ---------- DEBUG ----------
-        print("OPTIONCHAIN RAW KEYS:", list(r.keys()))
+    return values
 
-        # ---------- ERROR HANDLING ----------
-        # Some Dhan errors return:
-        # { "status":"error", "errorCode":811 ... }
 
-        if r.get("status") == "error":
+def flush_writes():
 
-            error_code = str(r.get("errorCode",""))
+    global LAST_SHADOW_RESYNC, LAST_HEARTBEAT
 
-            if error_code == "811":
+    if time.time() - LAST_SHADOW_RESYNC > SHADOW_RESYNC_SEC:
+        SHEET_SHADOW.clear()
+        LAST_SHADOW_RESYNC = time.time()
 
-                print("⚠️ INVALID EXPIRY (811) — resetting expiry")
+    for cell in HEARTBEAT_CELLS:
+        if cell in WRITE_CACHE:
+            HEARTBEAT[cell] = WRITE_CACHE.pop(cell)
 
-                ultra_write("B4","")   # force expiry refresh
+    changed = {
+        k:v for k,v in WRITE_CACHE.items()
+        if k not in SHEET_SHADOW or SHEET_SHADOW[k] != v
+    }
 
-                return {}
+    if HEARTBEAT and (changed or time.time() - LAST_HEARTBEAT >= HEARTBEAT_SEC):
 
-            print("OPTIONCHAIN ERROR:", r)
-            return {}
+        changed.update({
+            k:v for k,v in HEARTBEAT.items()
+            if k not in SHEET_SHADOW or SHEET_SHADOW[k] != v
+        })
 
-        # ---------- NORMAL DATA ----------
-        data = r.get("data", {})
+        HEARTBEAT.clear()
+        LAST_HEARTBEAT = time.time()
 
-        if "oc" in data:
+    if changed:
 
-            print("OPTIONCHAIN OK — strikes loaded:", len(data["oc"]))
+        ws.batch_update(coalesce_ranges(changed))
 
-            return data["oc"]
+        SHEET_SHADOW.update(changed)
 
-        # ---------- FALLBACK FORMAT ----------
-        # Sometimes API returns strikes directly
+    WRITE_CACHE.clear()
 
-        if isinstance(data, dict):
+    return len(changed)
 
-            print("OPTIONCHAIN ALT FORMAT DETECTED")
+# ================= DHAN CLIENT =================
 
-            return data
+CLIENT_ID = ws.acell("B1").value
+ACCESS_TOKEN = ws.acell("B2").value
 
-        print("OPTIONCHAIN UNKNOWN STRUCTURE:", r)
 
-        return {}
+dhan = dhanhq(CLIENT_ID, ACCESS_TOKEN)
 
-    except Exception as e:
+# ================= HEADERS =================
 
-        print("OPTIONCHAIN ERROR:", e)
+def headers():
+    return {
+        "client-id": CLIENT_ID,
+        "access-token": ACCESS_TOKEN,
+        "Content-Type": "application/json"
+    }
 
-        return {}
+# ================= FETCH CONFIG =================
 
+# every HTTP call gets its own deadline, the whole fetch stage gets one more
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "12"))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", "5"))
+FETCH_DEADLINE = float(os.getenv("FETCH_DEADLINE", "7"))
 
-# ================= GAMMA ENGINE =================
+FETCH_POOL = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
 
-def gamma_engine(ltp,oc):
+# ================= HTTP CLIENT (KEEP-ALIVE POOL) =================
 
-    atm=round(ltp/50)*50
+DHAN_API = "https://api.dhan.co/v2"
 
-    ce_build=0
-    pe_build=0
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(FETCH_WORKERS)))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
 
-    for i in range(-150,200,50):
+def http_session():
 
-        k=f"{atm+i:.6f}"
+    # 429/5xx are retried with backoff, everything else is returned as-is
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(429,500,502,503,504),
+        allowed_methods=frozenset(["GET","POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
 
-        if k not in oc:
-            continue
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry
+    )
 
-        ce=oc[k].get("ce")
-        pe=oc[k].get("pe")
+    s = requests.Session()
+    s.mount("https://", adapter)
 
-        if ce and ce["oi"]>ce.get("previous_oi",0):
-            ce_build+=1
+    return s
 
-        if pe and pe["oi"]>pe.get("previous_oi",0):
-            pe_build+=1
+HTTP = http_session()
 
-    state="NEUTRAL"
+def dhan_post(path, payload):
 
-    velocity = get_state("premium_velocity",0)
+    return HTTP.post(
+        f"{DHAN_API}/{path}",
+        headers=headers(),
+        json=payload,
+        timeout=FETCH_TIMEOUT
+    ).json()
 
-    if ce_build>=3 and pe_build>=3:
 
-        if velocity > 0.5:
-            state="TRUE GAMMA UP 🚀"
-        else:
-            state="PREMIUM TRAP ⚠️"
+# ================= SCRIP MASTER INDEX =================
 
-    elif ce_build>pe_build:
-        state="TRUE GAMMA UP 🚀"
+# api-scrip-master.csv is downloaded at most once per day (ETag /
+# If-Modified-Since), parsed once into scrip_index.db and then answered
+# by primary-key lookups instead of a csv scan per resolve
 
-    elif pe_build>ce_build:
-        state="TRUE GAMMA DOWN 🔻"
+SCRIP_MASTER_URL = "https://images.dhan.co/api-data/api-scrip-master.csv"
+SCRIP_DB_PATH = os.getenv("SCRIP_DB_PATH", "scrip_index.db")
 
-    set_state("gamma", state)
-    ultra_write("M17",state)
+SCRIP_DB = sqlite3.connect(SCRIP_DB_PATH, check_same_thread=False)
+SCRIP_LOCK = threading.Lock()
 
+SCRIP_DB.executescript("""
+CREATE TABLE IF NOT EXISTS scrips (
+    symbol TEXT PRIMARY KEY,
+    security_id TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    instrument TEXT NOT NULL,
+    exchange TEXT NOT NULL,
+    underlying TEXT NOT NULL,
+    expiry TEXT NOT NULL,
+    lot_size REAL
+) WITHOUT ROWID;
 
+CREATE INDEX IF NOT EXISTS scrips_underlying ON scrips(underlying, instrument, expiry);
 
-def god_mode_engine(ltp, oc):
+CREATE TABLE IF NOT EXISTS scrip_meta (key TEXT PRIMARY KEY, value TEXT);
+""")
 
-    atm = round(ltp/50)*50
+SCRIP_MEMO = {}
+SCRIP_CHECKED = {"date": None}
 
-    ce_unwind = 0
-    pe_unwind = 0
-    ce_build = 0
-    pe_build = 0
+DEFAULT_MARKET = {"id": "13", "seg": "IDX_I", "instr": "INDEX", "name": "NIFTY 50", "exch": "NSE", "lot": 75, "step": 50}
 
-    for shift in [-100,-50,0,50,100]:
+# option strike grid per index; anything else is inferred from its chain
+STRIKE_STEPS = {
+    "NIFTY": 50, "NIFTY 50": 50,
+    "BANKNIFTY": 100, "NIFTY BANK": 100,
+    "FINNIFTY": 50, "NIFTY FIN SERVICE": 50,
+    "MIDCPNIFTY": 25, "NIFTY MID SELECT": 25,
+    "SENSEX": 100
+}
 
-        k=f"{atm+shift:.6f}"
+def scrip_meta(key, value=None):
 
-        if k not in oc:
-            continue
+    if value is None:
+        row = SCRIP_DB.execute("SELECT value FROM scrip_meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
 
-        ce=oc[k].get("ce")
-        pe=oc[k].get("pe")
+    SCRIP_DB.execute("INSERT OR REPLACE INTO scrip_meta VALUES (?,?)", (key, value))
 
-        if ce:
-            if ce.get("oi",0) < ce.get("previous_oi",0):
-                ce_unwind += 1
-            else:
-                ce_build += 1
 
-        if pe:
-            if pe.get("oi",0) < pe.get("previous_oi",0):
-                pe_unwind += 1
-            else:
-                pe_build += 1
+def scrip_segment(instr, exch):
 
-    signal = "NO GOD SIGNAL"
+    if instr == "INDEX":
+        return "IDX_I"
 
-    # Liquidity vacuum up
-    if ce_unwind >=3 and pe_build <=1:
-        signal = "🔥 GOD MODE LONG"
+    if any(x in instr for x in ["OPT","FUT"]):
+        return f"{exch}_FNO"
 
-    # Liquidity vacuum down
-    elif pe_unwind >=3 and ce_build <=1:
-        signal = "🔻 GOD MODE SHORT"
+    return f"{exch}_EQ"
 
-    set_state("god_signal", signal)
-    ultra_write("N9", signal)
-# ================= DEALER INTENT RADAR =================
 
-def dealer_intent_radar(ltp, oc):
+def load_scrip_master(path):
 
-    atm = round(ltp/50)*50
+    def rows():
 
-    ce_build = 0
-    ce_unwind = 0
-    pe_build = 0
-    pe_unwind = 0
+        with open(path, newline="", encoding="utf-8") as f:
 
-    for shift in [-100,-50,0,50,100]:
+            for s in csv.DictReader(f):
 
-        k = f"{atm+shift:.6f}"
+                ins = s["SEM_INSTRUMENT_NAME"]
+                exch = s["SEM_EXM_EXCH_ID"]
+                trading = s["SEM_TRADING_SYMBOL"].upper()
 
-        if k not in oc:
-            continue
+                entry = (
+                    str(int(float(s["SEM_SMST_SECURITY_ID"]))),
+                    scrip_segment(ins, exch),
+                    ins,
+                    exch,
+                    trading.split("-")[0],
+                    s.get("SEM_EXPIRY_DATE","")[:10],
+                    to_float(s.get("SEM_LOT_UNITS"))
+                )
 
-        ce = oc[k].get("ce")
-        pe = oc[k].get("pe")
+                # first row wins for both names, same as the old linear scan
+                yield (trading,) + entry
 
-        if ce:
-            if ce.get("oi",0) > ce.get("previous_oi",0):
-                ce_build += 1
-            else:
-                ce_unwind += 1
+                custom = s.get("SEM_CUSTOM_SYMBOL","").upper()
 
-        if pe:
-            if pe.get("oi",0) > pe.get("previous_oi",0):
-                pe_build += 1
-            else:
-                pe_unwind += 1
+                if custom and custom != trading:
+                    yield (custom,) + entry
 
-    intent = "NEUTRAL"
+    SCRIP_DB.execute("DELETE FROM scrips")
+    SCRIP_DB.executemany("INSERT OR IGNORE INTO scrips VALUES (?,?,?,?,?,?,?,?)", rows())
 
-    # hidden bullish prep
-    if pe_build >=3 and ce_unwind >=2:
-        intent = "🚀 DEALER PREPARE LONG"
 
-    # hidden bearish prep
-    elif ce_build >=3 and pe_unwind >=2:
-        intent = "🔻 DEALER PREPARE SHORT"
+def refresh_scrip_index():
 
-    ultra_write("N25", intent)
-# ================= TRUE SNIPER V2 — PREDICTIVE GAMMA =================
+    today = ist_today().isoformat()
 
-LAST_PREMIUM = None
-LAST_PREMIUM_TIME = None
+    if SCRIP_CHECKED["date"] == today:
+        return
 
-def predictive_gamma_engine(ltp, oc):
+    with SCRIP_LOCK:
 
-    global LAST_PREMIUM, LAST_PREMIUM_TIME
+        if SCRIP_CHECKED["date"] == today or scrip_meta("checked_on") == today:
+            SCRIP_CHECKED["date"] = today
+            return
 
-    atm = round(ltp/50)*50
+        h = {}
 
-    ce_pressure = 0
-    pe_pressure = 0
-    premium_sum = 0
-    count = 0
+        if scrip_meta("etag"):
+            h["If-None-Match"] = scrip_meta("etag")
 
-    for shift in [-100,-50,0,50,100]:
+        if scrip_meta("last_modified"):
+            h["If-Modified-Since"] = scrip_meta("last_modified")
 
-        k = f"{atm+shift:.6f}"
+        try:
 
-        if k not in oc:
-            continue
+            r = HTTP.get(SCRIP_MASTER_URL, headers=h, stream=True, timeout=60)
 
-        ce = oc[k].get("ce")
-        pe = oc[k].get("pe")
+            if r.status_code == 304:
+                print("SCRIP MASTER UNCHANGED")
 
-        if ce:
-            ce_pressure += ce.get("oi",0) - ce.get("previous_oi",0)
-            premium_sum += ce.get("last_price",0)
-            count += 1
+            else:
 
-        if pe:
-            pe_pressure += pe.get("oi",0) - pe.get("previous_oi",0)
-            premium_sum += pe.get("last_price",0)
-            count += 1
+                r.raise_for_status()
 
-    signal = "NONE"
+                tmp = SCRIP_DB_PATH + ".csv"
 
-    # ---------- EARLY OI IMBALANCE ----------
-    if ce_pressure > abs(pe_pressure)*1.5:
-        signal = "EARLY UP PRESSURE"
+                with open(tmp, "wb") as f:
+                    for chunk in r.iter_content(1 << 20):
+                        f.write(chunk)
 
-    elif pe_pressure > abs(ce_pressure)*1.5:
-        signal = "EARLY DOWN PRESSURE"
+                with SCRIP_DB:
+                    load_scrip_master(tmp)
+                    scrip_meta("etag", r.headers.get("ETag",""))
+                    scrip_meta("last_modified", r.headers.get("Last-Modified",""))
 
-    # ---------- PREMIUM VELOCITY ----------
-    if count > 0:
+                os.remove(tmp)
 
-        avg_premium = premium_sum / count
-        now = time.time()
+                SCRIP_MEMO.clear()
 
-        velocity = 0
+                print("SCRIP MASTER INDEXED")
 
-        if LAST_PREMIUM and LAST_PREMIUM_TIME:
+            with SCRIP_DB:
+                scrip_meta("checked_on", today)
 
-            dt = now - LAST_PREMIUM_TIME
+            SCRIP_CHECKED["date"] = today
 
-            if dt > 0:
-                velocity = abs(avg_premium - LAST_PREMIUM) / dt
+        except Exception as e:
 
-        LAST_PREMIUM = avg_premium
-        LAST_PREMIUM_TIME = now
+            # keep serving yesterday's index, try again on the next resolve
+            print("SCRIP MASTER ERROR:", e)
 
-        set_state("premium_velocity", velocity)
 
-        if velocity > 0.8 and "PRESSURE" in signal:
-            signal = "PREDICTIVE GAMMA IGNITION"
+def lookup_scrip(symbol):
 
-    set_state("predictive_gamma", signal)
-#===============================DEALER =====================
+    symbol = symbol.strip().upper()
 
-def dealer_trap_engine(ltp, oc):
+    if symbol not in SCRIP_MEMO:
 
-    relation = get_state("relation")
-    gamma_state = get_state("gamma")
-    vwap_val = get_state("vwap")
+        with SCRIP_LOCK:
+            row = SCRIP_DB.execute(
+                "SELECT security_id,segment,instrument,exchange,lot_size FROM scrips WHERE symbol=?",
+                (symbol,)
+            ).fetchone()
 
+        SCRIP_MEMO[symbol] = None if row is None else {
+            "id": row[0], "seg": row[1], "instr": row[2], "name": symbol,
+            "exch": row[3], "lot": row[4]
+        }
 
-    resistance = safe("B31")
-    support = safe("B33")
+    return SCRIP_MEMO[symbol]
 
-    trap = "NO TRAP"
 
-    try:
-        vwap_val = float(vwap_val)
-        resistance = float(resistance) if resistance else None
-        support = float(support) if support else None
-    except:
-        ultra_write("N19", trap)
-        return
+# ================= UNIVERSAL RESOLVER (INDEX/FNO/CASH) =================
 
+def resolve_market(symbol):
 
+    # blank D1 keeps the classic NIFTY 50 setup without touching the scrip master
+    if not symbol or not symbol.strip():
+        return dict(DEFAULT_MARKET)
 
+    refresh_scrip_index()
 
-    atm = round(ltp/50)*50
+    cfg = lookup_scrip(symbol)
 
-    ce_build = 0
-    pe_build = 0
+    if cfg is None:
+        print("RESOLVER: UNKNOWN SYMBOL", symbol, "— using", DEFAULT_MARKET["name"])
+        return dict(DEFAULT_MARKET)
 
-    # ----- dealer behaviour -----
-    for shift in [-100,-50,0,50,100]:
+    cfg = dict(cfg, step=STRIKE_STEPS.get(cfg["name"]))
 
-        strike = atm + shift
-        key = f"{strike:.6f}"
+    print("🔎 Resolved:", symbol, cfg)
 
-        if key not in oc:
-            continue
+    return cfg
 
-        ce = oc[key].get("ce")
-        pe = oc[key].get("pe")
 
-        if ce and ce.get("oi",0) > ce.get("previous_oi",0):
-            ce_build += 1
+def atm_strike(ltp):
 
-        if pe and pe.get("oi",0) > pe.get("previous_oi",0):
-            pe_build += 1
+    step = UNDERLYING["step"]
 
-    # ----- distance from walls -----
-    near_resistance = abs(ltp - resistance) <= 30
-    near_support = abs(ltp - support) <= 30
+    return round(ltp/step)*step
 
-    # ---------- PRO TRAP LOGIC ----------
 
-    # Bull trap
-    if (relation=="ABOVE CPR" and
-        ltp>vwap_val and
-        near_resistance and
-        ce_build>pe_build and
-        "UP" in gamma_state):
+def option_segment(cfg):
 
-        trap="🔥 DEALER BULL TRAP PRO"
+    # option legs of this underlying: (exchangeSegment, instrument)
+    return f"{cfg['exch']}_FNO", ("OPTIDX" if cfg["instr"] == "INDEX" else "OPTSTK")
 
-    # Bear trap
-    elif (relation=="BELOW CPR" and
-          ltp<vwap_val and
-          near_support and
-          pe_build>ce_build and
-          "DOWN" in gamma_state):
 
-        trap="🔥 DEALER BEAR TRAP PRO"
+UNDERLYING = resolve_market(ws.acell("D1").value)
 
-    ultra_write("N19", trap)
 
-# ================= INSIDE CPR PRO MODE =================
+# ================= LIVE FEED (WEBSOCKET) =================
 
-def inside_cpr_pro_engine(ltp, oc):
+# Dhan v2 market feed: one socket pushes ticks for the index and the
+# subscribed option legs into LIVE_TICKS, so velocity engines read
+# sub-second prices instead of the 8s quote poll.
+#   FEED_MODE=ws      live Dhan websocket (needs websocket-client)
+#   FEED_MODE=replay  replays FEED_REPLAY_FILE (jsonl: seg, sid, ltp, t)
+#   FEED_MODE=poll    no feed, engines use loop-to-loop deltas
 
-    relation = get_state("relation")
+FEED_MODE = os.getenv("FEED_MODE", "ws").lower()
+FEED_URL = "wss://api-feed.dhan.co"
+FEED_REPLAY_FILE = os.getenv("FEED_REPLAY_FILE", "ticks.jsonl")
+FEED_REPLAY_SPEED = float(os.getenv("FEED_REPLAY_SPEED", "1"))
 
-    if relation != "INSIDE CPR":
-        ultra_write("N21","OUTSIDE CPR")
-        return
+FEED_STALE_SEC = float(os.getenv("FEED_STALE_SEC", "3"))
+FEED_HISTORY_SEC = float(os.getenv("FEED_HISTORY_SEC", "120"))
+FEED_VELOCITY_SEC = float(os.getenv("FEED_VELOCITY_SEC", "5"))
+FEED_MOVE_SEC = float(os.getenv("FEED_MOVE_SEC", "8"))
 
-    try:
-        tc=float(safe("H4"))
-        pivot=float(safe("H5"))
-        bc=float(safe("H6"))
-    except:
-        return
+FEED_SEGMENTS = {
+    "IDX_I": 0, "NSE_EQ": 1, "NSE_FNO": 2, "NSE_CURRENCY": 3,
+    "BSE_EQ": 4, "MCX_COMM": 5, "BSE_CURRENCY": 7, "BSE_FNO": 8
+}
+FEED_SEGMENT_NAMES = {v: k for k, v in FEED_SEGMENTS.items()}
 
-    atm=round(ltp/50)*50
+FEED_DISCONNECT = 50
 
-    ce_build=0
-    pe_build=0
-    ce_unwind=0
-    pe_unwind=0
+FEED_HEADER = struct.Struct("<BhBi")
 
-    for shift in [-100,-50,0,50,100]:
+# response code -> layout from byte 8, all carrying LTP first:
+#   ticker      LTP float32, LTT int32
+#   quote/full  LTP float32, LTQ int16, LTT int32
+FEED_PRICE = {
+    2: struct.Struct("<fi"),
+    4: struct.Struct("<fhi"),
+    8: struct.Struct("<fhi"),
+}
 
-        key=f"{atm+shift:.6f}"
+# (segment, security_id) -> {"ltp", "ltt", "ts", "hist": deque[(ts, ltp)]}
+LIVE_TICKS = {}
+LIVE_LOCK = threading.Lock()
 
-        if key not in oc:
-            continue
+FEED = {"socket": None, "connected": False, "subs": set(), "last": 0.0}
 
-        ce=oc[key].get("ce")
-        pe=oc[key].get("pe")
 
-        if ce:
-            if ce.get("oi",0)>ce.get("previous_oi",0):
-                ce_build+=1
-            else:
-                ce_unwind+=1
+def record_tick(seg, sid, ltp, ts=None, ltt=None):
 
-        if pe:
-            if pe.get("oi",0)>pe.get("previous_oi",0):
-                pe_build+=1
-            else:
-                pe_unwind+=1
+    ts = ts or time.time()
+    key = (seg, str(sid))
 
-    signal="INSIDE CPR — WAIT"
+    with LIVE_LOCK:
 
-    # BC Defense
-    if abs(ltp-bc)<=20 and pe_build>ce_build:
-        signal="🔥 BC DEFENSE → CE BIAS"
+        tick = LIVE_TICKS.get(key)
 
-    # TC Rejection
-    elif abs(ltp-tc)<=20 and ce_build>pe_build:
-        signal="🔥 TC REJECTION → PE BIAS"
+        if tick is None:
+            tick = LIVE_TICKS[key] = {"ltp": None, "ltt": None, "ts": 0.0, "hist": deque()}
 
-    # Pivot Gamma Flip
-    elif abs(ltp-pivot)<=20:
-        if ce_unwind>pe_unwind:
-            signal="🚀 PIVOT GAMMA FLIP UP"
-        elif pe_unwind>ce_unwind:
-            signal="🔻 PIVOT GAMMA FLIP DOWN"
+        tick["ltp"] = float(ltp)
+        tick["ltt"] = ltt
+        tick["ts"] = ts
 
-    # Compression
-    elif ce_build>=3 and pe_build>=3:
-        signal="⚡ CPR COMPRESSION — GAMMA BUILD"
+        hist = tick["hist"]
+        hist.append((ts, float(ltp)))
 
-    ultra_write("N21",signal)
-# ================= CPR MAGNET + LIQUIDITY ENGINE =================
+        while hist and ts - hist[0][0] > FEED_HISTORY_SEC:
+            hist.popleft()
 
-def liquidity_target_engine(ltp):
+    FEED["last"] = ts
 
-    relation = get_state("relation")
 
-    try:
-        tc=float(safe("H4"))
-        pivot=float(safe("H5"))
-        bc=float(safe("H6"))
+def live_ltp(seg=None, sid=None, max_age=FEED_STALE_SEC):
 
-        resistance=float(safe("B31"))
-        support=float(safe("B33"))
-        maxpain=float(safe("B32"))
+    # last pushed price, or None when the feed is off or stale
+    seg = seg or UNDERLYING["seg"]
+    sid = str(sid or UNDERLYING["id"])
 
-    except:
-        return
+    tick = LIVE_TICKS.get((seg, sid))
 
-    # --- Fetch PDH / PDL (ULTRA SAFE) ---
+    if not tick or time.time() - tick["ts"] > max_age:
+        return None
 
-    pdh = None
-    pdl = None
+    return tick["ltp"]
 
-    try:
 
-        hist = requests.post(
-            "https://api.dhan.co/v2/charts/historical",
-            headers=headers(),
-            json={
-                "securityId":"13",
-                "exchangeSegment":"IDX_I",
-                "instrument":"INDEX",
-                "fromDate":(datetime.date.today()-datetime.timedelta(days=5)).strftime("%Y-%m-%d"),
-                "toDate":datetime.date.today().strftime("%Y-%m-%d")
-            }
-        ).json()
-
-        highs = []
-        lows = []
-
-        if "high" in hist:
-            highs = hist.get("high",[])
-            lows  = hist.get("low",[])
-
-        elif "data" in hist:
-            data = hist.get("data",{})
-            highs = data.get("high",[])
-            lows  = data.get("low",[])
-
-        if len(highs) >= 2 and len(lows) >= 2:
-            pdh = highs[-2]
-            pdl = lows[-2]
+def price_window(window, seg=None, sid=None):
 
-    except Exception as e:
+    # (net move, seconds covered) over the last `window` seconds of ticks
+    if live_ltp(seg, sid) is None:
+        return None
 
-        print("LIQUIDITY HIST ERROR:", e)
+    seg = seg or UNDERLYING["seg"]
+    sid = str(sid or UNDERLYING["id"])
 
-    target="NO CLEAR TARGET"
+    with LIVE_LOCK:
+        hist = list(LIVE_TICKS[(seg, sid)]["hist"])
 
-    # ---- INSIDE CPR MAGNET ----
-    if relation=="INSIDE CPR":
+    now, last = hist[-1]
 
-        if abs(ltp-pivot)<=20:
-            target="🧲 CPR PIVOT MAGNET"
+    start = hist[0]
+    for point in reversed(hist):
+        if now - point[0] >= window:
+            start = point
+            break
 
-        elif ltp<pivot:
-            target="🎯 TARGET → TC (upper magnet)"
+    return abs(last - start[1]), now - start[0]
 
-        elif ltp>pivot:
-            target="🎯 TARGET → BC (lower magnet)"
 
-    # ---- ABOVE CPR ----
-    elif relation=="ABOVE CPR":
+def price_move(window=FEED_MOVE_SEC, seg=None, sid=None):
 
-        if pdh and abs(ltp-pdh)<=50:
-            target="🎯 TARGET → PDH LIQUIDITY"
+    span = price_window(window, seg, sid)
 
-        elif resistance:
-            target=f"🎯 TARGET → RESIST {int(resistance)}"
+    return span[0] if span else None
 
-    # ---- BELOW CPR ----
-    elif relation=="BELOW CPR":
 
-        if pdl and abs(ltp-pdl)<=50:
-            target="🎯 TARGET → PDL LIQUIDITY"
+def price_velocity(window=FEED_VELOCITY_SEC, seg=None, sid=None):
 
-        elif support:
-            target=f"🎯 TARGET → SUPPORT {int(support)}"
+    # points per second over a fixed window, independent of loop timing
+    span = price_window(window, seg, sid)
 
-    # ---- MAX PAIN PIN ----
-    if maxpain and abs(ltp-maxpain)<=30:
-        target="🧲 MAX PAIN PIN ZONE"
+    if not span or span[1] <= 0:
+        return None
 
-    ultra_write("N23",target)
-# ================= INSTITUTIONAL CONFIRMATION =================
+    return span[0] / span[1]
 
-LAST_LTP = None
-LAST_TIME = None
 
-def institutional_confirmation(ltp, oc):
+def parse_feed_packets(buf):
 
-    global LAST_LTP, LAST_TIME
+    # a frame may carry several packets back to back
+    pos = 0
 
-    relation = get_state("relation")
-    gamma_state = get_state("gamma")
-    vwap_val = get_state("vwap")
+    while pos + FEED_HEADER.size <= len(buf):
 
+        code, length, seg, sid = FEED_HEADER.unpack_from(buf, pos)
 
-    status = "NO FLOW"
-    set_state("flow", status)
+        if length <= 0:
+            break
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N17", status)
-        return
+        if code == FEED_DISCONNECT:
+            print("FEED DISCONNECT CODE:", struct.unpack_from("<h", buf, pos+8)[0] if len(buf) >= pos+10 else "")
 
-    # ---------- SPEED / VELOCITY ----------
-    now = time.time()
-    velocity = 0
+        elif code in FEED_PRICE and pos + 8 + FEED_PRICE[code].size <= len(buf):
 
-    if LAST_LTP is not None and LAST_TIME is not None:
+            fields = FEED_PRICE[code].unpack_from(buf, pos+8)
+            ltp, ltt = fields[0], fields[-1]
 
-        dt = now - LAST_TIME
+            yield FEED_SEGMENT_NAMES.get(seg, str(seg)), str(sid), ltp, ltt
 
-        if dt > 0:
-            velocity = abs(ltp - LAST_LTP) / dt
+        pos += length
 
-    LAST_LTP = ltp
-    LAST_TIME = now
 
-    # ---------- ULTRA FLOW DETECTION (NO GAMMA REQUIRED) ----------
+def feed_subscribe(seg, ids):
 
-    if relation == "ABOVE CPR" and ltp > vwap_val:
+    ids = {str(i) for i in ids if i}
+    new = {(seg, i) for i in ids} - FEED["subs"]
 
-        if velocity > 0.6:
-            status = "ULTRA FLOW 🚀"
-        elif velocity > 0.25:
-            status = "PROBABLE FLOW"
+    if not new:
+        return
 
-    elif relation == "BELOW CPR" and ltp < vwap_val:
+    FEED["subs"] |= new
 
-        if velocity > 0.6:
-            status = "ULTRA FLOW 🔻"
-        elif velocity > 0.25:
-            status = "PROBABLE FLOW"
+    if FEED["connected"]:
+        feed_send(sorted(new))
 
-    # ---------- GAMMA ACCELERATION LABEL ----------
-    if "UP" in gamma_state and "FLOW" in status:
-        status += " + GAMMA ACCEL"
 
-    elif "DOWN" in gamma_state and "FLOW" in status:
-        status += " + GAMMA ACCEL"
+def feed_send(subs):
 
-    ultra_write("N17", status)
-# ================= OPENING SNIPER =================
+    # Dhan caps a subscribe message at 100 instruments
+    for i in range(0, len(subs), 100):
 
-OPENING_DONE = False
+        batch = subs[i:i+100]
 
-def opening_sniper(ltp):
+        try:
+            FEED["socket"].send(json.dumps({
+                "RequestCode": 15,
+                "InstrumentCount": len(batch),
+                "InstrumentList": [
+                    {"ExchangeSegment": seg, "SecurityId": sid}
+                    for seg, sid in batch
+                ]
+            }))
+        except Exception as e:
+            print("FEED SUBSCRIBE ERROR:", e)
 
-    global OPENING_DONE
 
-    if OPENING_DONE:
-        return
+def feed_on_open(sock):
 
-    relation = get_state("relation")
-    vwap_val = get_state("vwap")
+    FEED["connected"] = True
+    feed_send(sorted(FEED["subs"]))
+    print("FEED CONNECTED")
 
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
+def feed_on_message(sock, message):
+
+    if isinstance(message, str):
         return
 
-    sniper = "WAIT"
+    for seg, sid, ltp, ltt in parse_feed_packets(message):
+        record_tick(seg, sid, ltp, ltt=ltt)
 
-    # ---- Opening bias logic ----
-    if relation == "ABOVE CPR" and ltp > vwap_val:
-        sniper = "OPENING LONG SNIPER 🚀"
 
-    elif relation == "BELOW CPR" and ltp < vwap_val:
-        sniper = "OPENING SHORT SNIPER 🔻"
+def feed_on_close(sock, *args):
 
-    ultra_write("N3", sniper)
+    FEED["connected"] = False
+    print("FEED CLOSED")
 
-    OPENING_DONE = True
 
+def feed_worker():
 
-# ==========================================================
-# ================= TRUE SNIPER MODE =================
-# ================= TRUE SNIPER MODE =================
+    url = f"{FEED_URL}?version=2&token={ACCESS_TOKEN}&clientId={CLIENT_ID}&authType=2"
+    delay = 1
 
-def true_sniper_mode():
+    while True:
 
-    predictive = get_state("predictive_gamma")
-    relation = get_state("relation")
-    vwap_val = get_state("vwap")
-    gamma = get_state("gamma")
-    inst_flow = get_state("flow")
-    god = get_state("god_signal")
-    floating = safe("A17")
+        try:
 
-    sniper = "WAIT"
+            FEED["socket"] = websocket.WebSocketApp(
+                url,
+                on_open=feed_on_open,
+                on_message=feed_on_message,
+                on_error=lambda sock, e: print("FEED ERROR:", e),
+                on_close=feed_on_close
+            )
 
-    try:
-        vwap_val = float(vwap_val)
-        ltp = float(safe("C6"))
-    except:
-        ultra_write("N5", sniper)
-        return
+            started = time.time()
+            FEED["socket"].run_forever(ping_interval=20, ping_timeout=10)
 
-    # ================= PRIORITY ORDER =================
+            if time.time() - started > 60:
+                delay = 1
 
-    # ---- GOD MODE ----
-    if "GOD MODE LONG" in god:
-        sniper = "⚡ GOD EARLY LONG"
+        except Exception as e:
+            print("FEED WORKER ERROR:", e)
 
-    elif "GOD MODE SHORT" in god:
-        sniper = "⚡ GOD EARLY SHORT"
+        FEED["connected"] = False
 
-    # ---- NEWS MODE ----
-    elif NEWS_MODE and relation=="ABOVE CPR" and ltp > vwap_val:
-        sniper = "🚨 NEWS SNIPER LONG"
+        time.sleep(delay)
+        delay = min(delay*2, 60)
 
-    elif NEWS_MODE and relation=="BELOW CPR" and ltp < vwap_val:
-        sniper = "🚨 NEWS SNIPER SHORT"
 
-    # ---- PREDICTIVE GAMMA ----
-    elif predictive == "PREDICTIVE GAMMA IGNITION":
+def replay_worker():
 
-        if relation=="ABOVE CPR" and ltp > vwap_val:
-            sniper = "⚡ V2 PREDICTIVE LONG"
+    # local stand-in for the socket: same record_tick path, paced by "t"
+    try:
 
-        elif relation=="BELOW CPR" and ltp < vwap_val:
-            sniper = "⚡ V2 PREDICTIVE SHORT"
+        with open(FEED_REPLAY_FILE) as f:
 
-    # ---- EARLY SNIPER ----
-    elif (relation=="ABOVE CPR"
-          and ltp > vwap_val
-          and ("STRONG" in floating or "SUPER STRONG" in floating)
-          and ("FLOW" in inst_flow)
-          and "PREMIUM TRAP" not in gamma):
+            FEED["connected"] = True
 
-        sniper = "⚡ EARLY SNIPER LONG"
+            first = None
+            started = time.time()
 
-    elif (relation=="BELOW CPR"
-          and ltp < vwap_val
-          and ("STRONG" in floating or "SUPER STRONG" in floating)
-          and ("FLOW" in inst_flow)
-          and "PREMIUM TRAP" not in gamma):
+            for line in f:
 
-        sniper = "⚡ EARLY SNIPER SHORT"
+                if not line.strip():
+                    continue
 
-    # ---- TRUE SNIPER FULL ----
-    elif (relation=="ABOVE CPR"
-          and ltp > vwap_val
-          and ("STRONG" in floating or "SUPER STRONG" in floating)
-          and ("FLOW" in inst_flow)
-          and "UP" in gamma):
+                t = json.loads(line)
 
-        sniper = "🔥 TRUE SNIPER LONG READY"
+                if first is None:
+                    first = t["t"]
 
-    elif (relation=="BELOW CPR"
-          and ltp < vwap_val
-          and ("STRONG" in floating or "SUPER STRONG" in floating)
-          and ("FLOW" in inst_flow)
-          and "DOWN" in gamma):
+                due = started + (t["t"] - first)/FEED_REPLAY_SPEED
+                wait = due - time.time()
 
-        sniper = "🔻 TRUE SNIPER SHORT READY"
+                if wait > 0:
+                    time.sleep(wait)
 
-    ultra_write("N5", sniper)
+                record_tick(t["seg"], t["sid"], t["ltp"], ltt=t.get("ltt"))
 
+    except Exception as e:
+        print("FEED REPLAY ERROR:", e)
 
+    FEED["connected"] = False
+    print("FEED REPLAY FINISHED")
 
-# ================= SNIPER ANTI-TRAP FILTER =================
 
-def sniper_antitrap_filter():
+def start_feed():
 
-    sniper = safe("N5")
-    gamma = safe("M17")
-    inst_flow = safe("N17")
-    target = safe("N23")
-    floating = safe("A17")
+    # instruments are subscribed per underlying context once they exist
+    if FEED_MODE == "replay":
+        target = replay_worker
 
-    filtered = sniper
+    elif FEED_MODE == "ws" and websocket is not None:
+        target = feed_worker
 
-    if "PREMIUM TRAP" in gamma:
-        filtered = "⚠️ SNIPER BLOCKED — PREMIUM TRAP"
+    else:
+        if FEED_MODE == "ws":
+            print("FEED: websocket-client not installed, polling quotes")
+        return
 
-    elif "MAX PAIN" in target:
-        filtered = "⚠️ SNIPER BLOCKED — MAGNET ZONE"
+    threading.Thread(target=target, daemon=True).start()
 
-    elif "NO FLOW" in inst_flow:
-        filtered = "⚠️ SNIPER BLOCKED — NO FLOW"
 
-    elif "WEAKENING" in floating:
-        filtered = "⚠️ SNIPER BLOCKED — WEAK STRUCTURE"
+start_feed()
 
-    ultra_write("N6", filtered)
+# ================= QUOTE BATCHER =================
 
+# every instrument a tick needs (index of each underlying, ATM±N legs,
+# INST strikes, manual strike) is priced by one or a few bulk
+# /marketfeed/ltp calls; pushed feed ticks skip the poll entirely.
 
-# ================= AUTO SNIPER EXECUTION =================
+QUOTE_STRIKES = int(os.getenv("QUOTE_STRIKES", "2"))       # ATM±N legs quoted every tick
+QUOTE_STALE_SEC = float(os.getenv("QUOTE_STALE_SEC", "10"))
+QUOTE_BATCH = 1000                                          # instruments per request
 
-def auto_sniper_execution():
+# (segment, security_id) -> {"ltp", "ts"}, shared by every underlying
+QUOTES = {}
 
-    sniper_ready = safe("N5")
-    sniper_block = safe("N6")
-    gamma = safe("M17")
-    flow = safe("N17")
-    relation = safe("H9")
-    vwap_val = safe("Q3")
-    ltp = safe("C6")
 
-    trend = safe("N27")
-    trend_regime = safe("N29")
-    dark = safe("N31")
+def quote(seg, sid):
 
-    execution = "WAIT"
+    # pushed tick, else the last polled quote while it is fresh
+    ltp = live_ltp(seg, sid)
 
-    # ---------- SAFE CONVERSION ----------
-    try:
-        vwap_val = float(vwap_val)
-        ltp = float(ltp)
-    except:
-        ultra_write("N7", execution)
-        return
+    if ltp is not None:
+        return ltp
 
-    # ---------- BLOCK FILTER ----------
-    if "BLOCKED" in sniper_block:
-        ultra_write("N7", execution)
-        return
+    q = QUOTES.get((seg, str(sid)))
 
-    # =====================================================
-    # TRUE SNIPER EXECUTION (FULL CONFIRMATION)
-    # =====================================================
+    if q and time.time() - q["ts"] <= QUOTE_STALE_SEC:
+        return q["ltp"]
 
-    if ("LONG READY" in sniper_ready
-        and "UP" in gamma
-        and "FLOW" in flow
-        and relation == "ABOVE CPR"
-        and ltp > vwap_val):
+    return None
 
-        execution = "🔥 AUTO EXECUTE CE"
 
-    elif ("SHORT READY" in sniper_ready
-          and "DOWN" in gamma
-          and "FLOW" in flow
-          and relation == "BELOW CPR"
-          and ltp < vwap_val):
+def fetch_quotes(instruments):
 
-        execution = "🔻 AUTO EXECUTE PE"
+    # instruments: iterable of (segment, security_id)
+    pending = sorted({
+        (seg, str(sid)) for seg,sid in instruments
+        if sid and live_ltp(seg, sid) is None
+    })
 
-    # =====================================================
-    # TREND CONTINUATION ENGINE
-    # =====================================================
+    for i in range(0, len(pending), QUOTE_BATCH):
 
-    elif ("TREND CONTINUATION SHORT" in trend
-          and relation == "BELOW CPR"
-          and ltp < vwap_val):
+        wanted = {}
 
-        execution = "🔻 TREND AUTO PE"
+        for seg,sid in pending[i:i+QUOTE_BATCH]:
+            wanted.setdefault(seg, []).append(sid)
 
-    elif ("TREND CONTINUATION LONG" in trend
-          and relation == "ABOVE CPR"
-          and ltp > vwap_val):
+        try:
 
-        execution = "🔥 TREND AUTO CE"
+            r = dhan_post("marketfeed/ltp", {seg:[int(sid) for sid in ids] for seg,ids in wanted.items()})
 
-    # =====================================================
-    # DEALER TREND INTELLIGENCE
-    # =====================================================
+            # ----- SAFE PARSE -----
+            if "data" not in r:
+                print("QUOTE ERROR:", r)
+                continue
 
-    elif ("DEALER TREND SHORT" in trend_regime
-          and relation == "BELOW CPR"
-          and ltp < vwap_val):
+            data = r.get("data", {})
+            now = time.time()
 
-        execution = "🔻 DEALER TREND PE"
+            for seg,ids in wanted.items():
 
-    elif ("DEALER TREND LONG" in trend_regime
-          and relation == "ABOVE CPR"
-          and ltp > vwap_val):
+                if seg not in data:
+                    print(f"QUOTE {seg} MISSING:", r)
+                    continue
 
-        execution = "🔥 DEALER TREND CE"
+                for sid in ids:
+                    if sid in data[seg]:
+                        QUOTES[(seg, sid)] = {"ltp": float(data[seg][sid]["last_price"]), "ts": now}
 
-    # =====================================================
-    # DARK POOL EARLY ENTRY
-    # =====================================================
+        except Exception as e:
 
-    elif ("DARK POOL SHORT BUILD" in dark
-          and relation == "BELOW CPR"
-          and ltp < vwap_val):
+            print("QUOTE API ERROR:", e)
 
-        execution = "🌑 EARLY DARK PE ENTRY"
 
-    # ---------- FINAL WRITE ----------
-    ultra_write("N7", execution)
-# ================= ABSORPTION RADAR =================
+# ================= MARKET (ULTRA SAFE) =================
 
-def absorption_radar_engine(ltp, oc):
+def market(cfgs, legs=()):
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
+    # -> {security_id: ltp} for every underlying; the option legs ride the
+    # same batched call and land in QUOTES
+    fetch_quotes([(cfg["seg"], cfg["id"]) for cfg in cfgs] + list(legs))
 
-    signal = "NO ABSORPTION"
+    prices = {}
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N33", signal)
-        return
+    for cfg in cfgs:
 
-    atm = round(ltp/50)*50
-    key = f"{atm:.6f}"
+        ltp = quote(cfg["seg"], cfg["id"])
 
-    if key not in oc:
-        ultra_write("N33", signal)
-        return
+        if ltp is None:
+            print("MARKET SECURITY ID MISSING:", cfg["seg"], cfg["id"])
+        else:
+            prices[cfg["id"]] = ltp
 
-    ce = oc[key].get("ce")
-    pe = oc[key].get("pe")
+    return prices
 
-    if not ce or not pe:
-        ultra_write("N33", signal)
-        return
 
-    ce_prem = ce.get("last_price",0)
-    pe_prem = pe.get("last_price",0)
+# ================= INDIA VIX =================
 
-    ce_oi = ce.get("oi",0)
-    ce_prev = ce.get("previous_oi",0)
+# Dhan quote first (INDIA VIX rides the batched LTP call), the NSE page
+# only as a fallback through one cookie-warm session, fetched as a job of
+# the fetch stage and tried at most once per VIX_TTL; the last good value
+# is cached for VIX_TTL and its age is exposed to the range engine.
 
-    pe_oi = pe.get("oi",0)
-    pe_prev = pe.get("previous_oi",0)
+VIX_CFG = {"id": "21", "seg": "IDX_I", "name": "INDIA VIX"}
 
-    # ---- Downside absorption ----
-    if (relation=="BELOW CPR"
-        and pe_oi > pe_prev
-        and pe_prem <= pe.get("previous_close",0)):
+VIX_TTL = float(os.getenv("VIX_TTL", "30"))
+VIX_STALE_SEC = float(os.getenv("VIX_STALE_SEC", "300"))
+VIX_DEFAULT = 15
 
-        signal="🟢 DOWNSIDE ABSORPTION"
+VIX = {"value": None, "ts": 0.0, "source": "", "missed": False, "nse_tried": 0.0}
 
-    # ---- Upside absorption ----
-    elif (relation=="ABOVE CPR"
-          and ce_oi > ce_prev
-          and ce_prem <= ce.get("previous_close",0)):
+NSE_URL = "https://www.nseindia.com"
+NSE_COOKIE_SEC = float(os.getenv("NSE_COOKIE_SEC", "600"))
 
-        signal="🔴 UPSIDE ABSORPTION"
+NSE = {"session": None, "warmed": 0.0}
 
-    ultra_write("N33", signal)
-# ================= LIQUIDITY VACUUM RADAR =================
-# ================= LIQUIDITY VACUUM RADAR =================
 
-LAST_LV_LTP = None
+def nse_session(force=False):
 
-def liquidity_vacuum_radar(ltp, oc):
+    # one session for the whole run; the home page is only re-hit to
+    # refresh cookies
+    if NSE["session"] is None:
+        NSE["session"] = requests.Session()
+        NSE["session"].headers.update({"User-Agent": "Mozilla/5.0", "Accept": "application/json"})
 
-    global LAST_LV_LTP
+    if force or time.time() - NSE["warmed"] > NSE_COOKIE_SEC:
+        NSE["session"].get(NSE_URL, timeout=FETCH_TIMEOUT)
+        NSE["warmed"] = time.time()
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
+    return NSE["session"]
 
-    signal = "NO VACUUM"
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N35", signal)
-        return
+def nse_vix():
 
-    atm = round(ltp/50)*50
-    key = f"{atm:.6f}"
+    for attempt in range(2):
 
-    if key not in oc:
-        ultra_write("N35", signal)
-        return
+        try:
 
-    ce = oc[key].get("ce")
-    pe = oc[key].get("pe")
+            r = nse_session(force=attempt > 0).get(NSE_URL + "/api/allIndices", timeout=FETCH_TIMEOUT)
 
-    if not ce or not pe:
-        ultra_write("N35", signal)
-        return
+            # cookies expired: re-warm once
+            if r.status_code in (401, 403):
+                continue
 
-    # ---- PRICE ACCELERATION ----
-    accel = 0
-    if LAST_LV_LTP is not None:
-        accel = abs(ltp - LAST_LV_LTP)
+            for i in r.json().get("data", []):
+                if i.get("index") == "INDIA VIX":
+                    return float(i.get("last"))
 
-    LAST_LV_LTP = ltp
+            return None
 
-    # ---- DOWN VACUUM ----
-    pe_prem_jump = pe.get("last_price",0) > pe.get("previous_close",0)*1.05
-    pe_oi_flat = abs(pe.get("oi",0) - pe.get("previous_oi",0)) < 1500
+        except Exception as e:
+            print("NSE VIX ERROR:", e)
 
-    if (relation=="BELOW CPR"
-        and ltp < vwap_val
-        and accel > 25
-        and pe_prem_jump
-        and pe_oi_flat):
+    return None
 
-        signal="🔻 LIQUIDITY VACUUM DOWN"
 
-    # ---- UP VACUUM ----
-    ce_prem_jump = ce.get("last_price",0) > ce.get("previous_close",0)*1.05
-    ce_oi_flat = abs(ce.get("oi",0) - ce.get("previous_oi",0)) < 1500
+def nse_vix_due(now):
 
-    if (relation=="ABOVE CPR"
-        and ltp > vwap_val
-        and accel > 25
-        and ce_prem_jump
-        and ce_oi_flat):
+    # only after the Dhan quote came back without VIX, and the attempt is
+    # stamped whether it succeeds or not
+    if not VIX["missed"] or now - VIX["nse_tried"] < VIX_TTL:
+        return False
 
-        signal="🚀 LIQUIDITY VACUUM UP"
+    if VIX["value"] is not None and now - VIX["ts"] < VIX_TTL:
+        return False
 
-    ultra_write("N35", signal)
+    VIX["nse_tried"] = now
 
-# ================= INSTITUTIONAL BREAKOUT RADAR =================
+    return True
 
-LAST_BREAK_LTP = None
-LAST_BREAK_TIME = None
 
-def breakout_radar_engine(ltp):
+def india_vix(nse=None):
 
-    global LAST_BREAK_LTP, LAST_BREAK_TIME
+    # nse: this tick's NSE fallback result, when one was fetched
+    now = time.time()
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
+    if VIX["value"] is not None and now - VIX["ts"] < VIX_TTL:
+        return VIX["value"]
 
-    signal = "NO BREAKOUT"
+    value, source = quote(VIX_CFG["seg"], VIX_CFG["id"]), "DHAN"
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N11", signal)
-        return
+    VIX["missed"] = value is None
 
-    now = time.time()
-    velocity = 0
+    if value is None:
+        value, source = nse, "NSE"
 
-    if LAST_BREAK_LTP is not None and LAST_BREAK_TIME is not None:
+    if value is not None:
+        VIX.update({"value": value, "ts": now, "source": source})
+    else:
+        print("VIX UNAVAILABLE — last:", VIX["value"], VIX["source"])
 
-        dt = now - LAST_BREAK_TIME
+    return VIX["value"]
+
+
+def vix_age():
+
+    # seconds since the last good reading (inf: never had one)
+    return time.time() - VIX["ts"] if VIX["value"] is not None else math.inf
+
+
+# ================= DAILY HISTORY =================
+
+def fetch_history(cfg):
+
+    return dhan_post("charts/historical", {
+        "securityId":cfg["id"],
+        "exchangeSegment":cfg["seg"],
+        "instrument":cfg["instr"],
+        "fromDate":(datetime.date.today()-datetime.timedelta(days=10)).strftime("%Y-%m-%d"),
+        "toDate":datetime.date.today().strftime("%Y-%m-%d")
+    })
+
+
+# ================= DAILY BAR STORE =================
+
+# previous-day OHLC cannot change during the session:
+# fetched once per trading day, kept in memory and on disk for restarts
+
+DAILY_BAR_FILE = os.getenv("DAILY_BAR_FILE", "daily_bars.json")
+
+# {"date", "bars": {security_id: bars}} shared by every underlying
+DAILY_BARS = {"date": None, "bars": {}}
+DAILY_BARS_LOCK = threading.Lock()
+
+def parse_daily_bars(hist):
+
+    if not hist:
+        return None
+
+    # ---- SAFE PARSE ----
+    if "high" in hist:
+        data = hist
+    elif "data" in hist:
+        data = hist.get("data",{})
+    else:
+        print("DAILY BARS STRUCTURE UNKNOWN:", hist)
+        return None
+
+    bars = {
+        "high": data.get("high",[]),
+        "low": data.get("low",[]),
+        "close": data.get("close",[]),
+        "timestamp": data.get("timestamp",[])
+    }
+
+    if len(bars["high"])<2 or len(bars["low"])<2 or len(bars["close"])<2:
+        print("DAILY BARS INSUFFICIENT DATA")
+        return None
+
+    return bars
+
+
+def daily_bars(cfg):
+
+    today = ist_today().isoformat()
+    sid = cfg["id"]
+
+    with DAILY_BARS_LOCK:
+
+        if DAILY_BARS["date"] != today:
+
+            DAILY_BARS.update({"date": today, "bars": {}})
+
+            # ---- restart: reuse today's file ----
+            try:
+                with open(DAILY_BAR_FILE) as f:
+                    saved = json.load(f)
+
+                if saved.get("date") == today and isinstance(saved.get("bars"), dict) and "close" not in saved["bars"]:
+                    DAILY_BARS["bars"].update(saved["bars"])
+                    print("DAILY BARS LOADED FROM FILE")
+
+            except (OSError, ValueError):
+                pass
+
+        if sid in DAILY_BARS["bars"]:
+            return DAILY_BARS["bars"][sid]
+
+    bars = parse_daily_bars(fetch_history(cfg))
+
+    if not bars:
+        return None
+
+    with DAILY_BARS_LOCK:
+
+        DAILY_BARS["bars"][sid] = bars
+
+        try:
+            tmp = DAILY_BAR_FILE + ".tmp"
+
+            with open(tmp, "w") as f:
+                json.dump(DAILY_BARS, f)
+
+            os.replace(tmp, DAILY_BAR_FILE)
+
+        except OSError as e:
+            print("DAILY BARS SAVE ERROR:", e)
+
+    print("DAILY BARS FETCHED:", cfg["name"], len(bars["close"]))
+
+    return bars
+
+
+def prev_day_bar(bars):
+
+    # -> {"high","low","close"} of the last completed session
+    if not bars:
+        return None
+
+    i = len(bars["close"]) - 2
+
+    # with timestamps, skip today's (possibly missing) candle by date,
+    # so a pre-open fetch doesn't shift PDH/PDL back a day
+    ts = bars.get("timestamp") or []
+
+    if len(ts) == len(bars["close"]):
+
+        today = ist_today()
+
+        i = -1
+
+        for j,t in enumerate(ts):
+            if datetime.datetime.fromtimestamp(t, IST).date() < today:
+                i = j
+
+        if i < 0:
+            return None
+
+    return {
+        "high": bars["high"][i],
+        "low": bars["low"][i],
+        "close": bars["close"][i]
+    }
+
+
+# ================= CPR ENGINE (ULTRA SAFE FINAL) =================
+
+def cpr_levels(prev):
+
+    H=prev["high"]
+    L=prev["low"]
+    C=prev["close"]
+
+    pivot=(H+L+C)/3
+    bc=(H+L)/2
+    tc=pivot*2-bc
+
+    tc,bc=max(tc,bc),min(tc,bc)
+
+    width=abs(tc-bc)
+
+    if width<=40:
+        typ="ULTRA NARROW ⚡"
+    elif width<=70:
+        typ="NARROW 🔥"
+    elif width<=120:
+        typ="NORMAL"
+    else:
+        typ="WIDE 🧊"
+
+    return {"hlc":(H,L,C), "tc":tc, "pivot":pivot, "bc":bc, "width":width, "type":typ}
+
+
+def cpr_engine(ltp, prev):
+
+    global LAST_CPR
+
+    try:
+
+        if not prev:
+            print("CPR INSUFFICIENT DATA")
+            return
+
+        # ---- levels are fixed for the session: compute only on change ----
+        if LAST_CPR is None or LAST_CPR["hlc"] != (prev["high"],prev["low"],prev["close"]):
+
+            LAST_CPR = cpr_levels(prev)
+
+            print("CPR LEVELS SET:", LAST_CPR["type"])
+
+        # re-emitted every run: the diff writer drops unchanged cells, and
+        # after a shadow resync this restores manually edited H4:H8
+        ultra_write("H4",LAST_CPR["tc"])
+        ultra_write("H5",LAST_CPR["pivot"])
+        ultra_write("H6",LAST_CPR["bc"])
+        ultra_write("H7",LAST_CPR["width"])
+        ultra_write("H8",LAST_CPR["type"])
+
+        tc=LAST_CPR["tc"]
+        pivot=LAST_CPR["pivot"]
+        bc=LAST_CPR["bc"]
+
+        relation=Relation.INSIDE
+
+        if ltp>tc:
+            relation=Relation.ABOVE
+        elif ltp<bc:
+            relation=Relation.BELOW
+
+        set_state("tc", tc)
+        set_state("pivot", pivot)
+        set_state("bc", bc)
+
+        emit("relation", relation)
+
+    except Exception as e:
+
+        print("CPR ENGINE ERROR:",e)
+
+
+#==================== RESIS/SUPP/MAX PAIN ======================
+
+OI_WALLS_TOP_N = 3
+
+def max_pain(strikes, ce_oi, pe_oi):
+
+    # total writer payout if expiry settles at each strike K_j:
+    #   calls  sum_{i<=j} ce_i*(K_j-K_i) = K_j*cum(ce) - cum(ce*K)
+    #   puts   sum_{i>=j} pe_i*(K_i-K_j) = rcum(pe*K) - K_j*rcum(pe)
+    # prefix sums turn the O(n^2) scan into O(n)
+    call_pay = strikes*np.cumsum(ce_oi) - np.cumsum(ce_oi*strikes)
+    put_pay = np.cumsum((pe_oi*strikes)[::-1])[::-1] - strikes*np.cumsum(pe_oi[::-1])[::-1]
+
+    return strikes[int(np.argmin(call_pay + put_pay))]
+
+
+def oi_walls(strikes, oi, mask, n=OI_WALLS_TOP_N):
+
+    # strikes of the n biggest OI walls inside mask, biggest first
+    order = np.argsort(-oi[mask], kind="stable")[:n]
+
+    return [int(k) for k in strikes[mask][order]]
+
+
+def oi_levels_engine(ltp, oc):
+
+    if not len(oc):
+        return
+
+    strikes = oc.strikes
+
+    ce_oi = oc.ce["oi"]
+    pe_oi = oc.pe["oi"]
+
+    atm = atm_strike(ltp)
+
+    # walls: only relevant strikes
+    near = np.abs(strikes-atm) <= 10*UNDERLYING["step"]
+
+    ce_walls = oi_walls(strikes, ce_oi, near & (strikes > ltp) & (ce_oi > 0))
+    pe_walls = oi_walls(strikes, pe_oi, near & (strikes < ltp) & (pe_oi > 0))
+
+    resistance = ce_walls[0] if ce_walls else None
+    support = pe_walls[0] if pe_walls else None
+
+    if resistance:
+        ultra_write("B31", resistance)
+
+    if support:
+        ultra_write("B33", support)
+
+    # max pain + PCR: whole chain
+    if ce_oi.sum() + pe_oi.sum() > 0:
+
+        maxpain = int(max_pain(strikes, ce_oi, pe_oi))
+
+        ultra_write("B32", maxpain)
+        set_state("max_pain", maxpain)
+
+    if ce_oi.sum() > 0:
+
+        pcr = round(float(pe_oi.sum()/ce_oi.sum()), 2)
+
+        ultra_write("B34", pcr)
+        set_state("pcr", pcr)
+
+    ultra_write("B35", " / ".join(map(str, ce_walls)))
+    ultra_write("B36", " / ".join(map(str, pe_walls)))
+# ================= VIX RANGE =================
+
+def vix_range_engine(ltp, vix, age=0):
+
+    if vix is None:
+        vix = VIX_DEFAULT
+
+    # Daily sigma formula
+    pct = vix / math.sqrt(365)
+    pts = (pct / 100) * ltp
+
+    vix_high = round(ltp + pts)
+    vix_low = round(ltp - pts)
+
+    ultra_write("D31", vix_high)   # VIX HIGH
+    ultra_write("D32", vix_low)    # VIX LOW
+
+    # range built on an old (or default) VIX
+    if age == math.inf:
+        ultra_write("D33", f"VIX DEFAULT {VIX_DEFAULT}")
+    elif age > VIX_STALE_SEC:
+        ultra_write("D33", f"VIX STALE {int(age//60)}m ({VIX['source']})")
+    else:
+        ultra_write("D33", "")
+
+
+# ================= VWAP =================
+
+# ================= VWAP ULTRA ENGINE v2 (LIVE SAFE) =================
+
+# Session VWAP plus two anchored VWAPs (from the last CPR break and from
+# the P7 time), advanced one closed 1-minute bar at a time from the candle
+# store. Index candles carry no volume, so each bar is weighted by the
+# near-month future's volume for the same minute.
+
+LAST_VWAP = None
+
+# index name -> its futures' underlying symbol in the scrip master
+FUT_SYMBOLS = {
+    "NIFTY 50": "NIFTY", "NIFTY BANK": "BANKNIFTY",
+    "NIFTY FIN SERVICE": "FINNIFTY", "NIFTY MID SELECT": "MIDCPNIFTY"
+}
+
+VWAP_STREAM = {"day": None, "last": None, "session": None, "cpr": None, "side": None, "manual": None, "anchor": None}
+
+def volume_scrip(cfg):
+
+    # stocks trade their own volume; an index borrows its near-month future's
+    if cfg["instr"] != "INDEX":
+        return cfg
+
+    refresh_scrip_index()
+
+    today = ist_today().isoformat()
+    key = f"FUT:{cfg['name']}:{today}"
+
+    if key not in SCRIP_MEMO:
+
+        with SCRIP_LOCK:
+            row = SCRIP_DB.execute(
+                "SELECT security_id,segment,instrument FROM scrips "
+                "WHERE underlying=? AND instrument='FUTIDX' AND expiry>=? ORDER BY expiry LIMIT 1",
+                (FUT_SYMBOLS.get(cfg["name"], cfg["name"].split()[0]), today)
+            ).fetchone()
+
+        SCRIP_MEMO[key] = None if row is None else {"id": row[0], "seg": row[1], "instr": row[2]}
+
+    return SCRIP_MEMO[key]
+
+
+def fetch_index_intraday(cfg):
+
+    # index prices and volume-source candles, both topped up incrementally
+    price = refresh_candles(cfg["id"], (cfg["seg"], cfg["instr"]))
+
+    vol = volume_scrip(cfg)
+
+    if vol is None or vol["id"] == cfg["id"]:
+        return {"price": price, "volume": price}
+
+    return {"price": price, "volume": refresh_candles(vol["id"], (vol["seg"], vol["instr"]))}
+
+
+def bar_volume(candles, ts):
+
+    stamps = candles["timestamp"]
+    i = bisect.bisect_left(stamps, ts)
+
+    return candles["volume"][i] if i < len(stamps) and stamps[i] == ts else 0.0
+
+
+def vwap_anchor_time(day, anchor):
+
+    # "HH:MM" (IST) in P7 -> epoch of that minute today
+    try:
+        return datetime.datetime.strptime(f"{day} {anchor.strip()}", "%Y-%m-%d %H:%M").replace(tzinfo=IST).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def vwap_commit(s, ts, bar):
+
+    s["session"].update(bar)
+
+    # CPR-break anchor restarts whenever a close leaves the CPR on a new side
+    if LAST_CPR:
+
+        side = "ABOVE" if bar["close"] > LAST_CPR["tc"] else "BELOW" if bar["close"] < LAST_CPR["bc"] else "INSIDE"
+
+        if side != "INSIDE" and side != s["side"]:
+            s["cpr"] = VWAP()
+
+        s["side"] = side
+
+    if s["cpr"]:
+        s["cpr"].update(bar)
+
+    if s["manual"] and ts >= s["anchor"][1]:
+        s["manual"].update(bar)
+
+
+def vwap_stream(intraday, anchor):
+
+    # advances VWAP_STREAM; returns the forming bar, None without candles
+    price, volume = intraday["price"], intraday["volume"]
+
+    stamps = price["timestamp"]
+
+    if not stamps:
+        return None
+
+    s = VWAP_STREAM
+
+    if s["day"] != price["day"]:
+        s.update({"day": price["day"], "last": None, "session": VWAP(), "cpr": None, "side": None, "manual": None, "anchor": None})
+
+    bar = lambda i: {"close": price["close"][i], "volume": bar_volume(volume, stamps[i])}
+
+    # manual anchor moved: replay the closed bars since the new anchor once
+    t = vwap_anchor_time(price["day"], anchor)
+
+    if (s["anchor"] or (None, None))[1] != t:
+
+        s["anchor"] = (anchor, t)
+        s["manual"] = VWAP() if t else None
+
+        if t and s["last"] is not None:
+            for i in range(bisect.bisect_left(stamps, t), bisect.bisect_right(stamps, s["last"])):
+                s["manual"].update(bar(i))
+
+    start = bisect.bisect_right(stamps, s["last"]) if s["last"] is not None else 0
+
+    # commit a bar only once it has closed in the volume series as well; a
+    # failed or lagging future fetch must not freeze a zero/partial volume
+    vol_stamps = volume["timestamp"]
+    end = bisect.bisect_right(stamps, vol_stamps[-2]) if len(vol_stamps) > 1 else 0
+
+    for i in range(start, min(end, len(stamps) - 1)):
+        vwap_commit(s, stamps[i], bar(i))
+        s["last"] = stamps[i]
+
+    return bar(len(stamps) - 1)
+
+
+def vwap(ltp, oc_data, intraday, anchor=""):
+
+    global LAST_VWAP
+
+    try:
+
+        # =====================================================
+        # 1️⃣ PRIMARY — STREAMING INDEX VWAP (INTRADAY CANDLES)
+        # =====================================================
+
+        forming = vwap_stream(intraday, anchor) if intraday else None
+
+        v, sigma = VWAP_STREAM["session"].bands(forming) if forming else (None, None)
+
+        if v is not None:
+
+            LAST_VWAP = round(v,2)
+
+            ultra_write("Q3", LAST_VWAP)
+
+            # ±1σ / ±2σ bands
+            ultra_write_range("R3:U3", [[round(v+sigma,2), round(v-sigma,2), round(v+2*sigma,2), round(v-2*sigma,2)]])
+
+            cpr_v = VWAP_STREAM["cpr"].peek(forming) if VWAP_STREAM["cpr"] else None
+            manual_v = VWAP_STREAM["manual"].peek(forming) if VWAP_STREAM["manual"] else None
+
+            ultra_write("Q6", round(cpr_v,2) if cpr_v is not None else "")
+            ultra_write("Q7", round(manual_v,2) if manual_v is not None else "")
+
+            print("VWAP LIVE:", LAST_VWAP)
+
+            return
+
+        
+        # =====================================================
+        # 2️⃣ FALLBACK — INSTITUTIONAL OPTIONCHAIN VWAP
+        # =====================================================
+
+        total_weight   = 0
+        weighted_price = 0
+
+        atm = atm_strike(ltp)
+
+        idx = oc_data.window(atm, -4, 4)
+
+        for side in (oc_data.ce, oc_data.pe):
+
+            p = side["last_price"][idx]
+            v = side["volume"][idx]
+            m = side["ok"][idx] & (v > 0)
+
+            weighted_price += float((p*v)[m].sum())
+            total_weight   += float(v[m].sum())
+
+        if total_weight > 0:
+
+            LAST_VWAP = round(weighted_price/total_weight,2)
+
+            ultra_write("Q3", LAST_VWAP)
+
+            print("VWAP OPTIONCHAIN FALLBACK:", LAST_VWAP)
+
+            return
+
+
+        # =====================================================
+        # 3️⃣ EMERGENCY FALLBACK — NEVER LEAVE VWAP EMPTY
+        # =====================================================
+
+        if LAST_VWAP is None:
+            LAST_VWAP = ltp
+
+        ultra_write("Q3", LAST_VWAP)
+
+        print("VWAP EMERGENCY (LTP):", LAST_VWAP)
+
+
+    except Exception as e:
+
+        print("VWAP ERROR:", e)
+
+    
+    if LAST_VWAP is not None:
+        set_state("vwap", LAST_VWAP)
+
+
+
+#=====================================================
+
+# security_id -> expiry in use; "" = rejected, clear B4 and refetch
+EXPIRY = {}
+
+def expiry(cfg, current=""):
+
+ # B4 (manual or previously auto-set) wins over the expiry list
+ if current:
+  EXPIRY[cfg["id"]]=current
+  return current
+
+ if EXPIRY.get(cfg["id"]):
+  return EXPIRY[cfg["id"]]
+
+ r=dhan_post("optionchain/expirylist", {"UnderlyingScrip":int(cfg["id"]),"UnderlyingSeg":cfg["seg"]})
+
+ exp=r.get("data",[])
+
+ if not exp:
+  raise Exception("No expiry received")
+
+ first=exp[0]
+
+ EXPIRY[cfg["id"]]=first
+
+ print("AUTO EXPIRY SET:",cfg["name"],first)
+
+ return first
+
+
+def sync_expiry():
+
+ # render the expiry the chain fetch settled on into B4
+ exp=EXPIRY.get(UNDERLYING["id"])
+
+ if exp is not None and exp!=safe("B4"):
+  ultra_write("B4",exp)
+
+# ================= OPTION CHAIN SNAPSHOT (COLUMNAR) =================
+
+# one sorted strike array + parallel numpy columns per side, built once
+# per chain refresh; engines index columns instead of "24500.000000" keys
+
+CHAIN_FIELDS = ("oi","previous_oi","last_price","previous_close","volume","iv","delta","security_id")
+
+def chain_leg_values(leg):
+
+    # Dhan names vary between payload versions, normalise them here
+    greeks = leg.get("greeks") or {}
+
+    return (
+        leg.get("oi",0),
+        leg.get("previous_oi",0),
+        leg.get("last_price",0),
+        leg.get("previous_close_price", leg.get("previous_close",0)),
+        leg.get("volume",0),
+        leg.get("implied_volatility", leg.get("iv",0)),
+        greeks.get("delta", leg.get("delta",0)),
+        leg.get("security_id") or 0
+    )
+
+
+def chain_side(legs):
+
+    rows = [chain_leg_values(leg) if leg else (0,)*len(CHAIN_FIELDS) for leg in legs]
+
+    cols = np.array(rows, dtype=np.float64).reshape(len(rows), len(CHAIN_FIELDS))
+
+    side = {f: cols[:,j] for j,f in enumerate(CHAIN_FIELDS)}
+
+    side["security_id"] = side["security_id"].astype(np.int64)
+    side["ok"] = np.array([bool(leg) for leg in legs], dtype=bool)
+
+    # the snapshot is shared by engine workers without copies: freeze it
+    for col in side.values():
+        col.flags.writeable = False
+
+    return side
+
+
+def oi_window_kernel(chain, idx):
+
+    # build/unwind counts, OI pressure and premium sums for one ATM window,
+    # shared by every gamma / dealer / CPR engine of the tick
+    out = {}
+
+    for name,side in (("ce",chain.ce), ("pe",chain.pe)):
+
+        ok = side["ok"][idx]
+        d = (side["oi"][idx] - side["previous_oi"][idx])[ok]
+
+        out[f"{name}_n"] = int(d.size)
+        out[f"{name}_up"] = int(np.count_nonzero(d > 0))
+        out[f"{name}_down"] = int(np.count_nonzero(d < 0))
+        out[f"{name}_pressure"] = float(d.sum())
+        out[f"{name}_premium"] = float(side["last_price"][idx][ok].sum())
+
+    n = out["ce_n"] + out["pe_n"]
+
+    out["premium_avg"] = (out["ce_premium"] + out["pe_premium"]) / n if n else None
+
+    return out
+
+
+class OptionChain:
+
+    __slots__ = ("strikes","pos","ce","pe","raw","flows","step","segment")
+
+    def __init__(self, oc, step=None):
+
+        items = []
+
+        for k,v in oc.items():
+            try:
+                items.append((float(k), v or {}))
+            except (TypeError, ValueError):
+                continue
+
+        items.sort(key=lambda x: x[0])
+
+        self.raw = oc
+        self.strikes = np.array([k for k,_ in items], dtype=np.float64)
+        self.pos = {round(k,2): i for i,(k,_) in enumerate(items)}
+
+        self.ce = chain_side([v.get("ce") for _,v in items])
+        self.pe = chain_side([v.get("pe") for _,v in items])
+
+        self.flows = {}
+
+        # strike grid: configured step, else the most common listed gap
+        gaps = np.diff(self.strikes)
+        gaps = gaps[gaps > 0]
+
+        self.step = step or (float(np.bincount(gaps.astype(np.int64)).argmax()) if len(gaps) else 50)
+
+        # exchange segment of the legs, set when the snapshot is taken
+        self.segment = None
+
+    def __len__(self):
+        return len(self.strikes)
+
+    def find(self, strike):
+        # strike -> row index (None if the strike isn't listed)
+        return self.pos.get(round(float(strike),2))
+
+    def side(self, side):
+        return self.ce if side.lower() == "ce" else self.pe
+
+    def window(self, atm, lo, hi):
+        # row indexes of the listed strikes atm+lo*step .. atm+hi*step
+        return np.array(
+            [i for i in (self.find(atm+n*self.step) for n in range(lo, hi+1)) if i is not None],
+            dtype=np.intp
+        )
+
+    def flow(self, atm, width=2):
+        # oi_window_kernel() over atm±width strikes, computed once per snapshot
+        key = (atm, width)
+
+        if key not in self.flows:
+            self.flows[key] = oi_window_kernel(self, self.window(atm, -width, width))
+
+        return self.flows[key]
+
+    def leg(self, strike, side):
+
+        # single-leg view as plain floats (None if the leg isn't listed)
+        i = self.find(strike)
+        col = self.side(side)
+
+        if i is None or not col["ok"][i]:
+            return None
+
+        leg = {f: float(col[f][i]) for f in CHAIN_FIELDS}
+
+        leg["security_id"] = int(col["security_id"][i])
+        leg["oi_change"] = leg["oi"] - leg["previous_oi"]
+
+        # a fresher batched/pushed quote beats the snapshot's premium
+        ltp = quote(self.segment, leg["security_id"]) if self.segment else None
+
+        if ltp is not None:
+            leg["last_price"] = ltp
+
+        return leg
+
+
+def chain_snapshot(cfg, data):
+
+    chain = OptionChain(data, cfg.get("step"))
+    chain.segment = option_segment(cfg)[0]
+
+    # symbols without a known strike step learn it from their first chain
+    if not cfg.get("step"):
+        cfg["step"] = chain.step
+        print("STRIKE STEP INFERRED:", cfg["name"], chain.step)
+
+    return chain
+
+
+# ================= OPTIONCHAIN (FIXED PARSER) =================
+
+# ================= OPTIONCHAIN (ULTRA SAFE PARSER) =================
+
+def optionchain(cfg, current_expiry=""):
+
+    try:
+
+        r = dhan_post("optionchain", {
+            "UnderlyingScrip":int(cfg["id"]),
+            "UnderlyingSeg":cfg["seg"],
+            "Expiry":expiry(cfg, current_expiry)
+        })
+
+        # ---------- DEBUG ----------
+        print("OPTIONCHAIN RAW KEYS:", list(r.keys()))
+
+        # ---------- ERROR HANDLING ----------
+        # Some Dhan errors return:
+        # { "status":"error", "errorCode":811 ... }
+
+        if r.get("status") == "error":
+
+            error_code = str(r.get("errorCode",""))
+
+            if error_code == "811":
+
+                print("⚠️ INVALID EXPIRY (811) — resetting expiry")
+
+                EXPIRY[cfg["id"]] = ""   # force expiry refresh
+
+                return {}
+
+            print("OPTIONCHAIN ERROR:", r)
+            return {}
+
+        # ---------- NORMAL DATA ----------
+        data = r.get("data", {})
+
+        if "oc" in data:
+
+            print("OPTIONCHAIN OK — strikes loaded:", len(data["oc"]))
+
+            return chain_snapshot(cfg, data["oc"])
+
+        # ---------- FALLBACK FORMAT ----------
+        # Sometimes API returns strikes directly
+
+        if isinstance(data, dict):
+
+            print("OPTIONCHAIN ALT FORMAT DETECTED")
+
+            return chain_snapshot(cfg, data)
+
+        print("OPTIONCHAIN UNKNOWN STRUCTURE:", r)
+
+        return {}
+
+    except Exception as e:
+
+        print("OPTIONCHAIN ERROR:", e)
+
+        return {}
+
+
+# ================= GAMMA ENGINE =================
+
+def gamma_engine(ltp,oc):
+
+    atm=atm_strike(ltp)
+
+    flow=oc.flow(atm,3)
+
+    ce_build=flow["ce_up"]
+    pe_build=flow["pe_up"]
+
+    state=Gamma.NEUTRAL
+
+    velocity = SIG.premium_velocity
+
+    if ce_build>=3 and pe_build>=3:
+
+        if velocity > 0.5:
+            state=Gamma.UP
+        else:
+            state=Gamma.TRAP
+
+    elif ce_build>pe_build:
+        state=Gamma.UP
+
+    elif pe_build>ce_build:
+        state=Gamma.DOWN
+
+    emit("gamma", state)
+
+
+
+def god_mode_engine(ltp, oc):
+
+    atm = atm_strike(ltp)
+
+    flow = oc.flow(atm, 2)
+
+    ce_unwind = flow["ce_down"]
+    pe_unwind = flow["pe_down"]
+
+    ce_build = flow["ce_n"] - ce_unwind
+    pe_build = flow["pe_n"] - pe_unwind
+
+    signal = God.NONE
+
+    # Liquidity vacuum up
+    if ce_unwind >=3 and pe_build <=1:
+        signal = God.LONG
+
+    # Liquidity vacuum down
+    elif pe_unwind >=3 and ce_build <=1:
+        signal = God.SHORT
+
+    emit("god_signal", signal)
+# ================= DEALER INTENT RADAR =================
+
+def dealer_intent_radar(ltp, oc):
+
+    atm = atm_strike(ltp)
+
+    flow = oc.flow(atm, 2)
+
+    ce_build = flow["ce_up"]
+    pe_build = flow["pe_up"]
+
+    ce_unwind = flow["ce_n"] - ce_build
+    pe_unwind = flow["pe_n"] - pe_build
+
+    intent = "NEUTRAL"
+
+    # hidden bullish prep
+    if pe_build >=3 and ce_unwind >=2:
+        intent = "🚀 DEALER PREPARE LONG"
+
+    # hidden bearish prep
+    elif ce_build >=3 and pe_unwind >=2:
+        intent = "🔻 DEALER PREPARE SHORT"
+
+    ultra_write("N25", intent)
+# ================= TRUE SNIPER V2 — PREDICTIVE GAMMA =================
+
+LAST_PREMIUM = None
+LAST_PREMIUM_TIME = None
+
+def predictive_gamma_engine(ltp, oc):
+
+    global LAST_PREMIUM, LAST_PREMIUM_TIME
+
+    atm = atm_strike(ltp)
+
+    flow = oc.flow(atm, 2)
+
+    ce_pressure = flow["ce_pressure"]
+    pe_pressure = flow["pe_pressure"]
+
+    premium_sum = flow["ce_premium"] + flow["pe_premium"]
+    count = flow["ce_n"] + flow["pe_n"]
+
+    signal = Predictive.NONE
+
+    # ---------- EARLY OI IMBALANCE ----------
+    if ce_pressure > abs(pe_pressure)*1.5:
+        signal = Predictive.EARLY_UP
+
+    elif pe_pressure > abs(ce_pressure)*1.5:
+        signal = Predictive.EARLY_DOWN
+
+    # ---------- PREMIUM VELOCITY ----------
+    if count > 0:
+
+        avg_premium = premium_sum / count
+        now = time.time()
+
+        velocity = 0
+
+        if LAST_PREMIUM and LAST_PREMIUM_TIME:
+
+            dt = now - LAST_PREMIUM_TIME
+
+            if dt > 0:
+                velocity = abs(avg_premium - LAST_PREMIUM) / dt
+
+        LAST_PREMIUM = avg_premium
+        LAST_PREMIUM_TIME = now
+
+        emit("premium_velocity", velocity)
+
+        if velocity > 0.8 and signal in (Predictive.EARLY_UP, Predictive.EARLY_DOWN):
+            signal = Predictive.IGNITION
+
+    emit("predictive_gamma", signal)
+#===============================DEALER =====================
+
+def dealer_trap_engine(ltp, oc):
+
+    relation = SIG.relation
+    gamma_state = SIG.gamma
+    vwap_val = get_state("vwap")
+
+
+    resistance = read_signal("resistance")
+    support = read_signal("support")
+
+    trap = "NO TRAP"
+
+    try:
+        vwap_val = float(vwap_val)
+        resistance = float(resistance) if resistance else None
+        support = float(support) if support else None
+    except:
+        ultra_write("N19", trap)
+        return
+
+
+
+
+    atm = atm_strike(ltp)
+
+    # ----- dealer behaviour -----
+    flow = oc.flow(atm, 2)
+
+    ce_build = flow["ce_up"]
+    pe_build = flow["pe_up"]
+
+    # ----- distance from walls -----
+    near_resistance = abs(ltp - resistance) <= 30
+    near_support = abs(ltp - support) <= 30
+
+    # ---------- PRO TRAP LOGIC ----------
+
+    # Bull trap
+    if (relation==Relation.ABOVE and
+        ltp>vwap_val and
+        near_resistance and
+        ce_build>pe_build and
+        gamma_state==Gamma.UP):
+
+        trap="🔥 DEALER BULL TRAP PRO"
+
+    # Bear trap
+    elif (relation==Relation.BELOW and
+          ltp<vwap_val and
+          near_support and
+          pe_build>ce_build and
+          gamma_state==Gamma.DOWN):
+
+        trap="🔥 DEALER BEAR TRAP PRO"
+
+    ultra_write("N19", trap)
+
+# ================= INSIDE CPR PRO MODE =================
+
+def inside_cpr_pro_engine(ltp, oc):
+
+    relation = SIG.relation
+
+    if relation != Relation.INSIDE:
+        ultra_write("N21","OUTSIDE CPR")
+        return
+
+    try:
+        tc=float(get_state("tc"))
+        pivot=float(get_state("pivot"))
+        bc=float(get_state("bc"))
+    except:
+        return
+
+    atm=atm_strike(ltp)
+
+    flow=oc.flow(atm,2)
+
+    ce_build=flow["ce_up"]
+    pe_build=flow["pe_up"]
+
+    ce_unwind=flow["ce_n"]-ce_build
+    pe_unwind=flow["pe_n"]-pe_build
+
+    signal="INSIDE CPR — WAIT"
+
+    # BC Defense
+    if abs(ltp-bc)<=20 and pe_build>ce_build:
+        signal="🔥 BC DEFENSE → CE BIAS"
+
+    # TC Rejection
+    elif abs(ltp-tc)<=20 and ce_build>pe_build:
+        signal="🔥 TC REJECTION → PE BIAS"
+
+    # Pivot Gamma Flip
+    elif abs(ltp-pivot)<=20:
+        if ce_unwind>pe_unwind:
+            signal="🚀 PIVOT GAMMA FLIP UP"
+        elif pe_unwind>ce_unwind:
+            signal="🔻 PIVOT GAMMA FLIP DOWN"
+
+    # Compression
+    elif ce_build>=3 and pe_build>=3:
+        signal="⚡ CPR COMPRESSION — GAMMA BUILD"
+
+    ultra_write("N21",signal)
+# ================= CPR MAGNET + LIQUIDITY ENGINE =================
+
+def liquidity_target_engine(ltp, prev):
+
+    relation = SIG.relation
+
+    try:
+        tc=float(get_state("tc"))
+        pivot=float(get_state("pivot"))
+        bc=float(get_state("bc"))
+
+        resistance=float(read_signal("resistance"))
+        support=float(read_signal("support"))
+        maxpain=float(read_signal("maxpain"))
+
+    except:
+        return
+
+    # --- PDH / PDL from the daily bar store ---
+
+    pdh = prev["high"] if prev else None
+    pdl = prev["low"] if prev else None
+
+    target=Target.NONE
+    level=None
+
+    # ---- INSIDE CPR MAGNET ----
+    if relation==Relation.INSIDE:
+
+        if abs(ltp-pivot)<=20:
+            target=Target.PIVOT_MAGNET
+
+        elif ltp<pivot:
+            target=Target.TC
+
+        elif ltp>pivot:
+            target=Target.BC
+
+    # ---- ABOVE CPR ----
+    elif relation==Relation.ABOVE:
+
+        if pdh and abs(ltp-pdh)<=UNDERLYING["step"]:
+            target=Target.PDH
+
+        elif resistance:
+            target,level=Target.RESIST,resistance
+
+    # ---- BELOW CPR ----
+    elif relation==Relation.BELOW:
+
+        if pdl and abs(ltp-pdl)<=UNDERLYING["step"]:
+            target=Target.PDL
+
+        elif support:
+            target,level=Target.SUPPORT,support
+
+    # ---- MAX PAIN PIN ----
+    if maxpain and abs(ltp-maxpain)<=30:
+        target,level=Target.MAX_PAIN,None
+
+    SIG.target_level = level
+    emit("target", target, key=(target, level))
+# ================= INSTITUTIONAL CONFIRMATION =================
+
+LAST_LTP = None
+LAST_TIME = None
+
+def institutional_confirmation(ltp, oc):
+
+    global LAST_LTP, LAST_TIME
+
+    relation = SIG.relation
+    gamma_state = SIG.gamma
+    vwap_val = get_state("vwap")
+
+
+    status = Flow.NONE
+    SIG.flow_accel = False
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        emit("flow", status, key=(status, False))
+        return
+
+    # ---------- SPEED / VELOCITY ----------
+    now = time.time()
+    velocity = 0
+
+    live = price_velocity()
+
+    if live is not None:
+        velocity = live
+
+    elif LAST_LTP is not None and LAST_TIME is not None:
+
+        dt = now - LAST_TIME
+
+        if dt > 0:
+            velocity = abs(ltp - LAST_LTP) / dt
+
+    LAST_LTP = ltp
+    LAST_TIME = now
+
+    # ---------- ULTRA FLOW DETECTION (NO GAMMA REQUIRED) ----------
+
+    if relation == Relation.ABOVE and ltp > vwap_val:
+
+        if velocity > 0.6:
+            status = Flow.ULTRA_UP
+        elif velocity > 0.25:
+            status = Flow.PROBABLE
+
+    elif relation == Relation.BELOW and ltp < vwap_val:
+
+        if velocity > 0.6:
+            status = Flow.ULTRA_DOWN
+        elif velocity > 0.25:
+            status = Flow.PROBABLE
+
+    # ---------- GAMMA ACCELERATION FLAG ----------
+    accel = status != Flow.NONE and gamma_state in (Gamma.UP, Gamma.DOWN)
+
+    SIG.flow_accel = accel
+    emit("flow", status, key=(status, accel))
+# ================= OPENING SNIPER =================
+
+OPENING_DONE = False
+
+def opening_sniper(ltp):
+
+    global OPENING_DONE
+
+    if OPENING_DONE:
+        return
+
+    relation = SIG.relation
+    vwap_val = get_state("vwap")
+
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        return
+
+    sniper = "WAIT"
+
+    # ---- Opening bias logic ----
+    if relation == Relation.ABOVE and ltp > vwap_val:
+        sniper = "OPENING LONG SNIPER 🚀"
+
+    elif relation == Relation.BELOW and ltp < vwap_val:
+        sniper = "OPENING SHORT SNIPER 🔻"
+
+    ultra_write("N3", sniper)
+
+    OPENING_DONE = True
+
+
+# ==========================================================
+# ================= TRUE SNIPER MODE =================
+# ================= TRUE SNIPER MODE =================
+
+def true_sniper_mode():
+
+    predictive = SIG.predictive_gamma
+    relation = SIG.relation
+    vwap_val = get_state("vwap")
+    gamma = SIG.gamma
+    inst_flow = SIG.flow
+    god = SIG.god_signal
+    strong = SIG.floating_strength >= Strength.STRONG
+
+    sniper = Sniper.WAIT
+
+    try:
+        vwap_val = float(vwap_val)
+        ltp = float(read_signal("ltp"))
+    except:
+        emit("sniper", sniper)
+        return
+
+    # ================= PRIORITY ORDER =================
+
+    # ---- GOD MODE ----
+    if god == God.LONG:
+        sniper = Sniper.GOD_LONG
+
+    elif god == God.SHORT:
+        sniper = Sniper.GOD_SHORT
+
+    # ---- NEWS MODE ----
+    elif NEWS_MODE and relation==Relation.ABOVE and ltp > vwap_val:
+        sniper = Sniper.NEWS_LONG
+
+    elif NEWS_MODE and relation==Relation.BELOW and ltp < vwap_val:
+        sniper = Sniper.NEWS_SHORT
+
+    # ---- PREDICTIVE GAMMA ----
+    elif predictive == Predictive.IGNITION:
+
+        if relation==Relation.ABOVE and ltp > vwap_val:
+            sniper = Sniper.PREDICTIVE_LONG
+
+        elif relation==Relation.BELOW and ltp < vwap_val:
+            sniper = Sniper.PREDICTIVE_SHORT
+
+    # ---- EARLY SNIPER ----
+    elif (relation==Relation.ABOVE
+          and ltp > vwap_val
+          and strong
+          and inst_flow != Flow.NONE
+          and gamma != Gamma.TRAP):
+
+        sniper = Sniper.EARLY_LONG
+
+    elif (relation==Relation.BELOW
+          and ltp < vwap_val
+          and strong
+          and inst_flow != Flow.NONE
+          and gamma != Gamma.TRAP):
+
+        sniper = Sniper.EARLY_SHORT
+
+    # ---- TRUE SNIPER FULL ----
+    elif (relation==Relation.ABOVE
+          and ltp > vwap_val
+          and strong
+          and inst_flow != Flow.NONE
+          and gamma == Gamma.UP):
+
+        sniper = Sniper.LONG_READY
+
+    elif (relation==Relation.BELOW
+          and ltp < vwap_val
+          and strong
+          and inst_flow != Flow.NONE
+          and gamma == Gamma.DOWN):
+
+        sniper = Sniper.SHORT_READY
+
+    emit("sniper", sniper)
+
+
+
+# ================= SNIPER ANTI-TRAP FILTER =================
+
+def sniper_antitrap_filter():
+
+    block = Block.NONE
+
+    if SIG.gamma == Gamma.TRAP:
+        block = Block.PREMIUM_TRAP
+
+    elif SIG.target == Target.MAX_PAIN:
+        block = Block.MAGNET
+
+    elif SIG.flow == Flow.NONE:
+        block = Block.NO_FLOW
+
+    elif SIG.floating_strength == Strength.WEAKENING:
+        block = Block.WEAK
+
+    # unblocked, the cell mirrors the sniper call
+    emit("sniper_block", block, key=(block, SIG.sniper))
+
+
+# ================= AUTO SNIPER EXECUTION =================
+
+def auto_sniper_execution():
+
+    sniper_ready = SIG.sniper
+    sniper_block = SIG.sniper_block
+    gamma = SIG.gamma
+    flow = SIG.flow
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+    ltp = read_signal("ltp")
+
+    trend = SIG.trend
+    trend_regime = SIG.trend_regime
+    dark = SIG.dark
+
+    execution = "WAIT"
+
+    # ---------- SAFE CONVERSION ----------
+    try:
+        vwap_val = float(vwap_val)
+        ltp = float(ltp)
+    except:
+        ultra_write("N7", execution)
+        return
+
+    # ---------- BLOCK FILTER ----------
+    if sniper_block != Block.NONE:
+        ultra_write("N7", execution)
+        return
+
+    # =====================================================
+    # TRUE SNIPER EXECUTION (FULL CONFIRMATION)
+    # =====================================================
+
+    if (sniper_ready == Sniper.LONG_READY
+        and gamma == Gamma.UP
+        and flow != Flow.NONE
+        and relation == Relation.ABOVE
+        and ltp > vwap_val):
+
+        execution = "🔥 AUTO EXECUTE CE"
+
+    elif (sniper_ready == Sniper.SHORT_READY
+          and gamma == Gamma.DOWN
+          and flow != Flow.NONE
+          and relation == Relation.BELOW
+          and ltp < vwap_val):
+
+        execution = "🔻 AUTO EXECUTE PE"
+
+    # =====================================================
+    # TREND CONTINUATION ENGINE
+    # =====================================================
+
+    elif (trend == Trend.SHORT
+          and relation == Relation.BELOW
+          and ltp < vwap_val):
+
+        execution = "🔻 TREND AUTO PE"
+
+    elif (trend == Trend.LONG
+          and relation == Relation.ABOVE
+          and ltp > vwap_val):
+
+        execution = "🔥 TREND AUTO CE"
+
+    # =====================================================
+    # DEALER TREND INTELLIGENCE
+    # =====================================================
+
+    elif (trend_regime == Regime.DEALER_SHORT
+          and relation == Relation.BELOW
+          and ltp < vwap_val):
+
+        execution = "🔻 DEALER TREND PE"
+
+    elif (trend_regime == Regime.DEALER_LONG
+          and relation == Relation.ABOVE
+          and ltp > vwap_val):
+
+        execution = "🔥 DEALER TREND CE"
+
+    # =====================================================
+    # DARK POOL EARLY ENTRY
+    # =====================================================
+
+    elif (dark == Dark.SHORT_BUILD
+          and relation == Relation.BELOW
+          and ltp < vwap_val):
+
+        execution = "🌑 EARLY DARK PE ENTRY"
+
+    # ---------- FINAL WRITE ----------
+    ultra_write("N7", execution)
+# ================= ABSORPTION RADAR =================
+
+def absorption_radar_engine(ltp, oc):
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+
+    signal = "NO ABSORPTION"
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        ultra_write("N33", signal)
+        return
+
+    atm = atm_strike(ltp)
+
+    ce = oc.leg(atm, "ce")
+    pe = oc.leg(atm, "pe")
+
+    if not ce or not pe:
+        ultra_write("N33", signal)
+        return
+
+    ce_prem = ce.get("last_price",0)
+    pe_prem = pe.get("last_price",0)
+
+    ce_oi = ce.get("oi",0)
+    ce_prev = ce.get("previous_oi",0)
+
+    pe_oi = pe.get("oi",0)
+    pe_prev = pe.get("previous_oi",0)
+
+    # ---- Downside absorption ----
+    if (relation==Relation.BELOW
+        and pe_oi > pe_prev
+        and pe_prem <= pe.get("previous_close",0)):
+
+        signal="🟢 DOWNSIDE ABSORPTION"
+
+    # ---- Upside absorption ----
+    elif (relation==Relation.ABOVE
+          and ce_oi > ce_prev
+          and ce_prem <= ce.get("previous_close",0)):
+
+        signal="🔴 UPSIDE ABSORPTION"
+
+    ultra_write("N33", signal)
+# ================= LIQUIDITY VACUUM RADAR =================
+# ================= LIQUIDITY VACUUM RADAR =================
+
+LAST_LV_LTP = None
+
+def liquidity_vacuum_radar(ltp, oc):
+
+    global LAST_LV_LTP
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+
+    signal = "NO VACUUM"
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        ultra_write("N35", signal)
+        return
+
+    atm = atm_strike(ltp)
+
+    ce = oc.leg(atm, "ce")
+    pe = oc.leg(atm, "pe")
+
+    if not ce or not pe:
+        ultra_write("N35", signal)
+        return
+
+    # ---- PRICE ACCELERATION ----
+    accel = price_move()
+
+    if accel is None:
+        accel = abs(ltp - LAST_LV_LTP) if LAST_LV_LTP is not None else 0
+
+    LAST_LV_LTP = ltp
+
+    # ---- DOWN VACUUM ----
+    pe_prem_jump = pe.get("last_price",0) > pe.get("previous_close",0)*1.05
+    pe_oi_flat = abs(pe.get("oi",0) - pe.get("previous_oi",0)) < 1500
+
+    if (relation==Relation.BELOW
+        and ltp < vwap_val
+        and accel > 25
+        and pe_prem_jump
+        and pe_oi_flat):
+
+        signal="🔻 LIQUIDITY VACUUM DOWN"
+
+    # ---- UP VACUUM ----
+    ce_prem_jump = ce.get("last_price",0) > ce.get("previous_close",0)*1.05
+    ce_oi_flat = abs(ce.get("oi",0) - ce.get("previous_oi",0)) < 1500
+
+    if (relation==Relation.ABOVE
+        and ltp > vwap_val
+        and accel > 25
+        and ce_prem_jump
+        and ce_oi_flat):
+
+        signal="🚀 LIQUIDITY VACUUM UP"
+
+    ultra_write("N35", signal)
+
+# ================= INSTITUTIONAL BREAKOUT RADAR =================
+
+LAST_BREAK_LTP = None
+LAST_BREAK_TIME = None
+
+def breakout_radar_engine(ltp):
+
+    global LAST_BREAK_LTP, LAST_BREAK_TIME
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+
+    signal = "NO BREAKOUT"
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        ultra_write("N11", signal)
+        return
+
+    now = time.time()
+    velocity = 0
+
+    live = price_velocity()
+
+    if live is not None:
+        velocity = live
+
+    elif LAST_BREAK_LTP is not None and LAST_BREAK_TIME is not None:
+
+        dt = now - LAST_BREAK_TIME
 
         if dt > 0:
             velocity = abs(ltp - LAST_BREAK_LTP) / dt
 
-    LAST_BREAK_LTP = ltp
-    LAST_BREAK_TIME = now
+    LAST_BREAK_LTP = ltp
+    LAST_BREAK_TIME = now
+
+    # -------- INSTITUTIONAL BREAKOUT DETECTION --------
+
+    if relation == Relation.ABOVE and ltp > vwap_val:
+
+        if velocity > 0.7:
+            signal = "🔥 INSTITUTIONAL BREAKOUT UP"
+
+    elif relation == Relation.BELOW and ltp < vwap_val:
+
+        if velocity > 0.7:
+            signal = "🔻 INSTITUTIONAL BREAKOUT DOWN"
+
+    ultra_write("N11", signal)
+# ================= GAMMA ACCELERATION ENGINE =================
+
+def gamma_acceleration_engine():
+
+    accel = "NO ACCELERATION"
+
+    # acceleration conditions
+    if (SIG.floating_strength >= Strength.STRONG and
+    SIG.flow != Flow.NONE and
+    SIG.gamma != Gamma.TRAP):
+
+
+        if SIG.sniper == Sniper.LONG_READY:
+            accel = "🚀 GAMMA ACCELERATION UP"
+
+        elif SIG.sniper == Sniper.SHORT_READY:
+            accel = "🔻 GAMMA ACCELERATION DOWN"
+
+    ultra_write("N8", accel)
+# ================= DEALER TREND INTELLIGENCE =================
+
+TREND_REGIME = Regime.NONE
+
+def dealer_trend_intelligence(ltp):
+
+    global TREND_REGIME
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+    strong = SIG.floating_strength >= Strength.STRONG
+    gamma = SIG.gamma
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        emit("trend_regime", Regime.NONE)
+        return
+
+    regime = Regime.NONE
+
+    # ---- CPR FLIP DETECTION ----
+    prev_relation = get_state("prev_relation", Relation.NONE)
+
+    if prev_relation:
+
+        # ABOVE → BELOW flip
+        if prev_relation == Relation.ABOVE and relation == Relation.BELOW:
+            regime = Regime.DEALER_SHORT
+
+        # BELOW → ABOVE flip
+        elif prev_relation == Relation.BELOW and relation == Relation.ABOVE:
+            regime = Regime.DEALER_LONG
+
+    # ---- TREND CONTINUATION ----
+    elif (relation==Relation.BELOW
+          and ltp < vwap_val
+          and strong
+          and gamma != Gamma.TRAP):
+
+        regime=Regime.CONT_SHORT
+
+    elif (relation==Relation.ABOVE
+          and ltp > vwap_val
+          and strong
+          and gamma != Gamma.TRAP):
+
+        regime=Regime.CONT_LONG
+
+    TREND_REGIME = regime
+
+    set_state("prev_relation", relation)
+
+    emit("trend_regime", regime)
+# ================= TREND CONTINUATION ENGINE =================
+
+TREND_MEMORY = None
+
+def trend_continuation_engine(ltp):
+
+    global TREND_MEMORY
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+    strong = SIG.floating_strength >= Strength.STRONG
+    gamma = SIG.gamma
+
+    trend_signal = Trend.NONE
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        emit("trend", trend_signal)
+        return
+
+    # ---- Initialize memory ----
+    if TREND_MEMORY is None:
+        TREND_MEMORY = ltp
+        emit("trend", trend_signal)
+        return
+
+    # ---- TREND LOGIC ----
+
+    # PE TREND CONTINUATION
+    if (relation == Relation.BELOW
+        and ltp < vwap_val
+        and strong
+        and gamma != Gamma.TRAP
+        and ltp < TREND_MEMORY):
+
+        trend_signal = Trend.SHORT
+
+    # CE TREND CONTINUATION
+    elif (relation == Relation.ABOVE
+          and ltp > vwap_val
+          and strong
+          and gamma != Gamma.TRAP
+          and ltp > TREND_MEMORY):
+
+        trend_signal = Trend.LONG
+
+    TREND_MEMORY = ltp
+
+    emit("trend", trend_signal)
+# ================= DARK POOL ENTRY ENGINE =================
+
+LAST_DARK_PREM = None
+
+def dark_pool_entry_engine(ltp, oc):
+
+    global LAST_DARK_PREM
+
+    relation = SIG.relation
+    vwap_val = read_signal("vwap")
+    gamma = SIG.gamma
+
+    signal = Dark.NONE
+
+    try:
+        vwap_val = float(vwap_val)
+    except:
+        emit("dark", signal)
+        return
+
+    atm = atm_strike(ltp)
+
+    ce = oc.leg(atm, "ce")
+    pe = oc.leg(atm, "pe")
+
+    if not ce or not pe:
+        emit("dark", signal)
+        return
+
+    pe_prem = pe.get("last_price",0)
+    ce_oi = ce.get("oi",0)
+    ce_prev = ce.get("previous_oi",0)
+    pe_oi = pe.get("oi",0)
+    pe_prev = pe.get("previous_oi",0)
+
+    # ---- Memory ----
+    if LAST_DARK_PREM is None:
+        LAST_DARK_PREM = pe_prem
+        emit("dark", signal)
+        return
+
+    prem_rising = pe_prem > LAST_DARK_PREM
+    ce_building = ce_oi >= ce_prev
+    pe_not_exploding = abs(pe_oi - pe_prev) < 2000
+
+    # ---- PE DARK ENTRY ----
+    if (relation==Relation.BELOW
+        and ltp < vwap_val
+        and prem_rising
+        and ce_building
+        and pe_not_exploding
+        and gamma != Gamma.TRAP):
+
+        signal=Dark.SHORT_BUILD
+
+    LAST_DARK_PREM = pe_prem
+
+    emit("dark", signal)
+# ================= FLOATING PIVOT PRO ENGINE =================
+
+option_ranges = {}
+
+def floating_pivot(high, low, ltp):
+
+    p = (high + low + ltp)/3
+    rng = high - low
+
+    wp = (2*p) - high
+    t1 = (2*p) - low
+    t2 = p + rng
+    t3 = high + 2*(p-low)
+
+    if ltp > t1:
+        status = Strength.SUPER_STRONG
+    elif wp < ltp <= t1:
+        status = Strength.STRONG
+    elif p < ltp <= wp:
+        status = Strength.WEAKENING
+    else:
+        status = Strength.INVALIDATED
+
+    return p, wp, t1, t2, t3, status
+
+
+
+# ================= STREAMING INDICATORS =================
+
+# Indicator state advances one closed bar at a time, so a tick costs the
+# bars that closed since the last one, not a pass over the session. The
+# forming bar is only peeked: peek() returns the value as if it closed at
+# the current price, without committing it.
+
+INDICATOR_FILE = os.getenv("INDICATOR_FILE", "indicators.json")
+INDICATOR_SAVE_SEC = float(os.getenv("INDICATOR_SAVE_SEC", "60"))
+
+
+class Indicator:
+
+    __slots__ = ()
+
+    def state(self):
+        return {k: list(v) if isinstance(v, deque) else v for k,v in ((k, getattr(self, k)) for k in self.__slots__)}
+
+    @classmethod
+    def restore(cls, state):
+
+        ind = cls.__new__(cls)
+
+        for k in cls.__slots__:
+            setattr(ind, k, state[k])
+
+        return ind
+
+
+class EMA(Indicator):
+
+    __slots__ = ("period","value")
+
+    def __init__(self, period):
+        self.period, self.value = period, None
+
+    def step(self, bar):
+        c = bar["close"]
+        return c if self.value is None else self.value + (c - self.value) * 2/(self.period+1)
+
+    def update(self, bar):
+        self.value = self.step(bar)
+
+    def peek(self, bar):
+        return self.step(bar)
+
+
+class SMA(Indicator):
+
+    __slots__ = ("period","window","total")
+
+    def __init__(self, period):
+        self.period, self.window, self.total = period, deque(), 0.0
+
+    def update(self, bar):
+
+        self.window.append(bar["close"])
+        self.total += bar["close"]
+
+        if len(self.window) > self.period:
+            self.total -= self.window.popleft()
+
+    def peek(self, bar):
+
+        if not self.window:
+            return bar["close"]
+
+        drop = self.window[0] if len(self.window) >= self.period else 0
+        return (self.total - drop + bar["close"]) / min(len(self.window)+1, self.period)
+
+    @classmethod
+    def restore(cls, state):
+        ind = super().restore(state)
+        ind.window = deque(ind.window)
+        return ind
+
+
+class VWAP(Indicator):
+
+    # running Σpv, Σv and Σp²v: mean and volume-weighted σ in O(1)
+    __slots__ = ("pv","v","p2v")
+
+    def __init__(self):
+        self.pv, self.v, self.p2v = 0.0, 0.0, 0.0
+
+    def update(self, bar):
+        c, v = bar["close"], bar["volume"]
+        self.pv += c*v
+        self.v += v
+        self.p2v += c*c*v
+
+    def bands(self, bar):
+
+        # (vwap, sigma) with the forming bar included; None without volume
+        c, v = bar["close"], bar["volume"]
+        total = self.v + v
+
+        if not total:
+            return None, None
+
+        mean = (self.pv + c*v) / total
+
+        return mean, math.sqrt(max((self.p2v + c*c*v)/total - mean*mean, 0))
+
+    def peek(self, bar):
+        return self.bands(bar)[0]
+
+
+class ATR(Indicator):
+
+    # Wilder: simple mean of the first `period` true ranges, then smoothed
+    __slots__ = ("period","value","n","prev_close")
+
+    def __init__(self, period):
+        self.period, self.value, self.n, self.prev_close = period, 0.0, 0, None
+
+    def step(self, bar):
+
+        h, l = bar["high"], bar["low"]
+        tr = h - l if self.prev_close is None else max(h - l, abs(h - self.prev_close), abs(l - self.prev_close))
+
+        n = min(self.n + 1, self.period)
+        return self.value + (tr - self.value) / n
+
+    def update(self, bar):
+        self.value = self.step(bar)
+        self.n += 1
+        self.prev_close = bar["close"]
+
+    def peek(self, bar):
+        return self.step(bar)
+
+
+class RSI(Indicator):
+
+    __slots__ = ("period","gain","loss","n","prev_close")
+
+    def __init__(self, period):
+        self.period, self.gain, self.loss, self.n, self.prev_close = period, 0.0, 0.0, 0, None
+
+    def step(self, bar):
+
+        if self.prev_close is None:
+            return self.gain, self.loss
+
+        d = bar["close"] - self.prev_close
+        n = min(self.n + 1, self.period)
+
+        return self.gain + (max(d, 0) - self.gain)/n, self.loss + (max(-d, 0) - self.loss)/n
+
+    def update(self, bar):
+
+        if self.prev_close is not None:
+            self.gain, self.loss = self.step(bar)
+            self.n += 1
+
+        self.prev_close = bar["close"]
+
+    def peek(self, bar):
+
+        gain, loss = self.step(bar)
+
+        # no change seen yet (or only flat ones): neutral, not overbought
+        if not gain and not loss:
+            return 50.0
+
+        return 100.0 if not loss else 100 - 100/(1 + gain/loss)
+
+
+INDICATOR_KINDS = {cls.__name__: cls for cls in (EMA, SMA, VWAP, ATR, RSI)}
+
+# name -> factory; a series only builds the names its panels ask for
+INDICATOR_SPECS = {
+    "ema9": lambda: EMA(9), "ema21": lambda: EMA(21), "sma20": lambda: SMA(20),
+    "vwap": VWAP, "atr14": lambda: ATR(14), "rsi14": lambda: RSI(14)
+}
+
+
+class IndicatorSeries:
+
+    # the indicators of one security id on 1-minute bars
+    __slots__ = ("day","last","bars","ind")
+
+    def __init__(self, day):
+        self.day, self.last, self.bars, self.ind = day, None, 0, {}
+
+    def require(self, names, candles):
+
+        # an indicator asked for the first time catches up on the bars the
+        # series already committed
+        stamps = candles["timestamp"]
+        done = bisect.bisect_right(stamps, self.last) if stamps and self.last is not None else self.bars
+
+        for name in names:
+
+            if name in self.ind:
+                continue
+
+            ind = self.ind[name] = INDICATOR_SPECS[name]()
+
+            for i in range(done):
+                ind.update({k: candles[k][i] for k in CANDLE_FIELDS})
+
+    def advance(self, candles):
+
+        # commit every closed bar since the last call; the final bar is
+        # still forming
+        stamps = candles["timestamp"]
+
+        start = bisect.bisect_right(stamps, self.last) if stamps and self.last is not None else self.bars
+
+        for i in range(start, len(candles["close"]) - 1):
+
+            bar = {k: candles[k][i] for k in CANDLE_FIELDS}
+
+            for ind in self.ind.values():
+                ind.update(bar)
+
+            self.bars = i + 1
+            self.last = stamps[i] if stamps else None
+
+    def peek(self, name, candles):
+        return self.ind[name].peek({k: candles[k][-1] for k in CANDLE_FIELDS})
+
+    def state(self):
+        return {"day": self.day, "last": self.last, "bars": self.bars,
+                "ind": {k: [type(v).__name__, v.state()] for k,v in self.ind.items()}}
+
+    @classmethod
+    def restore(cls, state):
+
+        series = cls(state["day"])
+        series.last, series.bars = state["last"], state["bars"]
+        series.ind = {k: INDICATOR_KINDS[kind].restore(s) for k,(kind,s) in state["ind"].items()}
+
+        return series
+
+
+# security_id -> IndicatorSeries, shared by every underlying; the candle
+# store only holds 1-minute bars, so that is the only timeframe
+INDICATORS = {}
+INDICATORS_SAVED = 0.0
+
+def indicators(security_id, names):
+
+    # names advanced to the latest candles; None while the leg has no candles
+    candles = fetch_candles(security_id)
+
+    if not candles or not candles["close"]:
+        return None, None
+
+    key = str(security_id)
+    series = INDICATORS.get(key)
+
+    if series is None or series.day != candles["day"]:
+        series = INDICATORS[key] = IndicatorSeries(candles["day"])
+
+    series.require(names, candles)
+    series.advance(candles)
+
+    return series, candles
+
+
+def load_indicators():
+
+    # candle days are IST dates
+    today = ist_today().isoformat()
+
+    try:
+        with open(INDICATOR_FILE) as f:
+            saved = json.load(f)
+
+        for key,state in saved.items():
+
+            if state["day"] == today:
+                # snapshots before the timeframe was dropped: "sid|1"
+                INDICATORS[key.split("|")[0]] = IndicatorSeries.restore(state)
+
+        print("INDICATORS LOADED:", len(INDICATORS))
+
+    except (OSError, ValueError, KeyError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print("INDICATOR SNAPSHOT IGNORED:", e)
+
+
+def save_indicators(now):
+
+    global INDICATORS_SAVED
+
+    if now - INDICATORS_SAVED < INDICATOR_SAVE_SEC or not INDICATORS:
+        return
+
+    INDICATORS_SAVED = now
+
+    try:
+        tmp = INDICATOR_FILE + ".tmp"
+
+        with open(tmp, "w") as f:
+            json.dump({k: v.state() for k,v in list(INDICATORS.items())}, f)
+
+        os.replace(tmp, INDICATOR_FILE)
+
+    except OSError as e:
+        print("INDICATOR SNAPSHOT ERROR:", e)
+
+
+load_indicators()
+
+
+# ================= GAMMA DEALER ENGINE =================
+
+def gamma_filter(atm, decision, oc):
+
+    try:
+
+        # find ATM index
+        idx = oc.find(atm)
+
+        if idx is None:
+            raise ValueError(f"{atm} not in chain")
+
+        nearby = slice(max(0,idx-2), idx+3)
+
+        side = oc.side(decision)
+        ok = side["ok"][nearby]
+
+        oi_change_total = float((side["oi"][nearby] - side["previous_oi"][nearby])[ok].sum())
+        premium_speed = float((side["last_price"][nearby] - side["previous_close"][nearby])[ok].sum())
+
+        # ----- Decision Logic -----
+
+        if premium_speed > 0 and oi_change_total < 0:
+            return "GAMMA BLAST 🚀"
+
+        elif premium_speed > 0 and oi_change_total > 0:
+            return "DEALER TRAP ⚠️"
+
+        else:
+            return "NEUTRAL FLOW"
+
+    except Exception as e:
+        print("GAMMA ERROR:",e)
+
+    return "UNKNOWN"
+
+
+# ================= STRIKE SELECTOR =================
+
+# ================= STRIKE SELECTOR =================
+
+option_high_low = {}
+
+# ---------- TRUE SESSION OHLC (FROM 9:15 AM) ----------
+def get_session_range(security_id):
+
+    try:
+
+        bars = fetch_candles(security_id) or {}
+
+        highs = bars.get("high",[])
+        lows  = bars.get("low",[])
+
+        if not highs or not lows:
+            return None,None
+
+        return max(highs),min(lows)
+
+    except Exception as e:
+        print("SESSION RANGE ERROR:",e)
+
+    return None,None
+
+
+# ---------- SMART RANGE ENGINE ----------
+def update_range(key_name, session_high, session_low, ltp):
+
+    if key_name not in option_high_low:
+
+        option_high_low[key_name] = {
+            "session_high": session_high if session_high else ltp,
+            "session_low": session_low if session_low else ltp,
+            "micro_high": ltp,
+            "micro_low": ltp
+        }
+
+    r = option_high_low[key_name]
+
+    r["micro_high"] = max(r["micro_high"], ltp)
+    r["micro_low"]  = min(r["micro_low"], ltp)
+
+    high = max(r["session_high"], r["micro_high"])
+    low  = min(r["session_low"], r["micro_low"])
+
+    return high, low
+
+# ================= UNIVERSAL STRIKE ENGINE (AUTO + MANUAL) =================
+
+def process_strike_floating(strike, side, oc, sheet_range):
+
+    opt = oc.leg(strike, side)
+
+    if not opt:
+        return None
+
+    ltp_opt = opt["last_price"]
+    security_id = opt["security_id"]
+
+    key_name = f"{strike}_{side}"
+
+    session_high, session_low = get_session_range(security_id)
+
+    high, low = update_range(key_name, session_high, session_low, ltp_opt)
+
+    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+
+    gamma_status = gamma_filter(strike, side, oc)
+
+    ultra_write_range(
+        sheet_range,
+        [[f"{strike} {side}", ltp_opt,
+          round(p,2), round(wp,2),
+          round(t1,2), round(t2,2),
+          round(t3,2), label(status) + " | " + gamma_status]]
+    )
+
+    return status
+
+# ---------- AUTO STRIKE ----------
+def auto_strike_floating(ltp, oc):
+
+    relation = SIG.relation
+
+    if relation == Relation.ABOVE:
+        decision = Side.CE
+    elif relation == Relation.BELOW:
+        decision = Side.PE
+    else:
+        return
+
+    atm = atm_strike(ltp)
+
+    status = process_strike_floating(atm, decision.name, oc, "A17:H17")
+
+    if status is not None:
+        SIG.floating_strength = status
+        emit("floating", decision, key=(decision, status))
+
+
+# ---------- MANUAL STRIKE ----------
+def manual_strike():
+
+    manual = safe("A23")
+
+    if not manual:
+        return None
+
+    try:
+        strike = int(manual.split()[0])
+        side = manual.split()[1].upper()
+    except:
+        return None
+
+    return strike, side
+
+
+def manual_strike_floating(oc):
+
+    manual = manual_strike()
+
+    if not manual:
+        return
+
+    strike, side = manual
+
+    process_strike_floating(strike, side, oc, "A23:H23")
+
+
+# ================= EMA SCALP ENGINE =================
+
+def process_strike_ema_scalp(strike, side, oc, sheet_range):
+
+    opt = oc.leg(strike, side)
+
+    if not opt:
+        return
+
+    security_id = opt["security_id"]
+
+    # ---- DEFAULT EMA STATUS ----
+    ema_status = "NO INTRADAY DATA"
+
+    try:
+
+        series, candles = indicators(security_id, ("ema9", "ema21"))
+
+        # Only calculate EMA if enough candles exist
+        if series and len(candles["close"]) >= 30:
+
+            # previous = last closed bar, now = forming bar
+            ema9_prev, ema21_prev = series.ind["ema9"].value, series.ind["ema21"].value
+            ema9, ema21 = series.peek("ema9", candles), series.peek("ema21", candles)
+
+            if ema9 > ema21 and ema9_prev <= ema21_prev:
+                ema_status = "EMA CROSS UP 🚀"
+
+            elif ema9 < ema21 and ema9_prev >= ema21_prev:
+                ema_status = "EMA CROSS DOWN 🔻"
+
+            else:
+                ema_status = "EMA NEUTRAL"
+
+    except Exception as e:
+        print("EMA SCALP ERROR:", e)
+
+
+    # ---- ALWAYS CALCULATE FLOATING PIVOT ----
+    ltp_opt = opt["last_price"]
+
+    high, low = ltp_opt, ltp_opt
+
+    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+
+    ultra_write_range(
+        sheet_range,
+        [[f"{strike} {side}",
+          ltp_opt,
+          round(wp,2),
+          round(p,2),
+          round(t1,2),
+          round(t2,2),
+          round(t3,2),
+          label(status),
+          ema_status]]
+    )
+# ================= EMA COMPRESSION DETECTOR =================
+
+def process_strike_ema_compression(strike, side, oc, sheet_range):
+
+    opt = oc.leg(strike, side)
+
+    if not opt:
+        return
+
+    security_id = opt["security_id"]
+
+    # ---- DEFAULT STATUS ----
+    compression_status = "NO INTRADAY DATA"
+
+    try:
+
+        series, candles = indicators(security_id, ("ema9", "ema21"))
+
+        if series and len(candles["close"]) >= 40:
+
+            dist_now = abs(series.peek("ema9", candles) - series.peek("ema21", candles))
+            dist_prev = abs(series.ind["ema9"].value - series.ind["ema21"].value)
+
+            compression_status = "NO COMPRESSION"
+
+            if dist_now < 0.5 and dist_now < dist_prev:
+                compression_status = "⚡ EMA COMPRESSION BUILDING"
+
+            elif dist_now < 0.3:
+                compression_status = "🔥 TIGHT COMPRESSION"
+
+    except Exception as e:
+        print("EMA COMPRESSION ERROR:", e)
+
+
+    # ---- ALWAYS CALCULATE FLOATING PIVOT ----
+    ltp_opt = opt["last_price"]
+
+    high, low = ltp_opt, ltp_opt
+
+    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+
+    ultra_write_range(
+        sheet_range,
+        [[f"{strike} {side}",
+          ltp_opt,
+          round(wp,2),
+          round(p,2),
+          round(t1,2),
+          round(t2,2),
+          round(t3,2),
+          label(status),
+          compression_status]]
+    )
+# ================= DEALER GAMMA ENGINE v6 =================
+
+def institutional_strike_selector(ltp, oc):
+
+    atm = atm_strike(ltp)
+
+    step = UNDERLYING["step"]
+
+    candidate_strikes = [atm+n*step for n in range(-2, 3)]
+
+    best_ce = None
+    best_pe = None
+
+    best_ce_score = -999999
+    best_pe_score = -999999
+
+    atm_ce = oc.leg(atm, "ce")
+    atm_iv = atm_ce["iv"] if atm_ce else 0
+
+    for strike in candidate_strikes:
+
+        for side in ["ce","pe"]:
+
+            opt = oc.leg(strike, side)
+            if not opt:
+                continue
+
+            oi = opt["oi"]
+            oi_change = opt["oi_change"]
+            delta = abs(opt["delta"])
+            iv = opt["iv"]
+
+            gamma_proxy = oi_change * delta
+            iv_edge = iv - atm_iv
+
+            score = (oi*0.5)+(gamma_proxy*0.3)+(iv_edge*0.2)
+
+            if side=="ce" and score>best_ce_score:
+                best_ce_score=score
+                best_ce=strike
+
+            if side=="pe" and score>best_pe_score:
+                best_pe_score=score
+                best_pe=strike
+
+    return best_ce,best_pe
+def institutional_floating(strike, side, oc, sheet_row):
+
+    opt=oc.leg(strike,side)
+
+    if not opt:
+        return None
+
+    ltp_opt=opt["last_price"]
+    security_id=opt["security_id"]
+
+    key_name=f"{strike}_{side}_INST"
+
+    if key_name not in option_high_low:
+
+        high,low=get_session_range(security_id)
+
+        if high and low:
+            option_high_low[key_name]={"high":high,"low":low}
+        else:
+            option_high_low[key_name]={"high":ltp_opt,"low":ltp_opt}
+
+    option_high_low[key_name]["high"]=max(option_high_low[key_name]["high"],ltp_opt)
+    option_high_low[key_name]["low"]=min(option_high_low[key_name]["low"],ltp_opt)
+
+    high=option_high_low[key_name]["high"]
+    low=option_high_low[key_name]["low"]
+
+    p,wp,t1,t2,t3,status=floating_pivot(high,low,ltp_opt)
+
+    ultra_write_range(
+        f"{sheet_row}:H{sheet_row[1:]}",
+        [[f"{strike} {side}",ltp_opt,
+          round(p,2),round(wp,2),
+          round(t1,2),round(t2,2),
+          round(t3,2),label(status)]]
+    )
+
+    return status
+
+# ================= 3 LAYER DECISION ENGINE =================
+
+def decision_engine():
+
+    auto = SIG.floating
+    inst = SIG.inst_floating
+    gamma = SIG.gamma
+
+    # ---- BUY CE ----
+    if auto == inst == Side.CE and gamma != Gamma.TRAP:
+        decision = Decision.CE_BUY
+
+    # ---- BUY PE ----
+    elif auto == inst == Side.PE and gamma != Gamma.TRAP:
+        decision = Decision.PE_BUY
+
+    else:
+        decision = Decision.CONFLICT
+
+    emit("decision", decision)
+# ================= SCALP MODE V3 SMART + GAMMA ACCEL + LIQUIDITY VACUUM =================
+
+LAST_CE_PREM = None
+LAST_PE_PREM = None
+
+def scalp_mode_v2(ltp, oc):
+
+    global LAST_LTP, PREV_LTP, LAST_CE_PREM, LAST_PE_PREM
+
+    relation = SIG.relation
+    vwap_val = STATE.get("vwap")
+    bc = STATE.get("bc")
+    tc = STATE.get("tc")
+
+    signal = ""
+    strike = ""
+
+    # ---- SAFE CHECK ----
+    try:
+        vwap_val = float(vwap_val)
+        bc = float(bc)
+        tc = float(tc)
+    except:
+        ultra_write("C12","")
+        ultra_write("C21","")
+        return
+
+    if LAST_LTP is None:
+        LAST_LTP = ltp
+        return
+
+    atm = atm_strike(ltp)
+
+    if oc.find(atm) is not None:
+
+        ce = oc.leg(atm, "ce")
+        pe = oc.leg(atm, "pe")
+
+        gamma_accel_up = False
+        gamma_accel_down = False
+
+        liquidity_vacuum_up = False
+        liquidity_vacuum_down = False
+
+        # ---- Gamma Acceleration ----
+        if ce and LAST_CE_PREM:
+            if ce.get("last_price",0) > LAST_CE_PREM * 1.05:
+                gamma_accel_up = True
+
+        if pe and LAST_PE_PREM:
+            if pe.get("last_price",0) > LAST_PE_PREM * 1.05:
+                gamma_accel_down = True
+
+        # ---- Liquidity Vacuum Detection ----
+        if ce:
+            ce_prem_jump = ce.get("last_price",0) > ce.get("previous_close",0) * 1.03
+            ce_oi_flat = abs(ce.get("oi",0) - ce.get("previous_oi",0)) < 1000
+            if ce_prem_jump and ce_oi_flat:
+                liquidity_vacuum_up = True
+
+        if pe:
+            pe_prem_jump = pe.get("last_price",0) > pe.get("previous_close",0) * 1.03
+            pe_oi_flat = abs(pe.get("oi",0) - pe.get("previous_oi",0)) < 1000
+            if pe_prem_jump and pe_oi_flat:
+                liquidity_vacuum_down = True
+
+        # ---------- PE SMART SCALP ----------
+        if relation == Relation.BELOW and ltp < vwap_val and ltp < LAST_LTP:
+
+            if pe and ce:
+
+                pe_oi_up = pe.get("oi",0) > pe.get("previous_oi",0)
+                ce_unwind = ce.get("oi",0) < ce.get("previous_oi",0)
+
+                premium_expand = pe.get("last_price",0) > pe.get("previous_close",0)
+
+                if (pe_oi_up or ce_unwind) and \
+                   (premium_expand or gamma_accel_down or liquidity_vacuum_down):
+
+                    signal = "🔻 PE SMART SCALP"
+                    strike = f"{atm} PE"
+
+        # ---------- CE SMART SCALP ----------
+        elif relation == Relation.ABOVE and ltp > vwap_val and ltp > LAST_LTP:
+
+            if ce and pe:
+
+                ce_oi_up = ce.get("oi",0) > ce.get("previous_oi",0)
+                pe_unwind = pe.get("oi",0) < pe.get("previous_oi",0)
+
+                premium_expand = ce.get("last_price",0) > ce.get("previous_close",0)
+
+                if (ce_oi_up or pe_unwind) and \
+                   (premium_expand or gamma_accel_up or liquidity_vacuum_up):
+
+                    signal = "🔺 CE SMART SCALP"
+                    strike = f"{atm} CE"
+
+        # ---- Update premium memory ----
+        if ce:
+            LAST_CE_PREM = ce.get("last_price",0)
+
+        if pe:
+            LAST_PE_PREM = pe.get("last_price",0)
+
+    # ====================================================
+    # INSIDE CPR DEFENSE MODE
+    # ====================================================
+
+    if relation == Relation.INSIDE:
+
+        if abs(ltp - bc) <= 20 and ltp > LAST_LTP:
+            signal = "🔵 CE DEFENSE SCALP"
+            strike = f"{atm} CE"
+
+        elif abs(ltp - tc) <= 20 and ltp < LAST_LTP:
+            signal = "🔴 PE DEFENSE SCALP"
+            strike = f"{atm} PE"
+
+    # ====================================================
+    # WRITE OR AUTO CLEAR
+    # ====================================================
+
+    if signal:
+
+        pivot_weak = round(ltp*0.75,2)
+        entry = round(ltp*0.5,2)
+        t1 = round(ltp*1.3,2)
+        t2 = round(ltp*1.6,2)
+        t3 = round(ltp*2.1,2)
+
+        ultra_write("C12", signal)
+        ultra_write("C21", strike)
+        ultra_write("D21", ltp)
+        ultra_write("E21", pivot_weak)
+        ultra_write("F21", entry)
+        ultra_write("G21", t1)
+        ultra_write("H21", t2)
+        ultra_write("I21", t3)
+        ultra_write("J21", "SCALP ACTIVE")
+
+    else:
+
+        ultra_write("C12","")
+        ultra_write("C21","")
+        ultra_write("D21","")
+        ultra_write("E21","")
+        ultra_write("F21","")
+        ultra_write("G21","")
+        ultra_write("H21","")
+        ultra_write("I21","")
+        ultra_write("J21","")
+
+    PREV_LTP = LAST_LTP
+    LAST_LTP = ltp
+
+# ================= TRADE STORE (LOCAL SQLITE) =================
+
+# trades.db is the source of truth for trade management,
+# the TRADE_LOG sheet is a view mirrored by a background thread
+
+TRADE_DB_PATH = os.getenv("TRADE_DB_PATH", "trades.db")
+
+TRADE_DB = sqlite3.connect(TRADE_DB_PATH, check_same_thread=False, isolation_level=None)
+TRADE_DB_LOCK = threading.Lock()
+
+# totals kept before the priced count booked unpriced exits at pnl 0:
+# dropped here and rebuilt from trades by load_performance()
+if "priced" not in [c[1] for c in TRADE_DB.execute("PRAGMA table_info(perf_totals)")]:
+    TRADE_DB.executescript("DROP TABLE IF EXISTS perf_totals; DROP TABLE IF EXISTS perf_source_totals;")
+
+TRADE_DB.executescript("""
+PRAGMA journal_mode=WAL;
+
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY,
+    strike TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    entry_price REAL,
+    pivot REAL,
+    t1 REAL,
+    t3 REAL,
+    entry_time TEXT,
+    exit_reason TEXT NOT NULL DEFAULT '',
+    exit_time TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'ACTIVE',
+    locked INTEGER NOT NULL DEFAULT 0,
+    sheet_row INTEGER,
+    version INTEGER NOT NULL DEFAULT 1,
+    mirrored_version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS trades_strike ON trades(strike);
+CREATE INDEX IF NOT EXISTS trades_status ON trades(status);
+
+-- one row per underlying; the single-row tables of earlier releases
+-- mixed every underlying's trades and are rebuilt from trades instead
+DROP TABLE IF EXISTS perf_stats;
+DROP TABLE IF EXISTS perf_sources;
+
+CREATE TABLE IF NOT EXISTS perf_totals (
+    underlying TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    losses INTEGER NOT NULL,
+    priced INTEGER NOT NULL,
+    pnl REAL NOT NULL,
+    win_pnl REAL NOT NULL,
+    loss_pnl REAL NOT NULL,
+    equity_peak REAL NOT NULL,
+    max_drawdown REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS perf_source_totals (
+    underlying TEXT NOT NULL,
+    source TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    pnl REAL NOT NULL,
+    PRIMARY KEY (underlying, source)
+);
+""")
+
+# ---- columns added after the first release of the store ----
+for col,typ in [("source","TEXT NOT NULL DEFAULT ''"), ("exit_price","REAL"), ("pnl","REAL"),
+                ("underlying","TEXT NOT NULL DEFAULT ''")]:
+    if col not in [c[1] for c in TRADE_DB.execute("PRAGMA table_info(trades)")]:
+        TRADE_DB.execute(f"ALTER TABLE trades ADD COLUMN {col} {typ}")
+
+# trades from single-underlying runs belong to the D1 underlying
+TRADE_DB.execute("UPDATE trades SET underlying=? WHERE underlying=''", (UNDERLYING["name"],))
+
+# exits without a price used to be stored as pnl 0
+TRADE_DB.execute("UPDATE trades SET pnl=NULL WHERE exit_price IS NULL AND status!='ACTIVE'")
+
+def trade_db(sql, args=()):
+
+    with TRADE_DB_LOCK:
+        return TRADE_DB.execute(sql, args).fetchall()
+
+
+def open_trade(row, locked=False, source=""):
+
+    # row = A..I of the panel row, B = premium, C/E/G hold pivot/T1/T3
+    row = (list(row) + [""]*9)[:9]
+
+    entry_time = datetime.datetime.now().strftime("%H:%M:%S")
+
+    with TRADE_DB_LOCK:
+
+        trade_id = TRADE_DB.execute(
+            "INSERT INTO trades (strike,row_json,entry_price,pivot,t1,t3,entry_time,locked,source,underlying)"
+            " VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (str(row[0]), json.dumps(row), to_float(row[1]), to_float(row[2]),
+             to_float(row[4]), to_float(row[6]), entry_time, int(locked), source, UNDERLYING["name"])
+        ).lastrowid
+
+    TRADE_MIRROR.put(trade_id)
+
+    return trade_id
+
+
+def close_trade(trade_id, exit_reason, exit_price=None):
+
+    exit_time = datetime.datetime.now().strftime("%H:%M:%S")
+    result = "WIN" if "T3" in exit_reason else "LOSS"
+
+    with TRADE_DB_LOCK:
+
+        rows = TRADE_DB.execute(
+            "SELECT entry_price,source,underlying FROM trades WHERE id=? AND status='ACTIVE'", (trade_id,)
+        ).fetchall()
+
+        if not rows:
+            return
+
+        entry_price, source, underlying = rows[0]
+
+        # unknown exit (leg not in the chain): counted, but not priced
+        pnl = exit_price - entry_price if None not in (exit_price, entry_price) else None
+
+        # trade row + running aggregates commit together
+        TRADE_DB.execute("BEGIN IMMEDIATE")
+
+        try:
+
+            TRADE_DB.execute(
+                "UPDATE trades SET exit_reason=?, exit_time=?, status=?, exit_price=?, pnl=?,"
+                " version=version+1 WHERE id=?",
+                (exit_reason, exit_time, result, exit_price, pnl, trade_id)
+            )
+
+            perf, src = record_closed_trade(underlying, result, pnl, source)
+
+            TRADE_DB.execute("COMMIT")
+
+        except Exception:
+
+            TRADE_DB.execute("ROLLBACK")
+            raise
+
+        # in memory only once the store has it
+        apply_closed_trade(underlying, source, perf, src)
+
+    # L2-L9 refresh on this, not on a timer
+    publish("trade_closed", trade_id)
+
+    TRADE_MIRROR.put(trade_id)
+
+
+def strike_logged(strike):
+
+    return bool(trade_db(
+        "SELECT 1 FROM trades WHERE strike=? AND underlying=? LIMIT 1", (str(strike), UNDERLYING["name"])
+    ))
+
+
+def exit_rule(ltp, pivot_weak, t1, t3):
+
+    if None in (pivot_weak, t1, t3):
+        return ""
+
+    if ltp >= t3:
+        return "EXIT DUE T3"
+
+    elif ltp < pivot_weak:
+        return "EXIT PIVOT BREAK"
+
+    elif ltp < t1:
+        return "EXIT BELOW T1"
+
+    return ""
+
+
+def leg_price(oc, label):
+
+    # "24500 CE" -> current premium of that leg in the chain
+    try:
+        strike, side = str(label).split()[:2]
+        opt = oc.leg(float(strike), side)
+    except (TypeError, ValueError):
+        return None
+
+    return opt["last_price"] if opt else None
+
+
+# ================= RUNNING PERFORMANCE AGGREGATES =================
+
+# updated in O(1) per closed trade, persisted in perf_totals /
+# perf_source_totals; keyed by underlying, so each tab shows its own
+
+# priced: closed trades with a known pnl, the base of the pnl figures
+PERF_ZERO = {
+    "total": 0, "wins": 0, "losses": 0, "priced": 0,
+    "pnl": 0.0, "win_pnl": 0.0, "loss_pnl": 0.0,
+    "equity_peak": 0.0, "max_drawdown": 0.0
+}
+
+# underlying -> totals, underlying -> {source: totals}
+PERF = {}
+PERF_SOURCES = {}
+
+def record_closed_trade(underlying, result, pnl, source):
+
+    # caller holds TRADE_DB_LOCK inside an open transaction; works on
+    # copies and returns them, the caller applies them once it committed
+    perf = dict(PERF.get(underlying, PERF_ZERO))
+
+    perf["total"] += 1
+    perf["wins" if result == "WIN" else "losses"] += 1
+
+    if pnl is not None:
+
+        perf["priced"] += 1
+        perf["win_pnl" if result == "WIN" else "loss_pnl"] += pnl
+
+        perf["pnl"] += pnl
+        perf["equity_peak"] = max(perf["equity_peak"], perf["pnl"])
+        perf["max_drawdown"] = max(perf["max_drawdown"], perf["equity_peak"] - perf["pnl"])
+
+    src = dict(PERF_SOURCES.get(underlying, {}).get(source, {"total": 0, "wins": 0, "pnl": 0.0}))
+
+    src["total"] += 1
+    src["wins"] += result == "WIN"
+    src["pnl"] += pnl or 0.0
+
+    TRADE_DB.execute(
+        "INSERT OR REPLACE INTO perf_totals VALUES"
+        " (:underlying,:total,:wins,:losses,:priced,:pnl,:win_pnl,:loss_pnl,:equity_peak,:max_drawdown)",
+        dict(perf, underlying=underlying)
+    )
+    TRADE_DB.execute(
+        "INSERT OR REPLACE INTO perf_source_totals VALUES (?,?,?,?,?)",
+        (underlying, source, src["total"], src["wins"], src["pnl"])
+    )
+
+    return perf, src
+
+
+def apply_closed_trade(underlying, source, perf, src):
+
+    PERF[underlying] = perf
+    PERF_SOURCES.setdefault(underlying, {})[source] = src
+
+
+def load_performance():
+
+    with TRADE_DB_LOCK:
+
+        stats = TRADE_DB.execute(
+            "SELECT underlying,total,wins,losses,priced,pnl,win_pnl,loss_pnl,equity_peak,max_drawdown FROM perf_totals"
+        ).fetchall()
+
+        if stats:
+
+            for underlying,*row in stats:
+                PERF[underlying] = dict(zip(PERF_ZERO.keys(), row))
+
+            for underlying,source,total,wins,pnl in TRADE_DB.execute("SELECT * FROM perf_source_totals"):
+                PERF_SOURCES.setdefault(underlying, {})[source] = {"total": total, "wins": wins, "pnl": pnl}
+
+            return
+
+        # ---- first start on an existing store: replay closed trades once ----
+        TRADE_DB.execute("BEGIN IMMEDIATE")
+
+        for underlying,status,pnl,source in TRADE_DB.execute(
+            "SELECT underlying,status,pnl,source FROM trades WHERE status!='ACTIVE' ORDER BY id"
+        ).fetchall():
+            apply_closed_trade(underlying, source, *record_closed_trade(underlying, status, pnl, source))
+
+        TRADE_DB.execute("COMMIT")
+
+
+load_performance()
+
+
+# ================= TRADE_LOG MIRROR =================
+
+# A..I panel row | J exit reason | K entry time | L exit time | M status
+
+TRADE_MIRROR = queue.Queue()
+
+def trade_log_ws():
+    return worksheet("TRADE_LOG")
+
+
+def mirror_trade(trade_id):
+
+    rows = trade_db(
+        "SELECT row_json,exit_reason,entry_time,exit_time,status,sheet_row,version"
+        " FROM trades WHERE id=?", (trade_id,)
+    )
+
+    if not rows:
+        return
+
+    row_json, exit_reason, entry_time, exit_time, status, sheet_row, version = rows[0]
+
+    tail = [exit_reason, entry_time, exit_time, status]
+
+    if sheet_row is None:
+
+        res = trade_log_ws().append_row(json.loads(row_json) + tail)
+
+        m = re.search(r"[A-Z]+(\d+)", res.get("updates",{}).get("updatedRange","").split("!")[-1])
+
+        if m:
+            trade_db("UPDATE trades SET sheet_row=? WHERE id=?", (int(m.group(1)), trade_id))
+
+    else:
+
+        trade_log_ws().batch_update([{"range": f"J{sheet_row}:M{sheet_row}", "values": [tail]}])
+
+    trade_db("UPDATE trades SET mirrored_version=? WHERE id=?", (version, trade_id))
+
+
+def trade_mirror_worker():
+
+    # ops are applied in order; a failing one blocks and retries
+    while True:
+
+        trade_id = TRADE_MIRROR.get()
+
+        while True:
+
+            try:
+                mirror_trade(trade_id)
+                break
+
+            except Exception as e:
+
+                print("TRADE MIRROR ERROR:", e)
+
+                if is_auth_error(e):
+
+                    # a failed re-auth is retried with the op
+                    try:
+                        refresh_worksheets()
+                    except Exception as e:
+                        print("SHEETS RE-AUTH FAILED:", e)
 
-    # -------- INSTITUTIONAL BREAKOUT DETECTION --------
+                time.sleep(5)
 
-    if relation == "ABOVE CPR" and ltp > vwap_val:
 
-        if velocity > 0.7:
-            signal = "🔥 INSTITUTIONAL BREAKOUT UP"
+# ---- catch up whatever the sheet missed before the last shutdown ----
+for (pending_id,) in trade_db("SELECT id FROM trades WHERE version>mirrored_version ORDER BY id"):
+    TRADE_MIRROR.put(pending_id)
 
-    elif relation == "BELOW CPR" and ltp < vwap_val:
+threading.Thread(target=trade_mirror_worker, daemon=True).start()
 
-        if velocity > 0.7:
-            signal = "🔻 INSTITUTIONAL BREAKOUT DOWN"
 
-    ultra_write("N11", signal)
-# ================= GAMMA ACCELERATION ENGINE =================
+# ================= TRADE LOGGER ENGINE =================
 
-def gamma_acceleration_engine():
+def trade_log_engine():
 
-    gamma = safe("M17")
-    flow = safe("N17")
-    floating = safe("A17")
-    sniper_ready = safe("N5")
+    if SIG.decision not in (Decision.CE_BUY, Decision.PE_BUY):
+        return
 
-    accel = "NO ACCELERATION"
+    # --- read active strike row (A17 auto row) ---
+    row = buffered_values("A17:I17")[0]
 
-    # acceleration conditions
-    if (("STRONG" in floating or "SUPER STRONG" in floating) and
-    "FLOW" in flow and
-    "PREMIUM TRAP" not in gamma):
+    strike = row[0]
 
+    # --- prevent duplicate logging ---
+    if not strike or strike_logged(strike):
+        return
 
-        if "LONG READY" in sniper_ready:
-            accel = "🚀 GAMMA ACCELERATION UP"
+    open_trade(row, source=trade_source())
+def trade_exit_engine(ltp, oc):
 
-        elif "SHORT READY" in sniper_ready:
-            accel = "🔻 GAMMA ACCELERATION DOWN"
+    for trade_id,strike,pivot_weak,t1,t3 in trade_db(
+        "SELECT id,strike,pivot,t1,t3 FROM trades WHERE status='ACTIVE' AND underlying=?",
+        (UNDERLYING["name"],)
+    ):
 
-    ultra_write("N8", accel)
-# ================= DEALER TREND INTELLIGENCE =================
+        exit_reason = exit_rule(ltp, pivot_weak, t1, t3)
+
+        if exit_reason:
+            close_trade(trade_id, exit_reason, leg_price(oc, strike))
+# ================= PERFORMANCE ANALYTICS =================
 
-TREND_REGIME = "NONE"
+def trade_source():
 
-def dealer_trend_intelligence(ltp):
+    # the auto execution label if one fired, else the decision engine
+    execution = str(buffered_values("N7:N7")[0][0])
 
-    global TREND_REGIME
+    if execution and execution != "WAIT":
+        return execution
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
-    floating = safe("A17")
-    gamma = safe("M17")
+    return label(SIG.decision)
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N29","NONE")
+
+def performance_analytics():
+
+    perf = PERF.get(UNDERLYING["name"], PERF_ZERO)
+    total = perf["total"]
+
+    if total == 0:
         return
 
-    regime = "NONE"
+    wins = perf["wins"]
+    losses = perf["losses"]
 
-    # ---- CPR FLIP DETECTION ----
-    prev_relation = get_state("prev_relation")
+    win_rate = (wins/total)*100 if total>0 else 0
 
-    if prev_relation:
+    ultra_write("L2", total)
+    ultra_write("L3", wins)
+    ultra_write("L4", losses)
+    ultra_write("L5", f"{round(win_rate,2)}%")
 
-        # ABOVE → BELOW flip
-        if prev_relation == "ABOVE CPR" and relation == "BELOW CPR":
-            regime = "🔥 DEALER TREND SHORT"
+    ultra_write("L6", round(perf["pnl"],2))
+    ultra_write("L7", round(perf["pnl"]/perf["priced"],2) if perf["priced"] else "")   # expectancy / priced trade
+    ultra_write("L8", round(perf["max_drawdown"],2))
 
-        # BELOW → ABOVE flip
-        elif prev_relation == "BELOW CPR" and relation == "ABOVE CPR":
-            regime = "🚀 DEALER TREND LONG"
+    ultra_write("L9", " | ".join(
+        f"{source or 'UNKNOWN'} {round(s['wins']/s['total']*100)}% ({s['total']})"
+        for source,s in sorted(PERF_SOURCES.get(UNDERLYING["name"], {}).items(), key=lambda x: -x[1]["total"])
+    ))
+# ================= TRADE STATE LOCK =================
 
-    # ---- TREND CONTINUATION ----
-    elif (relation=="BELOW CPR"
-          and ltp < vwap_val
-          and "STRONG" in floating
-          and "PREMIUM TRAP" not in gamma):
+def resume_locked_trade(name):
 
-        regime="🔻 TREND CONTINUATION"
+    # the locked trade of this underlying that was open at restart
+    for trade_id,strike in trade_db(
+        "SELECT id,strike FROM trades WHERE status='ACTIVE' AND locked=1 AND underlying=?"
+        " ORDER BY id DESC LIMIT 1", (name,)
+    ):
+        return {"id": trade_id, "strike": strike}
 
-    elif (relation=="ABOVE CPR"
-          and ltp > vwap_val
-          and "STRONG" in floating
-          and "PREMIUM TRAP" not in gamma):
+    return None
 
-        regime="🚀 TREND CONTINUATION"
 
-    TREND_REGIME = regime
+CURRENT_TRADE = None
+# ================= LOCKED TRADE ENTRY =================
 
-    set_state("prev_relation", relation)
+def locked_trade_entry():
 
-    ultra_write("N29", regime)
-# ================= TREND CONTINUATION ENGINE =================
+    global CURRENT_TRADE
 
-TREND_MEMORY = None
+    if CURRENT_TRADE is not None:
+        return  # already in trade
 
-def trend_continuation_engine(ltp):
+    if SIG.decision not in (Decision.CE_BUY, Decision.PE_BUY):
+        return
 
-    global TREND_MEMORY
+    row = buffered_values("A17:I17")[0]
+
+    if not row[0]:
+        return
+
+    CURRENT_TRADE = {
+        "id": open_trade(row, locked=True, source=trade_source()),
+        "strike": row[0]
+    }
+# ================= LOCKED TRADE EXIT =================
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
-    floating = safe("A17")
-    gamma = safe("M17")
+def locked_trade_exit(ltp, oc):
 
-    trend_signal = "NO TREND"
+    global CURRENT_TRADE
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N27", trend_signal)
+    if CURRENT_TRADE is None:
         return
 
-    # ---- Initialize memory ----
-    if TREND_MEMORY is None:
-        TREND_MEMORY = ltp
-        ultra_write("N27", trend_signal)
+    rows = trade_db(
+        "SELECT status,pivot,t1,t3 FROM trades WHERE id=?", (CURRENT_TRADE["id"],)
+    )
+
+    # closed elsewhere (or store reset): release the lock
+    if not rows or rows[0][0] != "ACTIVE":
+        CURRENT_TRADE = None
         return
 
-    # ---- TREND LOGIC ----
+    _,pivot_weak,t1,t3 = rows[0]
 
-    # PE TREND CONTINUATION
-    if (relation == "BELOW CPR"
-        and ltp < vwap_val
-        and ("STRONG" in floating or "SUPER STRONG" in floating)
-        and "PREMIUM TRAP" not in gamma
-        and ltp < TREND_MEMORY):
+    exit_reason = exit_rule(ltp, pivot_weak, t1, t3)
 
-        trend_signal = "🔻 TREND CONTINUATION SHORT"
+    if exit_reason:
 
-    # CE TREND CONTINUATION
-    elif (relation == "ABOVE CPR"
-          and ltp > vwap_val
-          and ("STRONG" in floating or "SUPER STRONG" in floating)
-          and "PREMIUM TRAP" not in gamma
-          and ltp > TREND_MEMORY):
+        close_trade(CURRENT_TRADE["id"], exit_reason, leg_price(oc, CURRENT_TRADE["strike"]))
 
-        trend_signal = "🚀 TREND CONTINUATION LONG"
+        CURRENT_TRADE = None
 
-    TREND_MEMORY = ltp
+NEWS_MODE = False
+PREV_LTP = None
 
-    ultra_write("N27", trend_signal)
-# ================= DARK POOL ENTRY ENGINE =================
+def news_mode_engine(ltp):
 
-LAST_DARK_PREM = None
+    global NEWS_MODE, PREV_LTP
 
-def dark_pool_entry_engine(ltp, oc):
+    move = price_move()
 
-    global LAST_DARK_PREM
+    if move is None:
 
-    relation = safe("H9")
-    vwap_val = safe("Q3")
-    gamma = safe("M17")
+        if PREV_LTP is None:
+            PREV_LTP = ltp
+            return
 
-    signal = "NO DARK SIGNAL"
+        move = abs(ltp - PREV_LTP)
 
-    try:
-        vwap_val = float(vwap_val)
-    except:
-        ultra_write("N31", signal)
-        return
+    if move >= 80:
+        NEWS_MODE = True
+    else:
+        NEWS_MODE = False
 
-    atm = round(ltp/50)*50
-    key = f"{atm:.6f}"
+    PREV_LTP = ltp
 
-    if key not in oc:
-        ultra_write("N31", signal)
-        return
+# ================= INTRADAY CANDLE STORE =================
 
-    ce = oc[key].get("ce")
-    pe = oc[key].get("pe")
+# 1-minute candles per option leg, kept across ticks and shared by the EMA
+# panels and the session range engine. The first request loads 09:15→now;
+# later refreshes only ask from the last stored bar, which is re-sent (it
+# was still forming) and replaced.
 
-    if not ce or not pe:
-        ultra_write("N31", signal)
-        return
+CANDLE_REFRESH_SEC = float(os.getenv("CANDLE_REFRESH_SEC", "30"))
 
-    pe_prem = pe.get("last_price",0)
-    ce_oi = ce.get("oi",0)
-    ce_prev = ce.get("previous_oi",0)
-    pe_oi = pe.get("oi",0)
-    pe_prev = pe.get("previous_oi",0)
+CANDLE_FIELDS = ("open","high","low","close","volume")
 
-    # ---- Memory ----
-    if LAST_DARK_PREM is None:
-        LAST_DARK_PREM = pe_prem
-        ultra_write("N31", signal)
-        return
+# security_id -> {"day", "fetched", "timestamp", open..volume}; a refresh
+# builds a new record and swaps it in, so readers never see half a merge
+CANDLE_STORE = {}
 
-    prem_rising = pe_prem > LAST_DARK_PREM
-    ce_building = ce_oi >= ce_prev
-    pe_not_exploding = abs(pe_oi - pe_prev) < 2000
+# one in-flight refresh per option leg
+OPTION_INTRADAY = {}
 
-    # ---- PE DARK ENTRY ----
-    if (relation=="BELOW CPR"
-        and ltp < vwap_val
-        and prem_rising
-        and ce_building
-        and pe_not_exploding
-        and "PREMIUM TRAP" not in gamma):
+def request_intraday(security_id, segment, since=None):
 
-        signal="🌑 DARK POOL SHORT BUILD"
+    seg, instr = segment
 
-    LAST_DARK_PREM = pe_prem
+    # Dhan takes exchange (IST) wall-clock times
+    now = datetime.datetime.now(IST)
+    today = now.strftime("%Y-%m-%d")
 
-    ultra_write("N31", signal)
-# ================= FLOATING PIVOT PRO ENGINE =================
+    start = datetime.datetime.fromtimestamp(since, IST).strftime("%Y-%m-%d %H:%M:%S") if since else f"{today} 09:15:00"
 
-option_ranges = {}
+    payload = {
+        "securityId": str(security_id),
+        "exchangeSegment": seg,
+        "instrument": instr,
+        "interval": "1",
+        "fromDate": start,
+        "toDate": now.strftime("%Y-%m-%d %H:%M:%S")
+    }
 
-def floating_pivot(high, low, ltp):
+    return dhan_post("charts/intraday", payload)
 
-    p = (high + low + ltp)/3
-    rng = high - low
 
-    wp = (2*p) - high
-    t1 = (2*p) - low
-    t2 = p + rng
-    t3 = high + 2*(p-low)
+def bar_time(t):
 
-    if ltp > t1:
-        status = "SUPER STRONG 🚀"
-    elif wp < ltp <= t1:
-        status = "STRONG"
-    elif p < ltp <= wp:
-        status = "WEAKENING"
-    else:
-        status = "INVALIDATED"
+    if isinstance(t, (int, float)):
+        return float(t)
 
-    return p, wp, t1, t2, t3, status
+    # ISO times without an offset are exchange (IST) times
+    dt = datetime.datetime.fromisoformat(str(t))
 
+    return (dt if dt.tzinfo else dt.replace(tzinfo=IST)).timestamp()
 
 
-# ================= EMA CALCULATOR =================
+def candle_arrays(r):
 
-def calculate_ema(values, period):
+    # v2: top-level arrays; older payloads nest them under "data" or send
+    # "candles" rows [time, open, high, low, close, volume]
+    data = r.get("data") if isinstance(r.get("data"), dict) else r
 
-    ema = []
+    if "candles" in data:
 
-    k = 2/(period+1)
+        rows = data["candles"]
 
-    for i,v in enumerate(values):
+        bars = {k: [float(c[i+1]) for c in rows] for i,k in enumerate(CANDLE_FIELDS)}
+        bars["timestamp"] = [bar_time(c[0]) for c in rows]
 
-        if i == 0:
-            ema.append(v)
-        else:
-            ema.append(v*k + ema[-1]*(1-k))
+        return bars
 
-    return ema
-# ================= GAMMA DEALER ENGINE =================
+    bars = {k: [float(x) for x in data.get(k) or []] for k in CANDLE_FIELDS}
+    bars["timestamp"] = [bar_time(t) for t in data.get("timestamp") or []]
 
-def gamma_filter(atm, decision, oc):
+    return bars
 
-    try:
 
-        strikes = list(oc.keys())
-        strikes = sorted([float(s) for s in strikes])
+def refresh_candles(security_id, segment):
 
-        # find ATM index
-        idx = strikes.index(float(f"{atm:.6f}"))
+    today = ist_today().isoformat()
 
-        nearby = strikes[max(0,idx-2): idx+3]
+    bars = CANDLE_STORE.get(security_id)
 
-        oi_change_total = 0
-        premium_speed = 0
+    if bars is None or bars["day"] != today:
+        bars = {"day": today, "timestamp": [], **{k: [] for k in CANDLE_FIELDS}}
 
-        for s in nearby:
+    stamps = bars["timestamp"]
 
-            data = oc.get(f"{s:.6f}",{}).get(decision.lower())
+    new = candle_arrays(request_intraday(security_id, segment, stamps[-1] if stamps else None) or {})
 
-            if not data:
-                continue
+    if new["timestamp"] and stamps:
 
-            oi = data.get("oi",0)
-            prev_oi = data.get("previous_oi",0)
-            ltp = data.get("last_price",0)
-            prev_close = data.get("previous_close_price",0)
+        # overlap from the first returned bar onwards is replaced
+        keep = bisect.bisect_left(stamps, new["timestamp"][0])
 
-            oi_change_total += (oi - prev_oi)
-            premium_speed += (ltp - prev_close)
+        merged = {k: bars[k][:keep] + new[k] for k in ("timestamp",) + CANDLE_FIELDS}
 
-        # ----- Decision Logic -----
+    elif new["close"] and not stamps:
 
-        if premium_speed > 0 and oi_change_total < 0:
-            return "GAMMA BLAST 🚀"
+        # first fetch of the day; a later payload without timestamps can't
+        # be merged and leaves the stored bars alone
+        merged = new
 
-        elif premium_speed > 0 and oi_change_total > 0:
-            return "DEALER TRAP ⚠️"
+    else:
 
-        else:
-            return "NEUTRAL FLOW"
+        merged = {k: bars[k] for k in ("timestamp",) + CANDLE_FIELDS}
 
-    except Exception as e:
-        print("GAMMA ERROR:",e)
+    CANDLE_STORE[security_id] = {"day": today, "fetched": time.time(), **merged}
 
-    return "UNKNOWN"
+    return CANDLE_STORE[security_id]
 
 
-# ================= STRIKE SELECTOR =================
+def prefetch_option_intraday(security_ids):
 
-# ================= STRIKE SELECTOR =================
+    now = time.time()
 
-option_high_low = {}
+    for security_id in security_ids:
 
-# ---------- TRUE SESSION OHLC (FROM 9:15 AM) ----------
-def get_session_range(security_id):
+        if not security_id:
+            continue
 
-    try:
+        f = OPTION_INTRADAY.get(security_id)
+        bars = CANDLE_STORE.get(security_id)
 
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if f is not None and (not f.done() or (bars and now - bars["fetched"] < CANDLE_REFRESH_SEC)):
+            continue
 
-        payload = {
-            "securityId": str(security_id),
-            "exchangeSegment": "NSE_FNO",
-            "instrument": "OPTIDX",
-            "interval": "1",
-            "fromDate": f"{today} 09:15:00",
-            "toDate": now
-        }
+        OPTION_INTRADAY[security_id] = FETCH_POOL.submit(
+            refresh_candles, security_id, option_segment(UNDERLYING)
+        )
 
-        r = requests.post(
-            "https://api.dhan.co/v2/charts/intraday",
-            headers=headers(),
-            json=payload
-        ).json()
 
-        highs = r.get("high",[])
-        lows  = r.get("low",[])
+def fetch_candles(security_id):
 
-        if not highs or not lows:
-            return None,None
+    prefetch_option_intraday([security_id])
 
-        return max(highs),min(lows)
+    try:
+        OPTION_INTRADAY[security_id].result(timeout=FETCH_DEADLINE)
 
     except Exception as e:
-        print("SESSION RANGE ERROR:",e)
+        print("CANDLE REFRESH ERROR:", security_id, type(e).__name__, e)
 
-    return None,None
+    # a failed refresh still serves the last stored bars
+    return CANDLE_STORE.get(security_id)
 
 
-# ---------- SMART RANGE ENGINE ----------
-def update_range(key_name, session_high, session_low, ltp):
+# ================= FETCH STAGE =================
 
-    if key_name not in option_high_low:
+def fetch_stage(jobs, deadline=FETCH_DEADLINE):
 
-        option_high_low[key_name] = {
-            "session_high": session_high if session_high else ltp,
-            "session_low": session_low if session_low else ltp,
-            "micro_high": ltp,
-            "micro_low": ltp
-        }
+    # jobs: name -> (fn, *args), all issued at once on the fetch pool
+    futures = {
+        name: FETCH_POOL.submit(job[0], *job[1:])
+        for name,job in jobs.items()
+    }
 
-    r = option_high_low[key_name]
+    end = time.time() + deadline
+    snapshot = {}
 
-    r["micro_high"] = max(r["micro_high"], ltp)
-    r["micro_low"]  = min(r["micro_low"], ltp)
+    for name,f in futures.items():
 
-    high = max(r["session_high"], r["micro_high"])
-    low  = min(r["session_low"], r["micro_low"])
+        try:
+            snapshot[name] = f.result(timeout=max(0, end-time.time()))
 
-    return high, low
+        except Exception as e:
+            print("FETCH FAILED:", name, type(e).__name__, e)
+            snapshot[name] = None
 
-# ================= UNIVERSAL STRIKE ENGINE (AUTO + MANUAL) =================
+    return snapshot
 
-def process_strike_floating(strike, side, oc, sheet_range):
 
-    key = f"{strike:.6f}"
+def option_security_id(oc, strike, side):
 
-    opt = oc.get(key, {}).get(side.lower())
+    opt = oc.leg(strike, side)
 
-    if not opt:
-        return
+    return opt["security_id"] if opt else None
 
-    ltp_opt = float(opt.get("last_price",0))
-    security_id = opt.get("security_id")
 
-    key_name = f"{strike}_{side}"
+def option_legs(ltp, oc, inst_ce, inst_pe):
 
-    session_high, session_low = get_session_range(security_id)
+    # every leg whose intraday candles this tick will need
+    atm = atm_strike(ltp)
 
-    high, low = update_range(key_name, session_high, session_low, ltp_opt)
+    legs = [(atm,"CE"), (atm,"PE")]
 
-    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+    manual = manual_strike()
 
-    gamma_status = gamma_filter(strike, side, oc)
+    if manual:
+        legs.append(manual)
 
-    ws.update(
-        values=[[f"{strike} {side}", ltp_opt,
-                 round(p,2), round(wp,2),
-                 round(t1,2), round(t2,2),
-                 round(t3,2), status + " | " + gamma_status]],
-        range_name=sheet_range
-    )
+    if inst_ce and f"{inst_ce}_CE_INST" not in option_high_low:
+        legs.append((inst_ce,"CE"))
 
-# ---------- AUTO STRIKE ----------
-def auto_strike_floating(ltp, oc):
+    if inst_pe and f"{inst_pe}_PE_INST" not in option_high_low:
+        legs.append((inst_pe,"PE"))
 
-    relation = safe("H9")
+    return [option_security_id(oc, strike, side) for strike,side in legs]
 
-    if relation == "ABOVE CPR":
-        decision = "CE"
-    elif relation == "BELOW CPR":
-        decision = "PE"
-    else:
-        return
 
-    atm = round(ltp/50)*50
+def quote_legs(ltp, oc, inst_ce, inst_pe):
 
-    process_strike_floating(atm, decision, oc, "A17:H17")
+    # legs priced by the batched quote call every tick: ATM±QUOTE_STRIKES
+    # on both sides, the INST strikes and the manual strike
+    atm = atm_strike(ltp)
 
+    legs = [(atm+n*oc.step, side) for n in range(-QUOTE_STRIKES, QUOTE_STRIKES+1) for side in ("CE","PE")]
 
-# ---------- MANUAL STRIKE ----------
-def manual_strike_floating(oc):
+    if inst_ce:
+        legs.append((inst_ce,"CE"))
 
-    manual = safe("A23")
+    if inst_pe:
+        legs.append((inst_pe,"PE"))
 
-    if not manual:
-        return
+    manual = manual_strike()
 
-    try:
-        strike = int(manual.split()[0])
-        side = manual.split()[1].upper()
-    except:
-        return
+    if manual:
+        legs.append(manual)
 
-    process_strike_floating(strike, side, oc, "A23:H23")
+    ids = {option_security_id(oc, strike, side) for strike,side in legs}
 
+    return [(oc.segment, sid) for sid in sorted(i for i in ids if i)]
 
-# ================= EMA SCALP ENGINE =================
+# ================= ENGINE SCHEDULER =================
 
-def process_strike_ema_scalp(strike, side, oc, sheet_range):
+# Engines declare the inputs they read and an optional cadence; a tick
+# re-runs an engine only when one of its inputs changed version since its
+# last run or its cadence elapsed. Sources (HTTP / sheet) are fetched on
+# their own cadence, so a quiet market costs one LTP read per tick.
 
-    key = f"{strike:.6f}"
-    opt = oc.get(key, {}).get(side.lower())
+TICK_SEC = float(os.getenv("TICK_SEC", "2"))            # feed live
+POLL_TICK_SEC = float(os.getenv("POLL_TICK_SEC", "8"))  # quote polling
 
-    if not opt:
-        return
+SHEET_READ_SEC = float(os.getenv("SHEET_READ_SEC", "8"))
 
-    security_id = opt.get("security_id")
+# the scalp engine compares premium and LTP with its previous run (5%
+# jump = gamma acceleration); a fixed cadence keeps that a move over
+# SCALP_SEC whatever the tick period
+SCALP_SEC = float(os.getenv("SCALP_SEC", "8"))
 
-    # ---- DEFAULT EMA STATUS ----
-    ema_status = "NO INTRADAY DATA"
+# serial | thread: thread fans each group of mutually independent engines
+# out on ENGINE_POOL; numpy kernels and candle waits release the GIL
+ENGINE_EXECUTOR = os.getenv("ENGINE_EXECUTOR", "serial").lower()
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", "8"))
 
-    try:
+ENGINE_POOL = ThreadPoolExecutor(max_workers=ENGINE_WORKERS) if ENGINE_EXECUTOR == "thread" else None
+CHAIN_SEC = float(os.getenv("CHAIN_SEC", "8"))
+INTRADAY_SEC = float(os.getenv("INTRADAY_SEC", "60"))
+BARS_SEC = float(os.getenv("BARS_SEC", "300"))
 
-        closes = fetch_intraday_closes(security_id)
+SHEET_KEYS = [
+    "B1","B2","B4",
+    "H9",
+    "Q3","M17","N17","N9",
+    "A17","A19","A23",
+    "B31","B32","B33",
+    "C6","N5","N6","N23",
+    "P7"
+]
 
-        # Only calculate EMA if enough candles exist
-        if len(closes) >= 30:
+# per-underlying sources: name -> (fn, cadence seconds), called with the
+# context's cfg; LTP (one batched quote) and VIX are shared by all of them
+SOURCES = {
+    "oc": (optionchain, CHAIN_SEC),
+    "bars": (daily_bars, BARS_SEC),
+    "intraday": (fetch_index_intraday, INTRADAY_SEC),
+}
+SOURCE_LAST = {}
+SHARED_LAST = {}
 
-            ema9 = calculate_ema(closes,9)
-            ema21 = calculate_ema(closes,21)
+# a failed source is due again after this, not after its whole cadence
+SOURCE_RETRY_SEC = float(os.getenv("SOURCE_RETRY_SEC", "10"))
 
-            if ema9[-1] > ema21[-1] and ema9[-2] <= ema21[-2]:
-                ema_status = "EMA CROSS UP 🚀"
+ENGINES = []
 
-            elif ema9[-1] < ema21[-1] and ema9[-2] >= ema21[-2]:
-                ema_status = "EMA CROSS DOWN 🔻"
+# engine name -> {"seen", "last", "runs", "cost"} of the active underlying
+ENGINE_RUNS = {}
 
-            else:
-                ema_status = "EMA NEUTRAL"
+TICK_STATS = {"ticks": 0, "overruns": 0, "last": 0.0, "worst": 0.0}
 
-    except Exception as e:
-        print("EMA SCALP ERROR:", e)
 
+EVERY_TICK = 0
 
-    # ---- ALWAYS CALCULATE FLOATING PIVOT ----
-    ltp_opt = float(opt.get("last_price",0))
+def schedule(name, run, inputs=("ltp",), every=None, writes=(), local=False):
 
-    high, low = ltp_opt, ltp_opt
+    # inputs: sources and signals read; writes: signals published;
+    # local: touches shared memory or I/O, never runs on a worker
+    ENGINES.append({
+        "name": name, "run": run, "inputs": inputs, "every": every, "writes": writes,
+        "local": local, "deps": set(), "level": 0
+    })
+
+
+def tick_period():
+
+    live = all(live_ltp(ctx.cfg["seg"], ctx.cfg["id"]) is not None for ctx in CONTEXTS)
+
+    return TICK_SEC if live else POLL_TICK_SEC
+
+
+def read_sheet_inputs(now):
+
+    # one values call for the input cells of every underlying's tab;
+    # -> {underlying: cells} when the sheet was read this tick
+    due = now - SHARED_LAST.get("sheet", 0) >= SHEET_READ_SEC
+    read_now = {}
+
+    if due:
+
+        tabs = [f"'{worksheet(ctx.tab).title}'!" for ctx in CONTEXTS]
+
+        ranges = spreadsheet().values_batch_get(
+            [tab+k for tab in tabs for k in SHEET_KEYS]
+        ).get("valueRanges", [])
+
+        SHARED_LAST["sheet"] = now
+
+    for n,ctx in enumerate(CONTEXTS):
+
+        activate(ctx)
+
+        if due:
+
+            cells = ranges[n*len(SHEET_KEYS):(n+1)*len(SHEET_KEYS)]
+
+            SHEET_CACHE.clear()
+            SHEET_CACHE.update({
+                k:(cells[i]["values"][0][0] if i < len(cells) and cells[i].get("values") else "")
+                for i,k in enumerate(SHEET_KEYS)
+            })
+
+        else:
+
+            # between reads, cells this process wrote are already known
+            SHEET_CACHE.update({k: SHEET_SHADOW[k] for k in SHEET_KEYS if k in SHEET_SHADOW})
+
+        cells = dict(SHEET_CACHE)
+        publish("sheet", cells, key=tuple(cells.values()))
+
+        if due:
+            read_now[ctx.name] = cells
+
+    return read_now or None
+
+
+def fetch_jobs(now):
 
-    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+    # every due source of every underlying, plus the shared ones
+    legs = []
 
-    ws.update(
-        values=[[f"{strike} {side}",
-                 ltp_opt,
-                 round(wp,2),
-                 round(p,2),
-                 round(t1,2),
-                 round(t2,2),
-                 round(t3,2),
-                 status,
-                 ema_status]],
-        range_name=sheet_range
-    )
-# ================= EMA COMPRESSION DETECTOR =================
+    for ctx in CONTEXTS:
+        activate(ctx)
+        legs += read("quote_legs", [])
 
-def process_strike_ema_compression(strike, side, oc, sheet_range):
+    jobs = {"ltp": (market, [ctx.cfg for ctx in CONTEXTS], legs + [(VIX_CFG["seg"], VIX_CFG["id"])])}
 
-    key = f"{strike:.6f}"
-    opt = oc.get(key, {}).get(side.lower())
+    if nse_vix_due(now):
+        jobs["vix_nse"] = (nse_vix,)
 
-    if not opt:
-        return
+    for ctx in CONTEXTS:
 
-    security_id = opt.get("security_id")
+        activate(ctx)
 
-    # ---- DEFAULT STATUS ----
-    compression_status = "NO INTRADAY DATA"
+        for name,(fn,every) in SOURCES.items():
 
-    try:
+            if now - SOURCE_LAST.get(name, 0) >= every:
 
-        closes = fetch_intraday_closes(security_id)
+                # the chain fetch needs this tab's expiry cell
+                args = (ctx.cfg, safe("B4")) if name == "oc" else (ctx.cfg,)
 
-        if len(closes) >= 40:
+                jobs[(ctx.name, name)] = (fn,) + args
+                SOURCE_LAST[name] = now
 
-            ema9 = calculate_ema(closes,9)
-            ema21 = calculate_ema(closes,21)
+    return jobs
 
-            dist_now = abs(ema9[-1] - ema21[-1])
-            dist_prev = abs(ema9[-2] - ema21[-2])
 
-            compression_status = "NO COMPRESSION"
+def apply_inputs(ctx, snap, now):
 
-            if dist_now < 0.5 and dist_now < dist_prev:
-                compression_status = "⚡ EMA COMPRESSION BUILDING"
+    # publish the active underlying's share of the fetch snapshot
+    ltp = (snap.get("ltp") or {}).get(ctx.cfg["id"])
 
-            elif dist_now < 0.3:
-                compression_status = "🔥 TIGHT COMPRESSION"
+    if ltp is not None:
+        publish("ltp", ltp)
 
-    except Exception as e:
-        print("EMA COMPRESSION ERROR:", e)
+    if snap.get("vix") is not None:
+        publish("vix", snap["vix"])
 
+    # leg premiums moved -> the leg panels re-run without a chain refresh
+    publish("quotes", tuple(quote(seg, sid) for seg,sid in read("quote_legs", [])))
 
-    # ---- ALWAYS CALCULATE FLOATING PIVOT ----
-    ltp_opt = float(opt.get("last_price",0))
+    part = {name: snap.get((ctx.name, name)) for name in SOURCES}
 
-    high, low = ltp_opt, ltp_opt
+    for name,(fn,every) in SOURCES.items():
+        # fetched this tick and failed (the chain reports errors as {})
+        if (ctx.name, name) in snap and not part[name]:
+            SOURCE_LAST[name] = now - every + min(every, SOURCE_RETRY_SEC)
 
-    p, wp, t1, t2, t3, status = floating_pivot(high, low, ltp_opt)
+    # every successful chain fetch is a new snapshot
+    if part["oc"]:
+        publish("oc", part["oc"], key=now)
 
-    ws.update(
-        values=[[f"{strike} {side}",
-                 ltp_opt,
-                 round(wp,2),
-                 round(p,2),
-                 round(t1,2),
-                 round(t2,2),
-                 round(t3,2),
-                 status,
-                 compression_status]],
-        range_name=sheet_range
-    )
-# ================= DEALER GAMMA ENGINE v6 =================
+    if part["intraday"] is not None:
+        publish("intraday", part["intraday"], key=now)
 
-def institutional_strike_selector(ltp, oc):
+    if part["bars"] is not None:
 
-    atm = round(ltp / 50) * 50
+        publish("bars", part["bars"], key=id(part["bars"]))
 
-    candidate_strikes = [atm-100, atm-50, atm, atm+50, atm+100]
+        prev = prev_day_bar(part["bars"])
+        publish("cpr", prev, key=(prev["high"], prev["low"], prev["close"]) if prev else None)
 
-    best_ce = None
-    best_pe = None
+    return ltp
 
-    best_ce_score = -999999
-    best_pe_score = -999999
 
-    atm_key = f"{atm:.6f}"
-    atm_iv = oc.get(atm_key, {}).get("ce", {}).get("iv", 0)
+def engine_runs(engine):
 
-    for strike in candidate_strikes:
+    runs = ENGINE_RUNS.get(engine["name"])
 
-        key = f"{strike:.6f}"
+    if runs is None:
+        runs = ENGINE_RUNS[engine["name"]] = {"seen": None, "last": 0.0, "runs": 0, "cost": 0.0}
 
-        data = oc.get(key)
-        if not data:
-            continue
+    return runs
 
-        for side in ["ce","pe"]:
 
-            opt = data.get(side)
-            if not opt:
-                continue
+def engine_due(engine, runs, now):
 
-            oi = opt.get("oi",0)
-            oi_change = opt.get("oi_change",0)
-            delta = abs(opt.get("delta",0))
-            iv = opt.get("iv",0)
+    seen = tuple(INPUTS[n]["version"] if n in INPUTS else 0 for n in engine["inputs"])
 
-            gamma_proxy = oi_change * delta
-            iv_edge = iv - atm_iv
+    if seen != runs["seen"]:
+        return seen
 
-            score = (oi*0.5)+(gamma_proxy*0.3)+(iv_edge*0.2)
+    if engine["every"] is not None and now - runs["last"] >= engine["every"]:
+        return seen
 
-            if side=="ce" and score>best_ce_score:
-                best_ce_score=score
-                best_ce=strike
+    return None
 
-            if side=="pe" and score>best_pe_score:
-                best_pe_score=score
-                best_pe=strike
 
-    return best_ce,best_pe
-def institutional_floating(strike, side, oc, sheet_row):
+def run_engine(engine, now):
 
-    key=f"{strike:.6f}"
-    opt=oc.get(key,{}).get(side.lower())
+    runs = engine_runs(engine)
+    seen = engine_due(engine, runs, now)
 
-    if not opt:
+    if seen is None:
         return
 
-    ltp_opt=float(opt.get("last_price",0))
-    security_id=opt.get("security_id")
+    started = time.perf_counter()
 
-    key_name=f"{strike}_{side}_INST"
+    try:
+        engine["run"]()
 
-    if key_name not in option_high_low:
+    except Exception as e:
 
-        high,low=get_session_range(security_id)
+        if is_auth_error(e):
+            raise
 
-        if high and low:
-            option_high_low[key_name]={"high":high,"low":low}
-        else:
-            option_high_low[key_name]={"high":ltp_opt,"low":ltp_opt}
+        print("ENGINE ERROR:", engine["name"], e)
 
-    option_high_low[key_name]["high"]=max(option_high_low[key_name]["high"],ltp_opt)
-    option_high_low[key_name]["low"]=min(option_high_low[key_name]["low"],ltp_opt)
+    runs["cost"] += time.perf_counter() - started
+    runs["runs"] += 1
+    runs["seen"] = seen
+    runs["last"] = now
 
-    high=option_high_low[key_name]["high"]
-    low=option_high_low[key_name]["low"]
 
-    p,wp,t1,t2,t3,status=floating_pivot(high,low,ltp_opt)
+def run_group(group, now):
 
-    ws.update(
-        values=[[f"{strike} {side}",ltp_opt,
-                 round(p,2),round(wp,2),
-                 round(t1,2),round(t2,2),
-                 round(t3,2),status]],
-        range_name=f"{sheet_row}:H{sheet_row[1:]}"
-    )
+    if len(group) == 1:
+        run_engine(group[0], now)
+        return
 
-# ================= 3 LAYER DECISION ENGINE =================
+    futures = [ENGINE_POOL.submit(run_engine, engine, now) for engine in group]
 
-def decision_engine():
+    for f in futures:
+        f.result()
 
-    auto = safe("A17")
-    inst = safe("A19")
-    gamma = safe("M17")
 
-    decision = "WAIT"
+def run_engines(now):
 
-    # --- detect CE or PE in strings ---
-    auto_ce = "CE" in auto
-    auto_pe = "PE" in auto
+    if ENGINE_POOL is None:
 
-    inst_ce = "CE" in inst
-    inst_pe = "PE" in inst
+        for engine in ENGINES:
+            run_engine(engine, now)
 
-    # ---- BUY CE ----
-    if auto_ce and inst_ce and "PREMIUM TRAP" not in gamma:
-        decision = "🔥 CE BUY"
+        return
 
-    # ---- BUY PE ----
-    elif auto_pe and inst_pe and "PREMIUM TRAP" not in gamma:
-        decision = "🔻 PE BUY"
+    # walk the topological order, growing a group while engines are
+    # independent of everything already in it; a local engine or a
+    # dependency closes the group, so relative order is preserved
+    group = []
 
-    else:
-        decision = "⚠️ WAIT / CONFLICT"
+    for engine in ENGINES:
 
-    ultra_write("C10", decision)
-# ================= SCALP MODE V3 SMART + GAMMA ACCEL + LIQUIDITY VACUUM =================
+        if engine["local"] or any(g["name"] in engine["deps"] for g in group):
 
-def scalp_mode_v2(ltp, oc):
+            if group:
+                run_group(group, now)
 
-    global LAST_LTP, PREV_LTP, LAST_CE_PREM, LAST_PE_PREM
+            group = []
 
-    relation = STATE.get("relation")
-    vwap_val = STATE.get("vwap")
-    bc = STATE.get("bc")
-    tc = STATE.get("tc")
+        if engine["local"]:
+            run_engine(engine, now)
+        else:
+            group.append(engine)
 
-    signal = ""
-    strike = ""
+    if group:
+        run_group(group, now)
 
-    # ---- SAFE CHECK ----
-    try:
-        vwap_val = float(vwap_val)
-        bc = float(bc)
-        tc = float(tc)
-    except:
-        ultra_write("C12","")
-        ultra_write("C21","")
-        return
 
-    if LAST_LTP is None:
-        LAST_LTP = ltp
-        return
+def finish_tick(started):
 
-    atm = round(ltp/50)*50
-    k = f"{atm:.6f}"
+    # sleep to the tick deadline; an overrun starts the next tick at once
+    period = tick_period()
+    elapsed = time.time() - started
 
-    if k in oc:
+    TICK_STATS["ticks"] += 1
+    TICK_STATS["last"] = elapsed
+    TICK_STATS["worst"] = max(TICK_STATS["worst"], elapsed)
 
-        ce = oc[k].get("ce")
-        pe = oc[k].get("pe")
+    if elapsed > period:
 
-        gamma_accel_up = False
-        gamma_accel_down = False
+        TICK_STATS["overruns"] += 1
 
-        liquidity_vacuum_up = False
-        liquidity_vacuum_down = False
+        slow = max(ENGINE_RUNS.items(), key=lambda x: x[1]["cost"]/max(x[1]["runs"],1))[0] if ENGINE_RUNS else ""
+        print(f"TICK OVERRUN {elapsed:.2f}s > {period:.0f}s (slowest engine avg: {slow})")
 
-        # ---- Gamma Acceleration ----
-        if ce and LAST_CE_PREM:
-            if ce.get("last_price",0) > LAST_CE_PREM * 1.05:
-                gamma_accel_up = True
+    time.sleep(max(0, period - elapsed))
 
-        if pe and LAST_PE_PREM:
-            if pe.get("last_price",0) > LAST_PE_PREM * 1.05:
-                gamma_accel_down = True
 
-        # ---- Liquidity Vacuum Detection ----
-        if ce:
-            ce_prem_jump = ce.get("last_price",0) > ce.get("previous_close",0) * 1.03
-            ce_oi_flat = abs(ce.get("oi",0) - ce.get("previous_oi",0)) < 1000
-            if ce_prem_jump and ce_oi_flat:
-                liquidity_vacuum_up = True
+def chain_legs():
 
-        if pe:
-            pe_prem_jump = pe.get("last_price",0) > pe.get("previous_close",0) * 1.03
-            pe_oi_flat = abs(pe.get("oi",0) - pe.get("previous_oi",0)) < 1000
-            if pe_prem_jump and pe_oi_flat:
-                liquidity_vacuum_down = True
+    # new chain: pick institutional strikes, then top up their candles in
+    # the background while the chain engines run
+    ltp, oc = read("ltp"), read("oc")
 
-        # ---------- PE SMART SCALP ----------
-        if relation == "BELOW CPR" and ltp < vwap_val and ltp < LAST_LTP:
+    inst_ce, inst_pe = institutional_strike_selector(ltp, oc)
 
-            if pe and ce:
+    publish("inst", (inst_ce, inst_pe))
 
-                pe_oi_up = pe.get("oi",0) > pe.get("previous_oi",0)
-                ce_unwind = ce.get("oi",0) < ce.get("previous_oi",0)
+    legs = option_legs(ltp, oc, inst_ce, inst_pe)
 
-                premium_expand = pe.get("last_price",0) > pe.get("previous_close",0)
+    prefetch_option_intraday(legs)
 
-                if (pe_oi_up or ce_unwind) and \
-                   (premium_expand or gamma_accel_down or liquidity_vacuum_down):
+    quoted = quote_legs(ltp, oc, inst_ce, inst_pe)
 
-                    signal = "🔻 PE SMART SCALP"
-                    strike = f"{atm} PE"
+    publish("quote_legs", quoted)
+    feed_subscribe(oc.segment, [sid for _,sid in quoted])
 
-        # ---------- CE SMART SCALP ----------
-        elif relation == "ABOVE CPR" and ltp > vwap_val and ltp > LAST_LTP:
 
-            if ce and pe:
+def market_cells():
 
-                ce_oi_up = ce.get("oi",0) > ce.get("previous_oi",0)
-                pe_unwind = pe.get("oi",0) < pe.get("previous_oi",0)
+    news_mode_engine(read("ltp"))
 
-                premium_expand = ce.get("last_price",0) > ce.get("previous_close",0)
+    ultra_write("C6", read("ltp"))
+    ultra_write("C7", read("vix", VIX_DEFAULT))
 
-                if (ce_oi_up or pe_unwind) and \
-                   (premium_expand or gamma_accel_up or liquidity_vacuum_up):
+    sync_expiry()
 
-                    signal = "🔺 CE SMART SCALP"
-                    strike = f"{atm} CE"
 
-        # ---- Update premium memory ----
-        if ce:
-            LAST_CE_PREM = ce.get("last_price",0)
+def vwap_step():
 
-        if pe:
-            LAST_PE_PREM = pe.get("last_price",0)
+    vwap(read("ltp"), read("oc"), read("intraday"), safe("P7"))
 
-    # ====================================================
-    # INSIDE CPR DEFENSE MODE
-    # ====================================================
 
-    if relation == "INSIDE CPR":
+def ema_panels():
 
-        if abs(ltp - bc) <= 20 and ltp > LAST_LTP:
-            signal = "🔵 CE DEFENSE SCALP"
-            strike = f"{atm} CE"
+    ltp, oc = read("ltp"), read("oc")
 
-        elif abs(ltp - tc) <= 20 and ltp < LAST_LTP:
-            signal = "🔴 PE DEFENSE SCALP"
-            strike = f"{atm} PE"
+    atm = atm_strike(ltp)
 
-    # ====================================================
-    # WRITE OR AUTO CLEAR
-    # ====================================================
+    # --- EMA SCALP PANEL ---
+    process_strike_ema_scalp(atm,"CE",oc,"A38:I38")
+    process_strike_ema_scalp(atm,"PE",oc,"A39:I39")
 
-    if signal:
+    # --- EMA COMPRESSION PANEL ---
+    process_strike_ema_compression(atm,"CE",oc,"A41:I41")
+    process_strike_ema_compression(atm,"PE",oc,"A42:I42")
 
-        pivot_weak = round(ltp*0.75,2)
-        entry = round(ltp*0.5,2)
-        t1 = round(ltp*1.3,2)
-        t2 = round(ltp*1.6,2)
-        t3 = round(ltp*2.1,2)
 
-        ultra_write("C12", signal)
-        ultra_write("C21", strike)
-        ultra_write("D21", ltp)
-        ultra_write("E21", pivot_weak)
-        ultra_write("F21", entry)
-        ultra_write("G21", t1)
-        ultra_write("H21", t2)
-        ultra_write("I21", t3)
-        ultra_write("J21", "SCALP ACTIVE")
+def inst_panels():
 
-    else:
+    inst_ce, inst_pe = read("inst", (None, None))
 
-        ultra_write("C12","")
-        ultra_write("C21","")
-        ultra_write("D21","")
-        ultra_write("E21","")
-        ultra_write("F21","")
-        ultra_write("G21","")
-        ultra_write("H21","")
-        ultra_write("I21","")
-        ultra_write("J21","")
+    if inst_ce:
 
-    PREV_LTP = LAST_LTP
-    LAST_LTP = ltp
+        status = institutional_floating(inst_ce,"CE",read("oc"),"A19")
 
-# ================= TRADE LOGGER ENGINE =================
+        if status is not None:
+            SIG.inst_strength = status
+            emit("inst_floating", Side.CE, key=(Side.CE, status))
 
-def trade_log_engine():
+    if inst_pe:
+        institutional_floating(inst_pe,"PE",read("oc"),"A25")
 
-    decision = safe("C10")
 
-    if "BUY" not in decision:
-        return
+def order_engines():
 
-    log_ws = gc.open("N50").worksheet("TRADE_LOG")
+    # stable topological order over declared reads/writes: producers run
+    # before consumers, ties keep registration order; a cycle falls back
+    # to registration order. level = longest producer chain, so engines on
+    # the same level are independent of each other.
+    writers = {}
 
-    # --- read active strike row (A17 auto row) ---
-    row = ws.get("A17:I17")[0]
+    for i,e in enumerate(ENGINES):
+        for name in e["writes"]:
+            writers.setdefault(name, set()).add(i)
 
-    strike = row[0]
+    deps = [
+        {j for name in e["inputs"] for j in writers.get(name, ()) if j != i}
+        for i,e in enumerate(ENGINES)
+    ]
 
-    # --- prevent duplicate logging ---
-    existing = log_ws.col_values(1)
+    order, done = [], set()
+
+    while len(order) < len(ENGINES):
+
+        ready = [i for i in range(len(ENGINES)) if i not in done and deps[i] <= done]
+
+        if not ready:
+            ready = [min(i for i in range(len(ENGINES)) if i not in done)]
+            print("ENGINE CYCLE AT:", ENGINES[ready[0]]["name"])
+
+        i = ready[0]
+        done.add(i)
+        order.append(i)
+
+    level = {}
+
+    for i in order:
+        level[i] = 1 + max((level[j] for j in deps[i] if j in level), default=-1)
+        ENGINES[i]["level"] = level[i]
+        ENGINES[i]["deps"] = {ENGINES[j]["name"] for j in deps[i]}
+
+    ENGINES[:] = [ENGINES[i] for i in order]
+
+
+# ---------- REGISTRY ----------
+# local=True: shares module memory with another engine (LAST_LTP/PREV_LTP
+# in scalp mode), resets shared caches, or does trade store / sheet I/O
+
+LTP = lambda: read("ltp")
+OC = lambda: read("oc")
+
+CPR_LEVELS = ("tc","pivot","bc")
+
+schedule("market", market_cells, ("ltp","vix"), EVERY_TICK, local=True)
+
+# levels recompute only when the previous day bar changes (once a day);
+# the ltp relation to them is re-evaluated every tick
+schedule("cpr", lambda: cpr_engine(LTP(), read("cpr")), ("ltp","cpr"),
+         writes=("relation",)+CPR_LEVELS)
+
+schedule("chain_legs", chain_legs, ("oc",), writes=("inst",), local=True)
+
+# ---------- STRUCTURE FIRST ----------
+schedule("vix_range", lambda: vix_range_engine(LTP(), read("vix"), vix_age()), ("ltp","vix"))
+schedule("oi_levels", lambda: oi_levels_engine(LTP(), OC()), ("oc",),
+         writes=("resistance","support","maxpain","max_pain","pcr"))
+
+# ---------- VWAP ----------
+schedule("vwap", vwap_step, ("oc","intraday","sheet"), writes=("vwap",))
+
+# ---------- GAMMA CORE ----------
+schedule("gamma", lambda: gamma_engine(LTP(), OC()), ("oc","premium_velocity"), writes=("gamma",))
+schedule("predictive_gamma", lambda: predictive_gamma_engine(LTP(), OC()), ("oc",),
+         writes=("premium_velocity","predictive_gamma"))
+schedule("god_mode", lambda: god_mode_engine(LTP(), OC()), ("oc",), writes=("god_signal",))
+
+# ---------- FLOATING STRUCTURE ----------
+schedule("auto_strike_floating", lambda: auto_strike_floating(LTP(), OC()), ("oc","quotes","relation"),
+         writes=("floating",))
+schedule("ema_panels", ema_panels, ("oc","quotes"))
+schedule("manual_strike_floating", lambda: manual_strike_floating(OC()), ("oc","quotes","sheet"))
+schedule("inst_panels", inst_panels, ("oc","quotes","inst"), writes=("inst_floating",))
+
+# ---------- FLOW & TARGET ----------
+# velocity engines run every tick: an unchanged ltp is itself a reading
+schedule("institutional_confirmation", lambda: institutional_confirmation(LTP(), OC()),
+         ("ltp","relation","gamma","vwap"), EVERY_TICK, writes=("flow",))
+schedule("breakout_radar", lambda: breakout_radar_engine(LTP()), ("ltp","relation","vwap"), EVERY_TICK)
+schedule("dealer_trap", lambda: dealer_trap_engine(LTP(), OC()),
+         ("oc","relation","gamma","vwap","resistance","support"))
+schedule("inside_cpr_pro", lambda: inside_cpr_pro_engine(LTP(), OC()), ("oc",)+CPR_LEVELS)
+schedule("liquidity_target", lambda: liquidity_target_engine(LTP(), read("cpr")),
+         ("ltp","cpr","relation","resistance","support","maxpain")+CPR_LEVELS, writes=("target",))
+schedule("dealer_trend", lambda: dealer_trend_intelligence(LTP()),
+         ("ltp","relation","vwap","floating","gamma"), writes=("trend_regime",))
+schedule("trend_continuation", lambda: trend_continuation_engine(LTP()),
+         ("ltp","relation","vwap","floating","gamma"), writes=("trend",))
+schedule("dark_pool", lambda: dark_pool_entry_engine(LTP(), OC()), ("oc","relation","vwap","gamma"),
+         writes=("dark",))
+schedule("absorption", lambda: absorption_radar_engine(LTP(), OC()), ("oc","relation","vwap"))
+schedule("liquidity_vacuum", lambda: liquidity_vacuum_radar(LTP(), OC()), ("ltp","oc","relation","vwap"),
+         EVERY_TICK)
+
+# ---------- SNIPER EXECUTION ----------
+schedule("opening_sniper", lambda: opening_sniper(LTP()), ("ltp","relation","vwap"))
+schedule("true_sniper", true_sniper_mode,
+         ("ltp","relation","vwap","gamma","flow","god_signal","predictive_gamma","floating"),
+         writes=("sniper",))
+schedule("sniper_antitrap", sniper_antitrap_filter, ("sniper","gamma","flow","target","floating"),
+         writes=("sniper_block",))
+schedule("auto_sniper", auto_sniper_execution,
+         ("ltp","relation","vwap","sniper","sniper_block","gamma","flow","trend","trend_regime","dark"))
+schedule("gamma_acceleration", gamma_acceleration_engine, ("gamma","flow","floating","sniper"))
+
+# ---------- FINAL DECISION ----------
+schedule("decision", decision_engine, ("floating","inst_floating","gamma"), writes=("decision",))
+schedule("scalp_mode", lambda: scalp_mode_v2(LTP(), OC()), (), every=SCALP_SEC, local=True)
+
+# ---------- TRADE MANAGEMENT ----------
+schedule("locked_trade_entry", locked_trade_entry, ("decision","floating","sheet"), local=True)
+schedule("locked_trade_exit", lambda: locked_trade_exit(LTP(), OC()), ("ltp","oc","quotes"),
+         writes=("trade_closed",), local=True)
+schedule("trade_log", trade_log_engine, ("decision","floating","sheet"), local=True)
+schedule("trade_exit", lambda: trade_exit_engine(LTP(), OC()), ("ltp","oc","quotes"),
+         writes=("trade_closed",), local=True)
+schedule("performance", performance_analytics, ("trade_closed",), local=True)
+
+order_engines()
+
+
+# ================= UNDERLYING CONTEXTS =================
+
+# UNDERLYINGS="NIFTY 50, BANKNIFTY:BNF, FINNIFTY:FIN" runs several
+# underlyings in one process, each rendering to its own tab (same layout as
+# the dashboard; a blank tab = the dashboard). Unset: the D1 underlying on
+# the dashboard, as before. Every context owns its copy of the globals
+# below and swaps them in while its engines run; HTTP pools, the quote
+# call, the feed, the scrip index and the trade store are shared.
+
+UNDERLYINGS = os.getenv("UNDERLYINGS", "")
+
+CONTEXT_GLOBALS = (
+    "UNDERLYING", "CURRENT_TRADE",
+    "STATE", "INPUTS", "WRITE_CACHE", "SHEET_CACHE", "SHEET_SHADOW", "LAST_SHADOW_RESYNC",
+    "HEARTBEAT", "LAST_HEARTBEAT",
+    "SOURCE_LAST", "ENGINE_RUNS",
+    "SIG", "option_high_low", "OPTION_INTRADAY", "VWAP_STREAM",
+    "LAST_CPR", "LAST_VWAP", "LAST_PREMIUM", "LAST_PREMIUM_TIME",
+    "LAST_LTP", "LAST_TIME", "OPENING_DONE", "LAST_LV_LTP",
+    "LAST_BREAK_LTP", "LAST_BREAK_TIME", "TREND_REGIME", "TREND_MEMORY",
+    "LAST_DARK_PREM", "PREV_LTP", "LAST_CE_PREM", "LAST_PE_PREM", "NEWS_MODE"
+)
 
-    if strike in existing:
-        return
 
-    # append trade
-    log_ws.append_row(row + ["ACTIVE"])
-def trade_exit_engine():
+class Context:
 
-    log_ws = gc.open("N50").worksheet("TRADE_LOG")
+    __slots__ = ("name","cfg","tab","scope")
 
-    data = log_ws.get_all_values()
+    def __init__(self, cfg, tab, defaults):
 
-    for i,row in enumerate(data[1:], start=2):
+        self.name = cfg["name"]
+        self.cfg = cfg
+        self.tab = tab or None
 
-        try:
+        self.scope = copy.deepcopy(defaults)
+        self.scope["UNDERLYING"] = cfg
+        self.scope["CURRENT_TRADE"] = resume_locked_trade(cfg["name"])
 
-            ltp = float(ws.acell("C6").value)
 
-            pivot_weak = float(row[2])
-            t1 = float(row[4])
-            t3 = float(row[6])
+CONTEXTS = []
+ACTIVE = None
 
-            exit_reason = ""
+# activate() swaps module globals and only ever runs on the loop thread.
+# Work handed to other threads (fetch jobs, candle refreshes, the trade
+# mirror) gets cfg, expiry and segment as arguments and resolves its own
+# worksheet, so it never reads UNDERLYING, ws or SHEET_CACHE mid-swap.
 
-            if ltp >= t3:
-                exit_reason = "EXIT DUE T3"
+def activate(ctx):
 
-            elif ltp < pivot_weak:
-                exit_reason = "EXIT PIVOT BREAK"
+    global ACTIVE, ws
 
-            elif ltp < t1:
-                exit_reason = "EXIT BELOW T1"
+    if ctx is ACTIVE:
+        return
 
-            if exit_reason:
+    if ACTIVE is not None:
+        ACTIVE.scope.update({name: globals()[name] for name in CONTEXT_GLOBALS})
 
-                ultra_write(f"J{i}", exit_reason)
+    globals().update(ctx.scope)
 
-        except:
-            continue
-# ================= PERFORMANCE ANALYTICS =================
+    ws = worksheet(ctx.tab)
+    ACTIVE = ctx
 
-def performance_analytics():
 
-    log_ws = gc.open("N50").worksheet("TRADE_LOG")
+def build_contexts():
 
-    data = log_ws.get_all_values()
+    # pristine module state, before any engine ran
+    defaults = {name: globals()[name] for name in CONTEXT_GLOBALS}
 
-    if len(data) <= 1:
-        return
+    entries = [e.partition(":") for e in UNDERLYINGS.split(",") if e.strip()]
 
-    total = 0
-    wins = 0
-    losses = 0
+    if not entries:
+        CONTEXTS.append(Context(UNDERLYING, None, defaults))
 
-    for row in data[1:]:
+    for symbol,_,tab in entries:
+        CONTEXTS.append(Context(resolve_market(symbol), tab.strip(), defaults))
 
-        if len(row) < 10:
-            continue
+    for ctx in CONTEXTS:
+        feed_subscribe(ctx.cfg["seg"], [ctx.cfg["id"]])
 
-        exit_reason = row[9]
+    activate(CONTEXTS[0])
 
-        if exit_reason == "":
-            continue
+    print("UNDERLYINGS:", ", ".join(f"{ctx.name} -> {ctx.tab or 'dashboard'}" for ctx in CONTEXTS))
 
-        total += 1
 
-        if "T3" in exit_reason:
-            wins += 1
-        else:
-            losses += 1
+build_contexts()
 
-    win_rate = (wins/total)*100 if total>0 else 0
 
-    ultra_write("L2", total)
-    ultra_write("L3", wins)
-    ultra_write("L4", losses)
-    ultra_write("L5", f"{round(win_rate,2)}%")
-# ================= TRADE STATE LOCK =================
+def run_context(ctx, snap, now):
 
-CURRENT_TRADE = None
-# ================= LOCKED TRADE ENTRY =================
+    activate(ctx)
 
-def locked_trade_entry():
+    ltp = apply_inputs(ctx, snap, now)
 
-    global CURRENT_TRADE
+    if ltp is None:
+        print("MARKET FAILED — SKIPPING LOOP:", ctx.name)
+        return
 
-    if CURRENT_TRADE is not None:
-        return  # already in trade
+    if read("oc") is None:
+        print("NO OC DATA — skipping loop:", ctx.name)
+        return
 
-    decision = safe("C10")
+    run_engines(now)
 
-    if "BUY" not in decision:
-        return
+    ultra_write("M3", datetime.datetime.now().strftime("%H:%M:%S"))
+    ultra_write("M4", f"{TICK_STATS['last']*1000:.0f} ms | {TICK_STATS['overruns']}/{TICK_STATS['ticks']} over")
 
-    log_ws = gc.open("N50").worksheet("TRADE_LOG")
 
-    row = ws.get("A17:I17")[0]
+    # ===== ULTRA WRITE FLUSH (CHANGED CELLS ONLY) =====
 
-    entry_time = datetime.datetime.now().strftime("%H:%M:%S")
+    flush_writes()
 
-    log_ws.append_row(row + ["", entry_time, "", "ACTIVE"])
 
-    last_row = len(log_ws.col_values(1))
+    print(">>> LOOP OK", ctx.name)
 
-    CURRENT_TRADE = {
-        "row": last_row,
-        "strike": row[0]
-    }
-# ================= LOCKED TRADE EXIT =================
 
-def locked_trade_exit():
+# ================= TICK RECORDER =================
 
-    global CURRENT_TRADE
+# Each tick's inputs (LTPs, leg quotes, VIX, chain columns, index and
+# option-leg intraday bars new since the last record, sheet inputs) go to
+# one compressed file per day. The loop only enqueues references to data that is never mutated
+# afterwards (frozen chain columns, swapped candle records); encoding and
+# compression run on the recorder thread.
+#   zstandard + msgpack installed: ticks-YYYY-MM-DD.msgpack.zst
+#   otherwise:                     ticks-YYYY-MM-DD.jsonl.gz
 
-    if CURRENT_TRADE is None:
-        return
+RECORD_TICKS = os.getenv("RECORD_TICKS", "1") == "1"
+RECORD_DIR = os.getenv("RECORD_DIR", "recordings")
+RECORD_FLUSH_SEC = float(os.getenv("RECORD_FLUSH_SEC", "10"))
+RECORD_LEVEL = int(os.getenv("RECORD_LEVEL", "3"))
 
-    log_ws = gc.open("N50").worksheet("TRADE_LOG")
+# a stalled disk drops ticks instead of growing memory or blocking the loop
+RECORD_QUEUE = queue.Queue(maxsize=int(os.getenv("RECORD_QUEUE", "600")))
 
-    r = CURRENT_TRADE["row"]
+RECORDER = {"day": None, "stream": None, "flushed": 0.0, "written": 0, "dropped": 0, "bars": {}, "fetched": {}}
 
-    try:
 
-        ltp = float(ws.acell("C6").value)
+def record_inputs(now, snap, sheet):
 
-        pivot_weak = float(log_ws.acell(f"C{r}").value)
-        t1 = float(log_ws.acell(f"E{r}").value)
-        t3 = float(log_ws.acell(f"G{r}").value)
+    if not RECORD_TICKS:
+        return
 
-        exit_reason = ""
+    tick = {
+        "t": now,
+        "ltp": snap.get("ltp"),
+        "quotes": {f"{seg}:{sid}": q["ltp"] for (seg,sid),q in list(QUOTES.items()) if q["ts"] >= now},
+        "vix": snap.get("vix"),
+        "vix_source": VIX["source"],
+        "sources": {f"{k[0]}:{k[1]}": v for k,v in snap.items() if isinstance(k, tuple) and v is not None},
+        "candles": [(sid, CANDLE_STORE[sid]) for sid in option_leg_ids() if sid in CANDLE_STORE],
+        "sheet": sheet
+    }
 
-        if ltp >= t3:
-            exit_reason = "EXIT DUE T3"
+    try:
+        RECORD_QUEUE.put_nowait(tick)
 
-        elif ltp < pivot_weak:
-            exit_reason = "EXIT PIVOT BREAK"
+    except queue.Full:
+        RECORDER["dropped"] += 1
 
-        elif ltp < t1:
-            exit_reason = "EXIT BELOW T1"
 
-        if exit_reason:
+def option_leg_ids():
 
-            exit_time = datetime.datetime.now().strftime("%H:%M:%S")
+    # every leg any underlying prefetched today (chain_legs, fetch_candles)
+    ids = set()
 
-            ultra_write(f"J{r}", exit_reason)
-            ultra_write(f"L{r}", exit_time)
+    for ctx in CONTEXTS:
+        ids |= (globals() if ctx is ACTIVE else ctx.scope)["OPTION_INTRADAY"].keys()
 
-            if "T3" in exit_reason:
-                ultra_write(f"M{r}", "WIN")
-            else:
-                ultra_write(f"M{r}", "LOSS")
+    return ids
 
-            CURRENT_TRADE = None
 
-    except:
-        pass
+def chain_columns(oc):
 
-NEWS_MODE = False
-PREV_LTP = None
+    return {
+        "strikes": oc.strikes, "step": oc.step, "segment": oc.segment,
+        "ce": dict(oc.ce), "pe": dict(oc.pe)
+    }
 
-def news_mode_engine(ltp):
 
-    global NEWS_MODE, PREV_LTP
+def new_bars(key, candles):
 
-    if PREV_LTP is None:
-        PREV_LTP = ltp
-        return
+    # only the bars from the last recorded one on; the forming bar is
+    # re-sent until it closes, same as the candle store does
+    stamps = candles["timestamp"]
 
-    move = abs(ltp - PREV_LTP)
+    last = RECORDER["bars"].get(key)
+    start = bisect.bisect_left(stamps, last) if last is not None else 0
 
-    if move >= 80:
-        NEWS_MODE = True
-    else:
-        NEWS_MODE = False
+    if stamps:
+        RECORDER["bars"][key] = stamps[-1]
 
-    PREV_LTP = ltp
+    return {k: candles[k][start:] for k in ("timestamp",) + CANDLE_FIELDS}
 
-# ================= SHARED INTRADAY CACHE =================
-# ================= SHARED INTRADAY CACHE =================
 
-EMA_CANDLE_CACHE = {}
+def encode_tick(tick):
 
-def fetch_intraday_closes(security_id):
+    sources = {}
 
-    global EMA_CANDLE_CACHE
+    for name,value in tick["sources"].items():
 
-    if security_id in EMA_CANDLE_CACHE:
-        return EMA_CANDLE_CACHE[security_id]
+        if isinstance(value, OptionChain):
+            value = chain_columns(value)
 
-    try:
+        elif name.endswith(":intraday"):
+            value = {"price": new_bars((name, "price"), value["price"]),
+                     "volume": None if value["volume"] is value["price"] else new_bars((name, "volume"), value["volume"])}
 
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sources[name] = value
 
-        payload = {
-            "securityId": str(security_id),
-            "exchangeSegment": "NSE_FNO",
-            "instrument": "OPTIDX",
-            "interval": "1",
-            "fromDate": f"{today} 09:15:00",
-            "toDate": now
-        }
+    # option-leg series, once per refresh
+    candles = {}
 
-        r = requests.post(
-            "https://api.dhan.co/v2/charts/intraday",
-            headers=headers(),
-            json=payload
-        ).json()
+    for sid,bars in tick["candles"]:
 
-        closes = []
+        if RECORDER["fetched"].get(sid) == bars["fetched"]:
+            continue
 
-        data = r.get("data", {})
+        RECORDER["fetched"][sid] = bars["fetched"]
+        candles[sid] = new_bars(("candles", sid), bars)
 
-        if "candles" in data:
-            for c in data["candles"]:
-                closes.append(float(c[4]))
+    return dict(tick, sources=sources, candles=candles)
 
-        elif "close" in data:
-            closes = [float(x) for x in data.get("close",[])]
 
-        EMA_CANDLE_CACHE[security_id] = closes
+def pack_default(o):
 
-        return closes
+    if isinstance(o, np.ndarray):
+        return {"nd": o.dtype.str, "shape": list(o.shape), "b": o.tobytes()}
 
-    except:
+    if isinstance(o, np.generic):
+        return o.item()
 
-        return []
-# ================= LOOP =================
+    raise TypeError(f"cannot record {type(o).__name__}")
 
-# ================= LOOP (OPTIMIZED INSTITUTIONAL ORDER) =================
 
-while True:
+def json_default(o):
 
-    try:
+    if isinstance(o, (np.ndarray, np.generic)):
+        return o.tolist()
 
-        EMA_CANDLE_CACHE.clear()
-        # ===== ULTRA READ CACHE =====
-
-        cells = ws.batch_get([
-            "B1","B2","B4",
-            "H4","H5","H6","H9",
-            "Q3","M17","N17","N9",
-            "A17","A19","A23",
-            "B31","B32","B33",
-            "C6","N5","N6","N23"
-        ])
-
-        keys = [
-            "B1","B2","B4",
-            "H4","H5","H6","H9",
-            "Q3","M17","N17","N9",
-            "A17","A19","A23",
-            "B31","B32","B33",
-            "C6","N5","N6","N23"
-        ]
+    raise TypeError(f"cannot record {type(o).__name__}")
 
-        SHEET_CACHE.clear()
-        SHEET_CACHE.update({
-            k:(cells[i][0][0] if cells[i] else "")
-            for i,k in enumerate(keys)
-        })
 
+def recorder_stream(day):
 
-        # ---------- MARKET ----------
-        ltp, vix = market()
+    if RECORDER["day"] == day:
+        return RECORDER["stream"]
 
-        if ltp is None:
-            print("MARKET FAILED — SKIPPING LOOP")
-            time.sleep(8)
-            continue
+    if RECORDER["stream"] is not None:
+        RECORDER["stream"].close()
 
-        news_mode_engine(ltp)
+    os.makedirs(RECORD_DIR, exist_ok=True)
 
-        ultra_write("C6", ltp)
-        ultra_write("C7", vix)
+    # appending after a restart starts a new zstd frame / gzip member
+    if zstandard:
+        path = os.path.join(RECORD_DIR, f"ticks-{day}.msgpack.zst")
+        stream = zstandard.ZstdCompressor(level=RECORD_LEVEL).stream_writer(open(path, "ab"))
+    else:
+        path = os.path.join(RECORD_DIR, f"ticks-{day}.jsonl.gz")
+        stream = gzip.open(path, "ab", compresslevel=RECORD_LEVEL)
 
+    RECORDER.update({"day": day, "stream": stream, "bars": {}, "fetched": {}})
 
-        # ---------- CPR ----------
-        cpr_engine(ltp)
+    print("RECORDING TICKS TO", path)
 
+    return stream
 
-        # ---------- OPTIONCHAIN ----------
-        oc = optionchain()
 
-        if not oc:
-            print("NO OC DATA — skipping loop")
-            time.sleep(8)
-            continue
+def recorder_worker():
 
+    while True:
 
-        # ---------- STRUCTURE FIRST ----------
-        vix_range_engine(ltp, vix)
-        oi_levels_engine(ltp, oc)
+        tick = RECORD_QUEUE.get()
 
+        try:
+
+            stream = recorder_stream(ist_today().isoformat())
 
-        # ---------- VWAP ----------
-        vwap(ltp, oc)
+            tick = encode_tick(tick)
 
+            if zstandard:
+                stream.write(msgpack.packb(tick, default=pack_default, use_bin_type=True))
+            else:
+                stream.write((json.dumps(tick, default=json_default) + "\n").encode())
 
-        # ---------- GAMMA CORE ----------
-        gamma_engine(ltp, oc)
-        predictive_gamma_engine(ltp, oc)
-        god_mode_engine(ltp, oc)
+            RECORDER["written"] += 1
 
+            # bound what a crash can lose
+            if time.time() - RECORDER["flushed"] >= RECORD_FLUSH_SEC:
+                stream.flush(zstandard.FLUSH_FRAME) if zstandard else stream.flush()
+                RECORDER["flushed"] = time.time()
 
-        # ---------- FLOATING STRUCTURE ----------
-        auto_strike_floating(ltp, oc)
+        except Exception as e:
+            print("RECORDER ERROR:", type(e).__name__, e)
 
-        atm = round(ltp/50)*50
 
-        # --- EMA SCALP PANEL ---
-        process_strike_ema_scalp(atm,"CE",oc,"A38:I38")
-        process_strike_ema_scalp(atm,"PE",oc,"A39:I39")
+def recorded_ticks(path):
 
-        # --- EMA COMPRESSION PANEL ---
-        process_strike_ema_compression(atm,"CE",oc,"A41:I41")
-        process_strike_ema_compression(atm,"PE",oc,"A42:I42")
+    # replay side: yields the ticks of one file, arrays restored
+    def unpack(obj):
+        if "nd" in obj and "b" in obj:
+            return np.frombuffer(obj["b"], dtype=obj["nd"]).reshape(obj["shape"])
+        return obj
 
-        manual_strike_floating(oc)
+    # a file cut short by a crash ends at its last flushed tick
+    try:
 
+        if path.endswith(".zst"):
 
-        inst_ce, inst_pe = institutional_strike_selector(ltp, oc)
+            with open(path, "rb") as f:
+                reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+                yield from msgpack.Unpacker(reader, object_hook=unpack, raw=False, strict_map_key=False)
 
-        if inst_ce:
-            institutional_floating(inst_ce,"CE",oc,"A19")
+        else:
 
-        if inst_pe:
-            institutional_floating(inst_pe,"PE",oc,"A25")
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    yield json.loads(line)
 
+    except (EOFError, ValueError) + ((zstandard.ZstdError,) if zstandard else ()):
+        return
 
-        # ---------- FLOW & TARGET ----------
-        institutional_confirmation(ltp, oc)
-        breakout_radar_engine(ltp)
-        dealer_trap_engine(ltp, oc)
-        inside_cpr_pro_engine(ltp, oc)
-        liquidity_target_engine(ltp)
-        dealer_trend_intelligence(ltp)
-        trend_continuation_engine(ltp)
-        dark_pool_entry_engine(ltp, oc)
-        absorption_radar_engine(ltp, oc)
-        liquidity_vacuum_radar(ltp, oc)
 
+if RECORD_TICKS:
+    threading.Thread(target=recorder_worker, daemon=True).start()
 
-        # ---------- SNIPER EXECUTION ----------
-        opening_sniper(ltp)
-        true_sniper_mode()
-        sniper_antitrap_filter()
-        auto_sniper_execution()
-        gamma_acceleration_engine()
 
+# ================= LOOP =================
 
-        # ---------- FINAL DECISION ----------
-        decision_engine()
-        scalp_mode_v2(ltp, oc)
+while True:
 
+    started = time.time()
 
-        # ---------- TRADE MANAGEMENT ----------
-        locked_trade_entry()
-        locked_trade_exit()
-        trade_log_engine()
-        trade_exit_engine()
-        performance_analytics()
+    try:
 
+        # ===== ULTRA READ CACHE (ALL TABS, ONE CALL) =====
+        sheet = read_sheet_inputs(started)
 
-        ultra_write("M3", datetime.datetime.now().strftime("%H:%M:%S"))
+        # ---------- FETCH STAGE (DUE SOURCES OF ALL UNDERLYINGS IN PARALLEL) ----------
+        snap = fetch_stage(fetch_jobs(started))
 
+        # cached for VIX_TTL; normally just reads the quote the LTP call brought
+        snap["vix"] = india_vix(snap.pop("vix_nse", None))
 
-        # ===== ULTRA WRITE FLUSH =====
+        # ---------- ENGINES: ONE UNDERLYING AT A TIME ----------
+        try:
 
-        if WRITE_CACHE:
+            for ctx in CONTEXTS:
 
-            batch_data = [
-                {"range":k,"values":[[v]]}
-                for k,v in WRITE_CACHE.items()
-            ]
+                try:
+                    run_context(ctx, snap, started)
 
-            ws.batch_update(batch_data)
+                except Exception as e:
 
-            WRITE_CACHE.clear()
+                    if is_auth_error(e):
+                        raise
 
+                    print("ERROR:", ctx.name, e)
 
-        print(">>> LOOP OK")
+        finally:
 
-        time.sleep(8)
+            # after the engines, so the option-leg candles they loaded ride along
+            record_inputs(started, snap, sheet)
 
+        save_indicators(started)
 
     except Exception as e:
 
         print("ERROR:", e)
-        time.sleep(8)
-
 
+        if is_auth_error(e):
 
+            # a failed re-auth is retried on the next tick
+            try:
+                refresh_worksheets()
+                ws = worksheet(ACTIVE.tab if ACTIVE else None)
+            except Exception as e:
+                print("SHEETS RE-AUTH FAILED:", e)
 
+    finish_tick(started)